@@ -3,6 +3,7 @@ from __future__ import annotations
 from openai import AsyncOpenAI, OpenAI
 
 from .errors import (
+    InvalidCursorError,
     InvalidOptionsError,
     InvalidTracerError,
     KantanLLMError,
@@ -34,6 +35,7 @@ __all__ = [
     "WrongAPIError",
     "InvalidOptionsError",
     "InvalidTracerError",
+    "InvalidCursorError",
     "MissingDependencyError",
     "NotSupportedError",
 ]
@@ -65,6 +65,13 @@ class NotSupportedError(KantanLLMError):
         super().__init__(f"[kantan-llm][E16] Not supported: {feature}")
 
 
+class InvalidCursorError(KantanLLMError):
+    """Raised when a search cursor is invalid. / 検索カーソルが不正。"""
+
+    def __init__(self, cursor: str):
+        super().__init__(f"[kantan-llm][E17] Invalid search cursor: {cursor!r}")
+
+
 @dataclass(frozen=True)
 class LLMErrorContext:
     provider: str | None
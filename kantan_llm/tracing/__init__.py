@@ -1,17 +1,34 @@
 from __future__ import annotations
 
+from .cache import CachedTraceSearchService
 from .create import custom_span, function_span, generation_span, get_current_span, get_current_trace, trace
 from .processor_interface import TracingProcessor
+from .jsonl import JSONLTraceReader, JSONLTracer
+from .memory import MemoryTracer
+from .partitioned import PartitionedSQLiteTracer
 from .processors import NoOpTracer, OTELTracer, PrintTracer, SQLiteTracer
 from .search import (
+    AggregateQuery,
+    AggregateRow,
+    And,
+    AsyncTraceSearchService,
+    Compare,
+    Not,
+    Or,
+    Predicate,
+    SearchPage,
     SpanQuery,
     SpanRecord,
     TraceQuery,
     TraceRecord,
     TraceSearchCapabilities,
     TraceSearchService,
+    UsageQuery,
+    UsageRow,
 )
 from .provider import DefaultTraceProvider, TraceProvider, get_trace_provider, set_trace_provider
+from .retention import RetentionPolicy, RetentionReport
+from .storage import StorageProfile
 from .setup import add_trace_processor, set_trace_processors, set_tracing_disabled
 from .spans import Span, SpanError
 from .traces import Trace
@@ -32,15 +49,32 @@ __all__ = [
     "set_trace_provider",
     "set_tracing_disabled",
     "trace",
+    "AggregateQuery",
+    "AggregateRow",
+    "And",
+    "AsyncTraceSearchService",
+    "CachedTraceSearchService",
+    "Compare",
     "DefaultTraceProvider",
+    "JSONLTraceReader",
+    "JSONLTracer",
+    "MemoryTracer",
     "NoOpTracer",
+    "Not",
     "OTELTracer",
+    "Or",
+    "PartitionedSQLiteTracer",
+    "Predicate",
     "PrintTracer",
+    "RetentionPolicy",
+    "RetentionReport",
     "SQLiteTracer",
+    "SearchPage",
     "SpanQuery",
     "SpanRecord",
     "Span",
     "SpanError",
+    "StorageProfile",
     "Trace",
     "TraceQuery",
     "TraceRecord",
@@ -48,4 +82,6 @@ __all__ = [
     "TraceSearchService",
     "TraceProvider",
     "TracingProcessor",
+    "UsageQuery",
+    "UsageRow",
 ]
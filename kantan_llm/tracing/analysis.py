@@ -3,8 +3,12 @@ from __future__ import annotations
 from typing import Sequence
 
 from ..errors import NotSupportedError
+from .processors import _rubric_bucket
 from .search import SpanQuery, SpanRecord, TraceQuery, TraceSearchService
 
+# Trace ids per multi-trace span query (below SQLite's host parameter limit). / 1回の複数Trace検索に渡すtrace_id数。
+_TRACE_ID_CHUNK = 500
+
 
 def find_failed_judges(
     service: TraceSearchService,
@@ -17,12 +21,20 @@ def find_failed_judges(
     if limit and not caps.supports_limit:
         raise NotSupportedError("limit")
 
+    # Stores with a rubric_score column return only failing spans, so limit caps the result.
+    # / rubric_score列を持つ実装は失敗Spanだけを返すため、limitは結果件数の上限になる。
+    score_lt = threshold if caps.supports_rubric_score else None
+
     if trace_query is not None:
         _ensure_trace_query_supported(caps, trace_query)
         trace_ids = [record.trace_id for record in service.search_traces(query=trace_query)]
-        return _collect_failed_judges_by_trace(service, trace_ids, threshold, limit)
+        if caps.supports_trace_ids:
+            return _collect_failed_judges_by_trace(service, trace_ids, threshold, limit, score_lt)
+        return _collect_failed_judges_per_trace(service, trace_ids, threshold, limit, score_lt)
 
-    spans = service.search_spans(query=SpanQuery(span_type="custom", name="judge", limit=limit))
+    spans = service.search_spans(
+        query=SpanQuery(span_type="custom", name="judge", rubric_score_lt=score_lt, limit=limit)
+    )
     return [span for span in spans if _is_failed(span, threshold)]
 
 
@@ -51,6 +63,30 @@ def _collect_failed_judges_by_trace(
     trace_ids: Sequence[str],
     threshold: float,
     limit: int,
+    score_lt: float | None,
+) -> list[SpanRecord]:
+    failed: list[SpanRecord] = []
+    for start in range(0, len(trace_ids), _TRACE_ID_CHUNK):
+        chunk = list(trace_ids[start : start + _TRACE_ID_CHUNK])
+        spans = service.search_spans(
+            query=SpanQuery(trace_ids=chunk, span_type="custom", name="judge", rubric_score_lt=score_lt)
+        )
+        # Keep the trace order of the input, then ingest order within each trace.
+        # 入力のTrace順、その中は取り込み順を保つ。
+        position = {trace_id: index for index, trace_id in enumerate(chunk)}
+        ordered = sorted(spans, key=lambda span: position[span.trace_id])
+        failed.extend(span for span in ordered if _is_failed(span, threshold))
+        if len(failed) >= limit:
+            return failed[:limit]
+    return failed
+
+
+def _collect_failed_judges_per_trace(
+    service: TraceSearchService,
+    trace_ids: Sequence[str],
+    threshold: float,
+    limit: int,
+    score_lt: float | None,
 ) -> list[SpanRecord]:
     failed: list[SpanRecord] = []
     for trace_id in trace_ids:
@@ -58,7 +94,9 @@ def _collect_failed_judges_by_trace(
         if remaining <= 0:
             break
         spans = service.search_spans(
-            query=SpanQuery(trace_id=trace_id, span_type="custom", name="judge", limit=remaining)
+            query=SpanQuery(
+                trace_id=trace_id, span_type="custom", name="judge", rubric_score_lt=score_lt, limit=remaining
+            )
         )
         for span in spans:
             if _is_failed(span, threshold):
@@ -78,15 +116,4 @@ def _is_failed(span: SpanRecord, threshold: float) -> bool:
 
 
 def _pick_bucket(span: SpanRecord) -> str:
-    rubric = span.rubric or {}
-    tags = rubric.get("tags")
-    if isinstance(tags, list) and tags:
-        first = tags[0]
-        if isinstance(first, str) and first:
-            return first
-    comment = rubric.get("comment")
-    if isinstance(comment, str):
-        token = comment.strip().split(" ", 1)[0]
-        if token:
-            return token
-    return "other"
+    return _rubric_bucket(span.rubric or {}) or "other"
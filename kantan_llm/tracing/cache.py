@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Iterator, TypeVar
+
+from ..errors import NotSupportedError
+from .search import (
+    AggregateQuery,
+    AggregateRow,
+    SearchPage,
+    SpanQuery,
+    SpanRecord,
+    TraceQuery,
+    TraceRecord,
+    TraceSearchCapabilities,
+    UsageQuery,
+    UsageRow,
+)
+
+_T = TypeVar("_T")
+
+
+class CachedTraceSearchService:
+    """LRU result cache in front of a TraceSearchService. / TraceSearchServiceの前に置くLRU結果キャッシュ。
+
+    Results are keyed by method and normalized query and reused until the backend's ``data_version()``
+    changes, so identical polls between writes skip the query. Streaming methods (``iter_*`` / ``aiter_*``)
+    pass through. Cached records are shared between callers; treat them as read-only.
+    / メソッドと正規化したクエリをキーに結果を保持し、バックエンドの ``data_version()`` が変わるまで再利用する。
+    書き込みの合間の同じポーリングはクエリを実行しない。``iter_*`` / ``aiter_*`` は素通しする。
+    キャッシュしたRecordは呼び出し側で共有されるため読み取り専用として扱う。
+    """
+
+    def __init__(self, service: Any, *, maxsize: int = 256) -> None:
+        if not callable(getattr(service, "data_version", None)):
+            raise NotSupportedError(f"CachedTraceSearchService over {type(service).__name__} (no data_version)")
+        self._service = service
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[Any, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def service(self) -> Any:
+        return self._service
+
+    def invalidate(self) -> None:
+        """Drop every cached result. / キャッシュをすべて破棄する。"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def capabilities(self) -> TraceSearchCapabilities:
+        return self._service.capabilities()
+
+    # ---- cached / キャッシュ対象 ----
+
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        return self._cached("search_traces", query, lambda: self._service.search_traces(query=query))
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        return self._cached("search_spans", query, lambda: self._service.search_spans(query=query))
+
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        return self._cached("aggregate", query, lambda: self._service.aggregate(query=query))
+
+    def usage_rollups(self, *, query: UsageQuery) -> list[UsageRow]:
+        return self._cached("usage_rollups", query, lambda: self._service.usage_rollups(query=query))
+
+    def get_trace(self, trace_id: str) -> TraceRecord | None:
+        return self._cached("get_trace", trace_id, lambda: self._service.get_trace(trace_id))
+
+    def get_span(self, span_id: str) -> SpanRecord | None:
+        return self._cached("get_span", span_id, lambda: self._service.get_span(span_id))
+
+    def get_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return self._cached("get_spans_by_trace", trace_id, lambda: self._service.get_spans_by_trace(trace_id))
+
+    def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        return self._cached(
+            "get_spans_since", (trace_id, since_seq), lambda: self._service.get_spans_since(trace_id, since_seq)
+        )
+
+    async def asearch_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        return await self._acached("search_traces", query, lambda: self._service.asearch_traces(query=query))
+
+    async def asearch_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        return await self._acached("search_spans", query, lambda: self._service.asearch_spans(query=query))
+
+    async def aaggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        return await self._acached("aggregate", query, lambda: self._service.aaggregate(query=query))
+
+    async def ausage_rollups(self, *, query: UsageQuery) -> list[UsageRow]:
+        return await self._acached("usage_rollups", query, lambda: self._service.ausage_rollups(query=query))
+
+    async def aget_trace(self, trace_id: str) -> TraceRecord | None:
+        return await self._acached("get_trace", trace_id, lambda: self._service.aget_trace(trace_id))
+
+    async def aget_span(self, span_id: str) -> SpanRecord | None:
+        return await self._acached("get_span", span_id, lambda: self._service.aget_span(span_id))
+
+    async def aget_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return await self._acached(
+            "get_spans_by_trace", trace_id, lambda: self._service.aget_spans_by_trace(trace_id)
+        )
+
+    async def aget_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        return await self._acached(
+            "get_spans_since", (trace_id, since_seq), lambda: self._service.aget_spans_since(trace_id, since_seq)
+        )
+
+    # ---- pass-through / 素通し ----
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]:
+        return self._service.iter_traces(query=query, chunk_size=chunk_size)
+
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        return self._service.iter_spans(query=query, chunk_size=chunk_size)
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        return self._service.iter_spans_by_trace(trace_id, chunk_size=chunk_size)
+
+    def aiter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> AsyncIterator[TraceRecord]:
+        return self._service.aiter_traces(query=query, chunk_size=chunk_size)
+
+    def aiter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> AsyncIterator[SpanRecord]:
+        return self._service.aiter_spans(query=query, chunk_size=chunk_size)
+
+    # ---- internals / 内部 ----
+
+    def _cached(self, method: str, args: Any, call: Callable[[], _T]) -> _T:
+        key = _cache_key(method, args)
+        # Read the version before the query: a write landing mid-query leaves the entry already stale.
+        # / バージョンはクエリ前に読む（実行中の書き込みがあればその結果は既に古い扱いになる）。
+        version = self._service.data_version()
+        found, result = self._lookup(key, version)
+        if not found:
+            result = call()
+            self._store(key, version, result)
+        return _copy(result)
+
+    async def _acached(self, method: str, args: Any, call: Callable[[], Awaitable[_T]]) -> _T:
+        key = _cache_key(method, args)
+        version = self._service.data_version()
+        found, result = self._lookup(key, version)
+        if not found:
+            result = await call()
+            self._store(key, version, result)
+        return _copy(result)
+
+    def _lookup(self, key: Hashable | None, version: Any) -> tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key) if key is not None else None
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def _store(self, key: Hashable | None, version: Any, result: Any) -> None:
+        if key is None or self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+def _cache_key(method: str, args: Any) -> Hashable | None:
+    # Unhashable leftovers (e.g. custom objects in metadata) bypass the cache. / ハッシュできない値はキャッシュしない。
+    key = (method, _normalize(args))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _normalize(value: Any) -> Any:
+    # Equal queries map to equal keys: dataclasses by field, dicts by sorted items. / 同じ条件は同じキーになる。
+    if is_dataclass(value) and not isinstance(value, type):
+        return (type(value).__name__, tuple((f.name, _normalize(getattr(value, f.name))) for f in fields(value)))
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted(((str(k), _normalize(v)) for k, v in value.items()), key=lambda item: item[0])))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return ("set", tuple(sorted((_normalize(item) for item in value), key=repr)))
+    return value
+
+
+def _copy(result: _T) -> _T:
+    # Callers get their own list; the records inside are shared. / リストは呼び出しごとに複製し、Recordは共有する。
+    if isinstance(result, SearchPage):
+        return SearchPage(result, result.next_cursor)  # type: ignore[return-value]
+    if isinstance(result, list):
+        return list(result)  # type: ignore[return-value]
+    return result
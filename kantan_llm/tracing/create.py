@@ -82,9 +82,13 @@ def generation_span(
     span_id: str | None = None,
     parent: Trace | Span[Any] | None = None,
     disabled: bool = False,
+    provider: str | None = None,
+    api_kind: str | None = None,
 ) -> Span[GenerationSpanData]:
     return get_trace_provider().create_span(
-        span_data=GenerationSpanData(input=input, output=output, model=model, usage=usage),
+        span_data=GenerationSpanData(
+            input=input, output=output, model=model, usage=usage, provider=provider, api_kind=api_kind
+        ),
         span_id=span_id,
         parent=parent,
         disabled=disabled,
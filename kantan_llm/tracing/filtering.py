@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import json
+import operator
+from datetime import datetime, timezone
+from typing import Any, Iterable
+
+from ..errors import NotSupportedError
+from .processors import (
+    _MODEL_COLUMNS,
+    _SPAN_PREDICATE_FIELDS,
+    _TRACE_PREDICATE_FIELDS,
+    _USAGE_TOKEN_KEYS,
+    _add_usage_total,
+    _aggregate_names,
+    _aggregate_order,
+    _check_compare,
+    _decode_cursor,
+    _encode_cursor,
+    _epoch_us,
+    _json_or_none,
+    _normalize_query_dt,
+    _parse_dt,
+    _percentile,
+    _rubric_bucket,
+    _trace_order,
+    _usage_tokens,
+    _usage_total_json,
+)
+from .search import AggregateQuery, AggregateRow, And, Compare, Not, Or, Predicate, SpanQuery, TraceQuery
+
+# Evaluate TraceQuery/SpanQuery in Python over rows shaped like the SQLite tables (plain dicts keyed by column
+# name), for tracers that scan instead of querying SQL. / SQLを使わず走査するトレーサー向けに、SQLiteの行と
+# 同じ形のdictに対してTraceQuery/SpanQueryを評価する。
+
+_SPAN_ORDER_KEY = "spans:ingest_seq:ASC"
+_SPAN_FIELDS = {*_SPAN_PREDICATE_FIELDS, *_USAGE_TOKEN_KEYS}
+_COMPARE_OPS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def span_matches(row: dict[str, Any], query: SpanQuery, default_tz) -> bool:
+    """Same conditions as the SQLite span search. / SQLiteのSpan検索と同じ条件。"""
+
+    if query.span_id and row["id"] != query.span_id:
+        return False
+    if query.trace_id and row["trace_id"] != query.trace_id:
+        return False
+    if query.trace_ids is not None and row["trace_id"] not in query.trace_ids:
+        return False
+    if query.span_type and row["span_type"] != query.span_type:
+        return False
+    if query.name and row["name"] != query.name:
+        return False
+    for column in _MODEL_COLUMNS:
+        value = getattr(query, column)
+        if value and row[column] != value:
+            return False
+    if query.has_error is not None and bool(row["has_error"]) != query.has_error:
+        return False
+    if query.has_tool_call is not None and bool(row["has_tool_call"]) != query.has_tool_call:
+        return False
+    score = row["rubric_score"]
+    if query.rubric_score_gte is not None and (score is None or score < query.rubric_score_gte):
+        return False
+    if query.rubric_score_lt is not None and (score is None or score >= query.rubric_score_lt):
+        return False
+    if query.keywords and not all(_keyword_in_span(row, kw) for kw in query.keywords):
+        return False
+    if query.where is not None and predicate_matches(query.where, row, _SPAN_FIELDS, _span_field) is not True:
+        return False
+    return _in_us_range(row["started_at_us"], query.started_from, query.started_to, default_tz)
+
+
+def trace_matches(row: dict[str, Any], spans: list[dict[str, Any]], query: TraceQuery, default_tz) -> bool:
+    """Same conditions as the SQLite trace search. / SQLiteのTrace検索と同じ条件。"""
+
+    if query.trace_id and row["id"] != query.trace_id:
+        return False
+    if query.workflow_name and row["workflow_name"] != query.workflow_name:
+        return False
+    if query.group_id and row["group_id"] != query.group_id:
+        return False
+    # Each keyword may match a different span. / キーワードごとに別のSpanで一致してよい。
+    for kw in query.keywords or []:
+        if not any(_keyword_in_span(span, kw) for span in spans):
+            return False
+    if query.has_error is not None and (row["error_count"] > 0) != query.has_error:
+        return False
+    if query.has_tool_call is not None and (row["tool_call_count"] > 0) != query.has_tool_call:
+        return False
+    if query.metadata and not _metadata_matches(row["metadata_json"], query.metadata):
+        return False
+    if query.where is not None and predicate_matches(query.where, row, _TRACE_PREDICATE_FIELDS, _row_field) is not True:
+        return False
+    if query.started_from is None and query.started_to is None:
+        return True
+    # Any span starting in the range, like the SQL EXISTS. / SQLのEXISTSと同様に範囲内に開始したSpanがあれば一致。
+    return any(_in_us_range(span["started_at_us"], query.started_from, query.started_to, default_tz) for span in spans)
+
+
+def predicate_matches(predicate: Predicate, row: dict[str, Any], fields: Any, get: Any) -> bool | None:
+    """SQL three-valued logic: None when a compared value is missing. / SQLと同じ3値論理（値が無ければNone）。"""
+
+    if isinstance(predicate, Compare):
+        _check_compare(predicate, fields)
+        actual = get(row, predicate.field)
+        if predicate.value is None:
+            return (actual is None) == (predicate.op == "=")
+        if actual is None:
+            return None
+        try:
+            return bool(_COMPARE_OPS[predicate.op](actual, predicate.value))
+        except TypeError:
+            return None
+    if isinstance(predicate, (And, Or)):
+        results = [predicate_matches(item, row, fields, get) for item in predicate.predicates]
+        decisive = isinstance(predicate, Or)
+        if decisive in results:
+            return decisive
+        return None if None in results else not decisive
+    if isinstance(predicate, Not):
+        result = predicate_matches(predicate.predicate, row, fields, get)
+        return None if result is None else not result
+    raise NotSupportedError(f"predicate {type(predicate).__name__}")
+
+
+def trace_row(values: tuple[Any, ...], spans: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """A traces row with rollup columns computed from its spans. / Spanから集計列を計算したtraces行。"""
+
+    trace_id, workflow_name, group_id, metadata_json = values
+    row: dict[str, Any] = {
+        "id": trace_id,
+        "workflow_name": workflow_name,
+        "group_id": group_id,
+        "metadata_json": metadata_json,
+        "span_count": 0,
+        "error_count": 0,
+        "tool_call_count": 0,
+        **{key: 0 for key in _USAGE_TOKEN_KEYS},
+    }
+    started: list[str] = []
+    ended: list[str] = []
+    usage_total: dict[str, Any] = {}
+    for span in spans:
+        _add_usage_total(usage_total, span["usage"])
+        row["span_count"] += 1
+        row["error_count"] += int(bool(span["has_error"]))
+        row["tool_call_count"] += int(bool(span["has_tool_call"]))
+        for key, value in _usage_tokens(span["usage"]).items():
+            row[key] += value
+        if span["started_at"]:
+            started.append(span["started_at"])
+        if span["ended_at"]:
+            ended.append(span["ended_at"])
+    row["usage_total_json"] = _usage_total_json(usage_total)
+    row["started_at"] = min(started) if started else None
+    row["ended_at"] = max(ended) if ended else None
+    start, end = _parse_dt(row["started_at"]), _parse_dt(row["ended_at"])
+    row["duration_ms"] = round((end - start).total_seconds() * 1000) if start and end else None
+    return row
+
+
+def page_traces(rows: list[dict[str, Any]], query: TraceQuery) -> tuple[list[dict[str, Any]], str | None]:
+    """Order, apply the cursor and limit like SQLiteTracer. / SQLiteTracerと同じ並び・カーソル・件数制限。"""
+
+    if query.order_by == "relevance":
+        raise NotSupportedError("order_by=relevance")
+    column, descending = _trace_order(query.order_by)
+    order_key = f"traces:{column}:{'DESC' if descending else 'ASC'}"
+    keyed = sorted(((_sort_key(row[column], row["id"]), row) for row in rows), key=lambda item: item[0])
+    if descending:
+        keyed.reverse()
+    if query.cursor:
+        after = _sort_key(*_decode_cursor(query.cursor, order_key))
+        keyed = [(key, row) for key, row in keyed if (key < after if descending else key > after)]
+    ordered = [row for _, row in keyed]
+    page = ordered[: query.limit] if query.limit else ordered
+    next_cursor = None
+    if query.limit and len(page) == query.limit:
+        next_cursor = _encode_cursor(order_key, [page[-1][column], page[-1]["id"]])
+    return page, next_cursor
+
+
+def page_spans(rows: list[dict[str, Any]], query: SpanQuery) -> tuple[list[dict[str, Any]], str | None]:
+    """Ingest order with cursor and limit like SQLiteTracer. / SQLiteTracerと同じ取り込み順・カーソル・件数制限。"""
+
+    if query.order_by is not None:
+        raise NotSupportedError(f"order_by={query.order_by}")
+    ordered = sorted(rows, key=lambda row: (row["ingest_seq"], row["id"]))
+    if query.cursor:
+        seq, span_id = _decode_cursor(query.cursor, _SPAN_ORDER_KEY)
+        ordered = [row for row in ordered if (row["ingest_seq"], row["id"]) > (seq, span_id)]
+    page = ordered[: query.limit] if query.limit else ordered
+    next_cursor = None
+    if query.limit and len(page) == query.limit:
+        next_cursor = _encode_cursor(_SPAN_ORDER_KEY, [page[-1]["ingest_seq"], page[-1]["id"]])
+    return page, next_cursor
+
+
+def aggregate_rows(
+    rows: Iterable[dict[str, Any]], query: AggregateQuery, workflows: dict[str, str | None], default_tz
+) -> list[AggregateRow]:
+    """Same groups and measures as SQLiteTracer.aggregate. / SQLiteTracer.aggregateと同じ集計。"""
+
+    dimensions, measures = _aggregate_names(query)
+    spans = query.spans or SpanQuery()
+    groups: dict[tuple[Any, ...], list[dict[str, Any]]] = {}
+    for row in rows:
+        if not span_matches(row, spans, default_tz):
+            continue
+        if query.workflow_name is not None and workflows.get(row["trace_id"]) != query.workflow_name:
+            continue
+        key = tuple(_dimension(row, name, workflows) for name in dimensions)
+        groups.setdefault(key, []).append(row)
+    if not groups and not dimensions:
+        groups[()] = []
+    result = [
+        AggregateRow(dict(zip(dimensions, key)), {name: _measure(members, name) for name in measures})
+        for key, members in groups.items()
+    ]
+    return order_aggregate(result, query)
+
+
+def order_aggregate(rows: list[AggregateRow], query: AggregateQuery) -> list[AggregateRow]:
+    """Order and limit aggregate rows like SQLiteTracer. / SQLiteTracerと同じ並びと件数制限。"""
+
+    dimensions, measures = _aggregate_names(query)
+    ordered = sorted(rows, key=lambda item: tuple(_sort_key(item.group[name], "") for name in dimensions))
+    if query.order_by:
+        name, descending = _aggregate_order(query.order_by, dimensions, measures)
+        source = "group" if name in dimensions else "values"
+        ordered.sort(key=lambda item: _sort_key(getattr(item, source)[name], ""), reverse=descending)
+    return ordered[: query.limit] if query.limit else ordered
+
+
+def _dimension(row: dict[str, Any], name: str, workflows: dict[str, str | None]) -> Any:
+    if name == "rubric_bucket":
+        return _rubric_bucket(_json_or_none(row["rubric_json"]))
+    if name == "workflow_name":
+        return workflows.get(row["trace_id"])
+    if name in ("day", "hour"):
+        if row["started_at_us"] is None:
+            return None
+        started = datetime.fromtimestamp(row["started_at_us"] // 1_000_000, timezone.utc)
+        return started.strftime("%Y-%m-%d" if name == "day" else "%Y-%m-%dT%H")
+    return row[name]
+
+
+def _measure(rows: list[dict[str, Any]], name: str) -> Any:
+    if name == "count":
+        return len(rows)
+    if name in ("error_count", "error_rate"):
+        errors = sum(int(bool(row["has_error"])) for row in rows)
+        if name == "error_count":
+            return errors if rows else None
+        return errors / len(rows) if rows else None
+    if name in _USAGE_TOKEN_KEYS:
+        return sum(_usage_tokens(row["usage"])[name] for row in rows)
+    if name == "rubric_score_avg":
+        scores = [row["rubric_score"] for row in rows if row["rubric_score"] is not None]
+        return sum(scores) / len(scores) if scores else None
+    durations = [row["duration_ms"] for row in rows if row["duration_ms"] is not None]
+    if name == "duration_avg":
+        return sum(durations) / len(durations) if durations else None
+    return _percentile(durations, float(name.rsplit("_p", 1)[1]))
+
+
+def _span_field(row: dict[str, Any], name: str) -> Any:
+    if name in _USAGE_TOKEN_KEYS:
+        value = row["usage"].get(name) if isinstance(row["usage"], dict) else None
+        return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+    return _row_field(row, name)
+
+
+def _row_field(row: dict[str, Any], name: str) -> Any:
+    value = row[name]
+    # SQLite stores booleans as 0/1. / SQLiteの真偽値は0/1。
+    return int(value) if isinstance(value, bool) else value
+
+
+def _sort_key(value: Any, row_id: str) -> tuple[Any, ...]:
+    # SQLite sorts NULL first. / SQLiteではNULLが先頭。
+    return (value is not None, value, row_id)
+
+
+def _keyword_in_span(row: dict[str, Any], keyword: str) -> bool:
+    needle = keyword.lower()
+    return any(needle in (row[column] or "").lower() for column in ("input", "output", "tool_calls_json"))
+
+
+def _in_us_range(value: int | None, started_from: datetime | None, started_to: datetime | None, default_tz) -> bool:
+    # Spans compare epoch microseconds like the SQL filter. / SpanはSQLと同様にエポックマイクロ秒で比較する。
+    lower = _normalize_query_dt(started_from, default_tz)
+    upper = _normalize_query_dt(started_to, default_tz)
+    if lower is None and upper is None:
+        return True
+    if value is None:
+        return False
+    if lower is not None and value < _epoch_us(lower):
+        return False
+    return upper is None or value <= _epoch_us(upper)
+
+
+def _metadata_matches(metadata_json: str | None, metadata: dict[str, Any]) -> bool:
+    stored = _json_or_none(metadata_json)
+    stored = stored if isinstance(stored, dict) else {}
+    for key, value in metadata.items():
+        if value is not None and not isinstance(value, (bool, int, float, str)):
+            raise NotSupportedError("metadata query (non-scalar)")
+        actual = stored.get(key)
+        if isinstance(actual, (dict, list)):
+            actual = json.dumps(actual, separators=(",", ":"))
+        if actual != value or isinstance(actual, str) != isinstance(value, str):
+            return False
+    return True
@@ -0,0 +1,440 @@
+from __future__ import annotations
+
+import gzip
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Iterator
+
+from ..errors import NotSupportedError
+from .filtering import aggregate_rows, page_spans, page_traces, span_matches, trace_matches, trace_row
+from .processor_interface import TracingProcessor
+from .processors import (
+    _TRACE_PREDICATE_FIELDS,
+    _TraceLike,
+    _row_to_span_record,
+    _row_to_trace_record,
+    _span_columns,
+    _span_predicate_fields,
+    _trace_export_values,
+)
+from .search import (
+    AggregateQuery,
+    AggregateRow,
+    SearchPage,
+    SpanQuery,
+    SpanRecord,
+    TraceQuery,
+    TraceRecord,
+    TraceSearchCapabilities,
+)
+
+# Segment files: <prefix>-<seq>.jsonl (active or rotated), .jsonl.gz (compressed), .idx (sidecar index).
+# / セグメント: <prefix>-<seq>.jsonl（書き込み中/ローテーション済み）、.jsonl.gz（圧縮済み）、.idx（索引）。
+_SEGMENT_RE = re.compile(r"^(?P<prefix>.+)-(?P<seq>\d{8})\.jsonl(?P<gz>\.gz)?$")
+# ingest_seq = segment seq << 32 | line offset; segments stay below 4 GiB. / セグメントは4GiB未満。
+_OFFSET_BITS = 32
+
+
+class JSONLTracer(TracingProcessor):
+    """Append-only JSONL trace sink with rotation. / ローテーション付きの追記専用JSONLトレーサー。
+
+    Each trace/span export is one line. Writes are buffered and fsynced every ``fsync_interval``, by a
+    background thread when no further write arrives; segments rotate by size or age, get a sidecar
+    ``trace_id -> offsets`` index and are optionally gzipped. Read them with :class:`JSONLTraceReader`.
+    / Trace/Spanのexportを1行ずつ書く。書き込みはバッファし、fsyncは ``fsync_interval`` ごとにまとめる
+    （後続の書き込みが無ければ裏のスレッドが行う）。セグメントはサイズか経過時間でローテーションし、
+    ``trace_id -> オフセット`` の索引を横に置き、必要ならgzip圧縮する。読み出しは :class:`JSONLTraceReader`。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        prefix: str = "traces",
+        max_bytes: int = 64 * 1024 * 1024,
+        max_age: timedelta = timedelta(hours=1),
+        buffer_size: int = 1024 * 1024,
+        fsync_interval: timedelta = timedelta(seconds=1),
+        compress: bool = False,
+    ) -> None:
+        if max_bytes >= 1 << _OFFSET_BITS:
+            raise NotSupportedError(f"max_bytes={max_bytes} (segments must stay below 4 GiB)")
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._prefix = prefix
+        self._max_bytes = max_bytes
+        self._max_age = max_age.total_seconds()
+        self._buffer_size = buffer_size
+        self._fsync_interval = fsync_interval.total_seconds()
+        self._compress = compress
+        self._lock = threading.Lock()
+        self._file = None
+        self._path: Path | None = None
+        self._size = 0
+        self._opened_at = 0.0
+        self._synced_at = 0.0
+        self._dirty = False
+        self._flusher: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._index: dict[str, list[int]] = {}
+        self._next_seq = max((seq for seq, _ in _segment_files(self._directory, prefix)), default=0) + 1
+        self._compressor: ThreadPoolExecutor | None = None
+
+    def on_trace_start(self, trace) -> None:
+        exported = getattr(trace, "export", lambda: None)()
+        if exported:
+            self._append(exported, exported.get("id") or getattr(trace, "trace_id", None))
+
+    def on_trace_end(self, trace) -> None:
+        self.on_trace_start(trace)
+
+    def on_span_start(self, span) -> None:
+        return
+
+    def on_span_end(self, span) -> None:
+        exported = getattr(span, "export", lambda: None)()
+        if exported:
+            self._append(exported, exported.get("trace_id") or getattr(span, "trace_id", None))
+
+    def _append(self, exported: dict[str, Any], trace_id: str | None) -> None:
+        if trace_id is None:
+            return
+        # Serialize outside the lock. / 直列化はロック外で行う。
+        line = json.dumps(exported, ensure_ascii=False, default=str, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._lock:
+            now = time.monotonic()
+            if self._file is not None and (self._size >= self._max_bytes or now - self._opened_at >= self._max_age):
+                self._rotate()
+            if self._file is None:
+                self._open_segment(now)
+            self._index.setdefault(trace_id, []).append(self._size)
+            self._file.write(line)
+            self._size += len(line)
+            self._dirty = True
+            if now - self._synced_at >= self._fsync_interval:
+                self._sync(now)
+            elif self._flusher is None:
+                self._start_flusher()
+
+    def _open_segment(self, now: float) -> None:
+        self._path = self._directory / f"{self._prefix}-{self._next_seq:08d}.jsonl"
+        self._next_seq += 1
+        self._file = open(self._path, "ab", buffering=self._buffer_size)
+        self._size = self._file.tell()
+        self._opened_at = now
+        self._synced_at = now
+        self._index = {}
+
+    def _sync(self, now: float) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced_at = now
+        self._dirty = False
+
+    def _start_flusher(self) -> None:
+        # Syncs the tail when traffic pauses, so readers and crashes never wait on the next write.
+        # / 書き込みが途切れても末尾を書き出し、読み手やクラッシュ時に次の書き込みを待たない。
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name="kantan-llm-jsonl-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self._fsync_interval):
+            with self._lock:
+                if self._file is not None and self._dirty:
+                    self._sync(time.monotonic())
+
+    def _rotate(self) -> None:
+        self._sync(time.monotonic())
+        self._file.close()
+        path, self._file, self._path = self._path, None, None
+        _write_atomic(_index_path(path), json.dumps({"size": self._size, "traces": self._index}).encode("utf-8"))
+        self._index = {}
+        if self._compress:
+            if self._compressor is None:
+                self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kantan-llm-jsonl-gzip")
+            self._compressor.submit(_gzip_segment, path)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._rotate()
+            compressor, self._compressor = self._compressor, None
+            flusher, self._flusher = self._flusher, None
+            self._stop.set()
+        if flusher is not None:
+            flusher.join()
+        if compressor is not None:
+            compressor.shutdown(wait=True)
+
+    def force_flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync(time.monotonic())
+
+
+class JSONLTraceReader:
+    """TraceSearchService over JSONLTracer segments. / JSONLTracerのセグメントを検索するTraceSearchService。
+
+    Segments are memory-mapped and scanned; trace_id lookups read only the lines listed in the sidecar index
+    (built on the fly for the active segment), seeking through gzipped segments instead of inflating them.
+    / セグメントはmmapして走査する。trace_id指定の検索は索引（書き込み中のセグメントはその場で作成）に
+    ある行だけを読み、gzip済みセグメントは全体を展開せずseekで読む。
+    """
+
+    def __init__(self, directory: str, *, prefix: str = "traces") -> None:
+        self._directory = Path(directory)
+        self._prefix = prefix
+        self.default_tz = datetime.now().astimezone().tzinfo or timezone.utc
+        self._lock = threading.RLock()
+        self._segments: dict[Path, _Segment] = {}
+
+    def capabilities(self) -> TraceSearchCapabilities:
+        return TraceSearchCapabilities(
+            supports_keywords=True,
+            supports_has_tool_call=True,
+            supports_metadata_query=True,
+            supports_limit=True,
+            supports_since=True,
+            supports_full_text=False,
+            supports_cursor=True,
+            supports_rubric_score=True,
+            supports_trace_ids=True,
+            supports_aggregate=True,
+            span_predicate_fields=tuple(_span_predicate_fields(json1=True)),
+            trace_predicate_fields=tuple(_TRACE_PREDICATE_FIELDS),
+        )
+
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        traces, spans = self._load([query.trace_id] if query.trace_id is not None else None)
+        by_trace: dict[str, list[dict[str, Any]]] = {trace_id: [] for trace_id in traces}
+        for span in spans.values():
+            by_trace.setdefault(span["trace_id"], []).append(span)
+        rows = []
+        for trace_id, trace_spans in by_trace.items():
+            row = trace_row(traces[trace_id], trace_spans)
+            if trace_matches(row, trace_spans, query, self.default_tz):
+                rows.append(row)
+        page, next_cursor = page_traces(rows, query)
+        return SearchPage([_row_to_trace_record(row, query, self.default_tz) for row in page], next_cursor)
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        _, spans = self._load([query.trace_id] if query.trace_id is not None else query.trace_ids)
+        rows = [row for row in spans.values() if span_matches(row, query, self.default_tz)]
+        page, next_cursor = page_spans(rows, query)
+        return SearchPage([_row_to_span_record(row, query, self.default_tz) for row in page], next_cursor)
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]:
+        yield from self.search_traces(query=query)
+
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        yield from self.search_spans(query=query)
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        yield from self.search_spans(query=SpanQuery(trace_id=trace_id))
+
+    def get_trace(self, trace_id: str) -> TraceRecord | None:
+        records = self.search_traces(query=TraceQuery(trace_id=trace_id))
+        return records[0] if records else None
+
+    def get_span(self, span_id: str) -> SpanRecord | None:
+        records = self.search_spans(query=SpanQuery(span_id=span_id))
+        return records[0] if records else None
+
+    def get_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return list(self.iter_spans_by_trace(trace_id))
+
+    def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        return [span for span in self.get_spans_by_trace(trace_id) if span.ingest_seq > (since_seq or 0)]
+
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        traces, spans = self._load(None)
+        workflows = {trace_id: values[1] for trace_id, values in traces.items()}
+        return aggregate_rows(spans.values(), query, workflows, self.default_tz)
+
+    def data_version(self) -> tuple[tuple[str, int, int], ...]:
+        """Segment names, sizes and mtimes; appends and rotation change it. / 追記・ローテーションで変わる値。"""
+
+        version = []
+        for _, path in _segment_files(self._directory, self._prefix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            version.append((path.name, stat.st_size, stat.st_mtime_ns))
+        return tuple(version)
+
+    def close(self) -> None:
+        with self._lock:
+            self._segments.clear()
+
+    def _load(self, trace_ids: list[str] | None) -> tuple[dict[str, tuple[Any, ...]], dict[str, dict[str, Any]]]:
+        # Later span lines replace earlier ones (re-ingest); the first trace line wins like INSERT OR IGNORE.
+        # / 後のSpan行が前の行を置き換え（再取り込み）、Trace行はINSERT OR IGNOREと同様に最初の行を使う。
+        traces: dict[str, tuple[Any, ...]] = {}
+        spans: dict[str, dict[str, Any]] = {}
+        for segment in self._current_segments():
+            for offset, line in segment.lines(trace_ids):
+                exported = json.loads(line)
+                if exported.get("object") == "trace":
+                    values = _trace_export_values(exported)
+                    traces.setdefault(values[0], values)
+                    continue
+                row = _span_columns(exported)
+                if row is None:
+                    continue
+                row["ingest_seq"] = segment.seq << _OFFSET_BITS | offset
+                spans.pop(row["id"], None)
+                spans[row["id"]] = row
+                traces.setdefault(row["trace_id"], _trace_export_values(_TraceLike(row["trace_id"]).export()))
+        return traces, spans
+
+    def _current_segments(self) -> list[_Segment]:
+        with self._lock:
+            current: dict[Path, _Segment] = {}
+            for seq, path in _segment_files(self._directory, self._prefix):
+                segment = self._segments.get(path) or _Segment(path, seq)
+                current[path] = segment
+            # Forget segments deleted or replaced by their .gz. / 削除・圧縮済みのセグメントは破棄する。
+            self._segments = current
+            return list(current.values())
+
+
+class _Segment:
+    def __init__(self, path: Path, seq: int) -> None:
+        self.path = path
+        self.seq = seq
+        self._compressed = path.name.endswith(".gz")
+        self._lock = threading.Lock()
+        self._mapped: Any = None
+        self._mtime = 0
+        self._index: dict[str, list[int]] = {}
+        self._indexed = 0
+
+    def lines(self, trace_ids: list[str] | None) -> Iterator[tuple[int, bytes]]:
+        if trace_ids is not None and self._compressed and self._has_sidecar():
+            offsets = sorted({offset for trace_id in trace_ids for offset in self._sidecar_offsets(trace_id)})
+            if not offsets:
+                return
+            # Seeking forward inflates only up to the last wanted line. / 前方へのseekは必要な行までしか展開しない。
+            with gzip.open(self.path, "rb") as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    yield offset, f.readline().rstrip(b"\n")
+            return
+        buffer = self.buffer()
+        if trace_ids is None:
+            yield from _lines(buffer, 0)
+            return
+        offsets = sorted({offset for trace_id in trace_ids for offset in self.offsets(buffer, trace_id)})
+        for offset in offsets:
+            yield offset, _line_at(buffer, offset)
+
+    def buffer(self) -> Any:
+        if self._compressed:
+            with self._lock:
+                # Rotated segments never change; inflate once per file version. / ローテーション済みは不変なので1回だけ展開する。
+                mtime = self.path.stat().st_mtime_ns
+                if self._mapped is None or self._mtime != mtime:
+                    self._mapped = gzip.decompress(self.path.read_bytes())
+                    self._mtime = mtime
+                return self._mapped
+        with self._lock:
+            size = self.path.stat().st_size
+            if self._mapped is None or len(self._mapped) != size:
+                # Remap as the active segment grows; readers holding the old map keep it alive.
+                # / 書き込み中のセグメントは伸びたら再マップする（古いマップは参照中は有効）。
+                self._mapped = _map(self.path, size)
+            return self._mapped
+
+    def offsets(self, buffer: Any, trace_id: str) -> list[int]:
+        with self._lock:
+            if self._indexed == 0:
+                self._load_sidecar()
+            if self._indexed < len(buffer):
+                for offset, line in _lines(buffer, self._indexed):
+                    exported = json.loads(line)
+                    key = exported.get("id") if exported.get("object") == "trace" else exported.get("trace_id")
+                    self._index.setdefault(key, []).append(offset)
+                    self._indexed = offset + len(line) + 1
+            return list(self._index.get(trace_id, ()))
+
+    def _has_sidecar(self) -> bool:
+        with self._lock:
+            if self._indexed == 0:
+                self._load_sidecar()
+            return self._indexed > 0
+
+    def _sidecar_offsets(self, trace_id: str) -> list[int]:
+        with self._lock:
+            return list(self._index.get(trace_id, ()))
+
+    def _load_sidecar(self) -> None:
+        try:
+            sidecar = json.loads(_index_path(self.path).read_bytes())
+        except (OSError, ValueError):
+            return
+        self._index = {key: list(offsets) for key, offsets in sidecar["traces"].items()}
+        self._indexed = sidecar["size"]
+
+
+def _segment_files(directory: Path, prefix: str) -> list[tuple[int, Path]]:
+    found: dict[int, Path] = {}
+    for path in directory.glob(f"{prefix}-*.jsonl*"):
+        match = _SEGMENT_RE.match(path.name)
+        if match is None or match["prefix"] != prefix:
+            continue
+        seq = int(match["seq"])
+        # The plain file wins while its .gz is being written. / .gz作成中は元ファイルを使う。
+        if seq not in found or not match["gz"]:
+            found[seq] = path
+    return sorted(found.items())
+
+
+def _index_path(path: Path) -> Path:
+    return path.with_name(path.name.split(".jsonl", 1)[0] + ".idx")
+
+
+def _map(path: Path, size: int) -> Any:
+    if size == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+def _lines(buffer: Any, start: int) -> Iterator[tuple[int, bytes]]:
+    # Complete lines only; a buffered write may end mid-line. / 完結した行のみ（バッファ書き込みは行の途中で切れ得る）。
+    pos = start
+    while True:
+        end = buffer.find(b"\n", pos)
+        if end < 0:
+            return
+        yield pos, buffer[pos:end]
+        pos = end + 1
+
+
+def _line_at(buffer: Any, offset: int) -> bytes:
+    return buffer[offset : buffer.find(b"\n", offset)]
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _gzip_segment(path: Path) -> None:
+    target = path.with_name(path.name + ".gz")
+    tmp = target.with_name(target.name + ".tmp")
+    with open(path, "rb") as src, gzip.open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, target)
+    os.remove(path)
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+from .filtering import aggregate_rows, page_spans, page_traces, span_matches, trace_matches, trace_row
+from .processor_interface import TracingProcessor
+from .processors import (
+    _TRACE_PREDICATE_FIELDS,
+    _TraceLike,
+    _row_to_span_record,
+    _row_to_trace_record,
+    _span_columns,
+    _span_predicate_fields,
+    _trace_export_values,
+    _trace_values,
+)
+from .search import (
+    AggregateQuery,
+    AggregateRow,
+    SearchPage,
+    SpanQuery,
+    SpanRecord,
+    TraceQuery,
+    TraceRecord,
+    TraceSearchCapabilities,
+)
+
+
+class MemoryTracer(TracingProcessor):
+    """In-memory ring buffer of finished spans. / 終了したSpanを保持するメモリ上のリングバッファ。
+
+    Keeps the latest ``capacity`` spans with a trace_id index; ingest is O(1) and memory is bounded.
+    Searches follow SQLiteTracer semantics (except full-text relevance). / 最新 ``capacity`` 件のSpanを
+    trace_id索引付きで保持する。記録はO(1)、メモリは上限付き。検索の意味はSQLiteTracerと同じ
+    （全文検索の関連度順を除く）。
+    """
+
+    def __init__(self, capacity: int = 10000) -> None:
+        self._capacity = capacity
+        self.default_tz = datetime.now().astimezone().tzinfo or timezone.utc
+        self._lock = threading.Lock()
+        self._spans: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._by_trace: dict[str, dict[str, dict[str, Any]]] = {}
+        self._traces: OrderedDict[str, tuple[Any, ...]] = OrderedDict()
+        self._version = 0
+
+    def on_trace_start(self, trace) -> None:
+        values = _trace_values(trace)
+        if values is None:
+            return
+        with self._lock:
+            # First write wins, like INSERT OR IGNORE. / INSERT OR IGNOREと同様に最初の値を使う。
+            if values[0] not in self._traces:
+                self._traces[values[0]] = values
+                self._evict()
+                self._version += 1
+
+    def on_trace_end(self, trace) -> None:
+        self.on_trace_start(trace)
+
+    def on_span_start(self, span) -> None:
+        return
+
+    def on_span_end(self, span) -> None:
+        exported = getattr(span, "export", lambda: None)()
+        if not exported:
+            return
+        row = _span_columns(exported, getattr(span, "span_id", None), getattr(span, "trace_id", None))
+        if row is None:
+            return
+        trace_id = row["trace_id"]
+        values = _trace_values(getattr(span, "_trace", None) or _TraceLike(trace_id=trace_id))
+        with self._lock:
+            # Per-trace sequence like SQLiteTracer (MAX + 1 within the trace). / SQLiteTracerと同じくTrace内で連番。
+            previous = self._by_trace.get(trace_id)
+            row["ingest_seq"] = next(reversed(previous.values()))["ingest_seq"] + 1 if previous else 1
+            # Re-ingest replaces the span and moves it to the newest slot. / 再取り込みは置き換えて最新位置へ移す。
+            self._remove(row["id"], keep_trace=True)
+            self._spans[row["id"]] = row
+            self._by_trace.setdefault(trace_id, {})[row["id"]] = row
+            if trace_id not in self._traces:
+                self._traces[trace_id] = values
+            self._evict()
+            self._version += 1
+
+    def _remove(self, span_id: str, keep_trace: bool = False) -> None:
+        row = self._spans.pop(span_id, None)
+        if row is None:
+            return
+        spans = self._by_trace.get(row["trace_id"])
+        if spans is not None:
+            spans.pop(span_id, None)
+            if not spans:
+                del self._by_trace[row["trace_id"]]
+                if not keep_trace:
+                    self._traces.pop(row["trace_id"], None)
+
+    def _evict(self) -> None:
+        while len(self._spans) > self._capacity:
+            self._remove(next(iter(self._spans)))
+        while len(self._traces) > self._capacity:
+            # Only traces with no spans left go; the others stay searchable like in SQLiteTracer.
+            # / Spanが残っていないTraceだけ捨てる（SQLiteTracerと同じく検索できる状態を保つ）。
+            trace_id = next(iter(self._traces))
+            if trace_id in self._by_trace:
+                self._traces.move_to_end(trace_id)
+            else:
+                del self._traces[trace_id]
+
+    def data_version(self) -> int:
+        """Bumped on every change. / 変更のたびに増える値。"""
+
+        with self._lock:
+            return self._version
+
+    def capabilities(self) -> TraceSearchCapabilities:
+        return TraceSearchCapabilities(
+            supports_keywords=True,
+            supports_has_tool_call=True,
+            supports_metadata_query=True,
+            supports_limit=True,
+            supports_since=True,
+            supports_full_text=False,
+            supports_cursor=True,
+            supports_rubric_score=True,
+            supports_trace_ids=True,
+            supports_aggregate=True,
+            span_predicate_fields=tuple(_span_predicate_fields(json1=True)),
+            trace_predicate_fields=tuple(_TRACE_PREDICATE_FIELDS),
+        )
+
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        with self._lock:
+            if query.trace_id is not None:
+                trace_ids = [query.trace_id] if query.trace_id in self._traces or query.trace_id in self._by_trace else []
+            else:
+                trace_ids = list(self._traces.keys() | self._by_trace.keys())
+            snapshot = [
+                (
+                    self._traces.get(trace_id) or _trace_export_values(_TraceLike(trace_id).export()),
+                    list(self._by_trace.get(trace_id, {}).values()),
+                )
+                for trace_id in trace_ids
+            ]
+        rows = []
+        for values, spans in snapshot:
+            row = trace_row(values, spans)
+            if trace_matches(row, spans, query, self.default_tz):
+                rows.append(row)
+        page, next_cursor = page_traces(rows, query)
+        return SearchPage([_row_to_trace_record(row, query, self.default_tz) for row in page], next_cursor)
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        with self._lock:
+            if query.trace_id is not None or query.trace_ids is not None:
+                trace_ids = [query.trace_id] if query.trace_id is not None else query.trace_ids
+                candidates = [row for trace_id in trace_ids for row in self._by_trace.get(trace_id, {}).values()]
+            else:
+                candidates = list(self._spans.values())
+        rows = [row for row in candidates if span_matches(row, query, self.default_tz)]
+        page, next_cursor = page_spans(rows, query)
+        return SearchPage([_row_to_span_record(row, query, self.default_tz) for row in page], next_cursor)
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]:
+        yield from self.search_traces(query=query)
+
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        yield from self.search_spans(query=query)
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        yield from self.search_spans(query=SpanQuery(trace_id=trace_id))
+
+    def get_trace(self, trace_id: str) -> TraceRecord | None:
+        records = self.search_traces(query=TraceQuery(trace_id=trace_id))
+        return records[0] if records else None
+
+    def get_span(self, span_id: str) -> SpanRecord | None:
+        with self._lock:
+            row = self._spans.get(span_id)
+        return _row_to_span_record(row, None, self.default_tz) if row is not None else None
+
+    def get_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return list(self.iter_spans_by_trace(trace_id))
+
+    def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        with self._lock:
+            rows = [row for row in self._by_trace.get(trace_id, {}).values() if row["ingest_seq"] > (since_seq or 0)]
+        return [_row_to_span_record(row, None, self.default_tz) for row in rows]
+
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        with self._lock:
+            rows = list(self._spans.values())
+            workflows = {trace_id: values[1] for trace_id, values in self._traces.items()}
+        return aggregate_rows(rows, query, workflows, self.default_tz)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+            self._by_trace.clear()
+            self._traces.clear()
+            self._version += 1
+
+    def shutdown(self) -> None:
+        return
+
+    def force_flush(self) -> None:
+        return
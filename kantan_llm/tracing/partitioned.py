@@ -0,0 +1,547 @@
+from __future__ import annotations
+
+import functools
+import heapq
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Iterator, TypeVar
+
+from ..errors import NotSupportedError
+from .processor_interface import TracingProcessor
+from .filtering import aggregate_rows, order_aggregate
+from .processors import (
+    _USAGE_TOKEN_KEYS,
+    _USAGE_VALUES,
+    SQLiteTracer,
+    _aggregate_names,
+    _decode_cursor,
+    _encode_cursor,
+    _normalize_query_dt,
+    _parse_dt,
+    _row_to_trace_record,
+    _trace_order,
+)
+from .search import (
+    AggregateQuery,
+    AggregateRow,
+    SearchPage,
+    SpanQuery,
+    SpanRecord,
+    TraceQuery,
+    TraceRecord,
+    TraceSearchCapabilities,
+    UsageQuery,
+    UsageRow,
+)
+
+_T = TypeVar("_T")
+
+# Partition file name formats (UTC); lexical order is time order. / パーティションのファイル名（UTC、辞書順=時刻順）。
+_GRANULARITIES = {
+    "day": ("%Y-%m-%d", timedelta(days=1)),
+    "hour": ("%Y-%m-%dT%H", timedelta(hours=1)),
+}
+_PREFIX = "traces-"
+_SUFFIX = ".sqlite3"
+_SPAN_CURSOR_KEY = "partitions:spans"
+_SPAN_ORDER_KEY = "spans:ingest_seq:ASC"
+# Measures that can be summed across partitions. / パーティション横断で合算できる指標。
+_ADDITIVE_MEASURES = {"count", "error_count", *_USAGE_TOKEN_KEYS}
+# Trace -> partition routes kept in memory. / メモリに保持するTrace→パーティションの対応数。
+_MAX_ROUTES = 65536
+
+
+class PartitionedSQLiteTracer(TracingProcessor):
+    """SQLiteTracer split into per-day/per-hour files. / 日・時間単位のSQLiteファイルに分けたSQLiteTracer。
+
+    A trace and all of its spans go to the partition of the trace start (UTC). Searches skip partitions
+    outside ``started_from`` / ``started_to`` and query the rest in parallel. Old partitions are dropped
+    by deleting their files. / Traceとその全Spanは開始時刻（UTC）のパーティションへ保存する。検索は
+    ``started_from`` / ``started_to`` の範囲外を除外し、残りを並列に問い合わせる。古いパーティションは
+    ファイル削除で破棄する。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        granularity: str = "day",
+        max_partitions: int | None = None,
+        max_workers: int = 4,
+        **tracer_options: Any,
+    ) -> None:
+        if granularity not in _GRANULARITIES:
+            raise NotSupportedError(f"granularity={granularity}")
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._format, self._width = _GRANULARITIES[granularity]
+        self._max_partitions = max_partitions
+        self._max_workers = max_workers
+        self._tracer_options = tracer_options
+        self.default_tz = datetime.now().astimezone().tzinfo or timezone.utc
+        self._lock = threading.RLock()
+        self._tracers: dict[str, SQLiteTracer] = {}
+        # Active queries per partition; a dropped partition is removed when its last query ends.
+        # / パーティションごとの実行中クエリ数。破棄したパーティションは最後のクエリ終了時に削除する。
+        self._leases: dict[str, int] = {}
+        self._retiring: dict[str, SQLiteTracer] = {}
+        # Dropped keys, so late queries do not recreate their files. / 破棄済みキー（遅れた検索でファイルを再作成しない）。
+        self._dropped: set[str] = set()
+        self._keys = sorted(
+            key for key in (self._key_from_name(p.name) for p in self._directory.glob(f"{_PREFIX}*{_SUFFIX}")) if key
+        )
+        self._routes: OrderedDict[str, str] = OrderedDict()
+        # (max trace started_at, max trace ended_at) per partition; cleared on write. / パーティションごとの最大時刻。
+        self._bounds: dict[str, tuple[datetime | None, datetime | None]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+
+    def partitions(self) -> list[str]:
+        """Partition keys, oldest first. / パーティションキー（古い順）。"""
+
+        with self._lock:
+            return list(self._keys)
+
+    def partition_path(self, key: str) -> Path:
+        return self._directory / f"{_PREFIX}{key}{_SUFFIX}"
+
+    def drop_partitions(self, before: datetime) -> list[str]:
+        """Delete partitions that end at or before ``before``. / ``before`` 以前に終わるパーティションを削除する。"""
+
+        cutoff = _normalize_query_dt(before, self.default_tz)
+        with self._lock:
+            keys = [key for key in self._keys if self._window(key)[1] <= cutoff]
+        for key in keys:
+            self._drop(key)
+        return keys
+
+    # ---- ingest / 記録 ----
+
+    def on_trace_start(self, trace) -> None:
+        key = self._key_for(datetime.now(timezone.utc))
+        trace_id = getattr(trace, "trace_id", None)
+        if trace_id is not None:
+            self._route(trace_id, key)
+        self._writer(key).on_trace_start(trace)
+
+    def on_trace_end(self, trace) -> None:
+        trace_id = getattr(trace, "trace_id", None)
+        key = self._routed(trace_id) or self._key_for(datetime.now(timezone.utc))
+        self._writer(key).on_trace_end(trace)
+
+    def on_span_start(self, span) -> None:
+        return
+
+    def on_span_end(self, span) -> None:
+        trace_id = getattr(span, "trace_id", None)
+        started_at = getattr(span, "started_at", None)
+        if trace_id is None:
+            exported = getattr(span, "export", lambda: None)() or {}
+            trace_id = exported.get("trace_id")
+            started_at = exported.get("started_at")
+        key = self._routed(trace_id)
+        if key is None:
+            key = self._key_for(_parse_dt(started_at) or datetime.now(timezone.utc))
+            if trace_id is not None:
+                self._route(trace_id, key)
+        self._writer(key).on_span_end(span)
+
+    # ---- search / 検索 ----
+
+    def data_version(self) -> tuple[Any, ...]:
+        """Partition keys and each partition's data_version. / パーティション一覧と各data_version。"""
+
+        keys = self.partitions()
+        return tuple((key, self._call(key, lambda tracer: tracer.data_version())) for key in keys)
+
+    def capabilities(self) -> TraceSearchCapabilities:
+        with self._lock:
+            key = self._keys[-1] if self._keys else None
+        # The newest partition answers; a probe never creates one. / 最新のパーティションで判定し、問い合わせで新規作成はしない。
+        capabilities = self._call(key, lambda tracer: tracer.capabilities()) if key is not None else None
+        if capabilities is None:
+            # Same SQLite library, so an in-memory tracer reports the same flags. / 同じSQLiteなのでインメモリで同じ判定になる。
+            probe = SQLiteTracer(":memory:")
+            try:
+                capabilities = probe.capabilities()
+            finally:
+                probe.shutdown()
+        # Cursors stay valid across partitions; relevance ranks and watch cursors (ingest_id) do not.
+        # / カーソルは横断で有効、bm25順位とwatchのカーソル（ingest_id）は比較できない。
+        return replace(capabilities, supports_cursor=True, supports_watch=False)
+
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        """Aggregate per partition; only additive measures merge across partitions.
+        / パーティションごとに集計する。横断で合算できるのは加算的な指標のみ。
+        """
+
+        spans = query.spans or SpanQuery()
+        keys = self._prune(spans.started_from, spans.started_to)
+        if not keys:
+            return aggregate_rows([], query, {}, self.default_tz)
+        if len(keys) == 1:
+            return self._call(keys[0], lambda tracer: tracer.aggregate(query=query), [])
+        _, measures = _aggregate_names(query)
+        for name in measures:
+            if name not in _ADDITIVE_MEASURES:
+                raise NotSupportedError(f"measure={name} across partitions")
+        partial = replace(query, order_by=None, limit=None)
+        merged: dict[tuple[Any, ...], AggregateRow] = {}
+        for rows in self._map(lambda tracer: tracer.aggregate(query=partial), keys, []):
+            for row in rows:
+                key = tuple(row.group.values())
+                if key not in merged:
+                    merged[key] = AggregateRow(dict(row.group), dict.fromkeys(measures, None))
+                values = merged[key].values
+                for name in measures:
+                    if row.values[name] is not None:
+                        values[name] = (values[name] or 0) + row.values[name]
+        return order_aggregate(list(merged.values()), query)
+
+    def usage_rollups(self, *, query: UsageQuery) -> list[UsageRow]:
+        """Sum each partition's usage rollups (dropped partitions take theirs along).
+        / 各パーティションのusage rollupを合算する（破棄したパーティションの分は消える）。
+        """
+
+        keys = self._prune(query.started_from, query.started_to)
+        merged: dict[tuple[Any, ...], UsageRow] = {}
+        for rows in self._map(lambda tracer: tracer.usage_rollups(query=query), keys, []):
+            for row in rows:
+                key = tuple(row.group.values())
+                if key not in merged:
+                    merged[key] = UsageRow(dict(row.group))
+                for name in _USAGE_VALUES:
+                    setattr(merged[key], name, getattr(merged[key], name) + getattr(row, name))
+        # NULL groups first, like SQLite's ORDER BY. / SQLiteのORDER BYと同じくNULLを先頭に。
+        order = sorted(merged, key=lambda key: tuple((value is not None, value or "") for value in key))
+        return [merged[key] for key in order]
+
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        keys = self._trace_partitions(query)
+        if not keys:
+            return SearchPage([])
+        if len(keys) == 1:
+            return self._call(keys[0], lambda tracer: tracer.search_traces(query=query), SearchPage([]))
+        if query.order_by == "relevance":
+            raise NotSupportedError("order_by=relevance across partitions")
+        order_column, descending = _trace_order(query.order_by)
+        results = self._map(lambda tracer: list(tracer.iter_trace_rows(query=query)), keys, [])
+        rows = list(itertools.islice(_merge_trace_rows(results, order_column, descending), query.limit))
+        next_cursor = None
+        if query.limit and len(rows) == query.limit:
+            order_key = f"traces:{order_column}:{'DESC' if descending else 'ASC'}"
+            next_cursor = _encode_cursor(order_key, [rows[-1][order_column], rows[-1]["id"]])
+        return SearchPage([_row_to_trace_record(row, query, self.default_tz) for row in rows], next_cursor)
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        plan = self._span_plan(query)
+        if len(plan) > 1 and query.order_by == "relevance":
+            raise NotSupportedError("order_by=relevance across partitions")
+        calls = [
+            functools.partial(self._call, key, lambda tracer, sub=sub: tracer.search_spans(query=sub), SearchPage([]))
+            for key, sub in plan
+        ]
+        pages = self._parallel(calls)
+        # Partition order, then ingest order within each. / パーティション順、その中は取り込み順。
+        records: list[SpanRecord] = []
+        last_key = None
+        for (key, _), page in zip(plan, pages):
+            for record in page:
+                if query.limit and len(records) == query.limit:
+                    break
+                records.append(record)
+                last_key = key
+        next_cursor = None
+        if query.limit and len(records) == query.limit and query.order_by != "relevance":
+            last = records[-1]
+            inner = _encode_cursor(_SPAN_ORDER_KEY, [last.ingest_seq, last.span_id])
+            next_cursor = _encode_cursor(_SPAN_CURSOR_KEY, [last_key, inner])
+        return SearchPage(records, next_cursor)
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]:
+        """Stream traces merged across partitions. / パーティションを横断してTraceを逐次返す。"""
+
+        keys = self._trace_partitions(query)
+        if len(keys) == 1:
+            with self._lease(keys[0]) as tracer:
+                if tracer is not None:
+                    yield from tracer.iter_traces(query=query, chunk_size=chunk_size)
+            return
+        if query.order_by == "relevance" and keys:
+            raise NotSupportedError("order_by=relevance across partitions")
+        order_column, descending = _trace_order(query.order_by)
+        with ExitStack() as stack:
+            tracers = [stack.enter_context(self._lease(key)) for key in keys]
+            streams = [tracer.iter_trace_rows(query=query, chunk_size=chunk_size) for tracer in tracers if tracer]
+            merged = _merge_trace_rows(streams, order_column, descending)
+            for row in itertools.islice(merged, query.limit):
+                yield _row_to_trace_record(row, query, self.default_tz)
+
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        """Stream spans partition by partition. / パーティション順にSpanを逐次返す。"""
+
+        plan = self._span_plan(query)
+        if len(plan) > 1 and query.order_by == "relevance":
+            raise NotSupportedError("order_by=relevance across partitions")
+        yield from itertools.islice(self._iter_plan(plan, chunk_size), query.limit)
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        key = self._locate(trace_id)
+        if key is not None:
+            with self._lease(key) as tracer:
+                if tracer is not None:
+                    yield from tracer.iter_spans_by_trace(trace_id, chunk_size)
+
+    def get_trace(self, trace_id: str) -> TraceRecord | None:
+        key = self._locate(trace_id)
+        return self._call(key, lambda tracer: tracer.get_trace(trace_id)) if key is not None else None
+
+    def get_span(self, span_id: str) -> SpanRecord | None:
+        keys = self.partitions()[::-1]
+        for record in self._map(lambda tracer: tracer.get_span(span_id), keys):
+            if record is not None:
+                return record
+        return None
+
+    def get_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return list(self.iter_spans_by_trace(trace_id))
+
+    def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        # A trace lives in one partition, so its ingest_seq is consistent. / Traceは1パーティション内なのでingest_seqは一貫する。
+        key = self._locate(trace_id)
+        if key is None:
+            return []
+        return self._call(key, lambda tracer: tracer.get_spans_since(trace_id, since_seq), [])
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            tracers = [*self._tracers.values(), *self._retiring.values()]
+            self._tracers.clear()
+            self._retiring.clear()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for tracer in tracers:
+            tracer.shutdown()
+
+    def force_flush(self) -> None:
+        with self._lock:
+            tracers = list(self._tracers.values())
+        for tracer in tracers:
+            tracer.force_flush()
+
+    # ---- partitions / パーティション ----
+
+    def _key_for(self, moment: datetime) -> str:
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.astimezone(timezone.utc).strftime(self._format)
+
+    def _key_from_name(self, name: str) -> str | None:
+        key = name[len(_PREFIX) : -len(_SUFFIX)]
+        try:
+            datetime.strptime(key, self._format)
+        except ValueError:
+            return None
+        return key
+
+    def _window(self, key: str) -> tuple[datetime, datetime]:
+        start = datetime.strptime(key, self._format).replace(tzinfo=timezone.utc)
+        return start, start + self._width
+
+    def _tracer(self, key: str) -> SQLiteTracer:
+        with self._lock:
+            tracer = self._tracers.get(key)
+            if tracer is None:
+                tracer = SQLiteTracer(str(self.partition_path(key)), **self._tracer_options)
+                self._tracers[key] = tracer
+            return tracer
+
+    def _writer(self, key: str) -> SQLiteTracer:
+        dropped: list[str] = []
+        with self._lock:
+            self._bounds.pop(key, None)
+            self._dropped.discard(key)
+            if key not in self._keys:
+                self._keys.append(key)
+                self._keys.sort()
+                if self._max_partitions is not None:
+                    dropped = self._keys[: max(0, len(self._keys) - self._max_partitions)]
+            tracer = self._tracer(key)
+        for old in dropped:
+            if old != key:
+                self._drop(old)
+        return tracer
+
+    @contextmanager
+    def _lease(self, key: str) -> Iterator[SQLiteTracer | None]:
+        """Pin a partition while it is queried (None once dropped). / 検索中はパーティションを固定する（破棄済みはNone）。"""
+
+        with self._lock:
+            tracer = self._retiring.get(key)
+            if tracer is None and key not in self._dropped:
+                tracer = self._tracer(key)
+            if tracer is not None:
+                self._leases[key] = self._leases.get(key, 0) + 1
+        if tracer is None:
+            yield None
+            return
+        try:
+            yield tracer
+        finally:
+            with self._lock:
+                self._leases[key] -= 1
+                retired = None
+                if not self._leases[key]:
+                    del self._leases[key]
+                    retired = self._retiring.pop(key, None)
+            if retired is not None:
+                # Last query on a dropped partition: finish the drop. / 破棄済みパーティションの最後のクエリで削除する。
+                self._remove(key, retired)
+
+    def _call(self, key: str, fn: Callable[[SQLiteTracer], _T], default: Any = None) -> _T:
+        with self._lease(key) as tracer:
+            return fn(tracer) if tracer is not None else default
+
+    def _iter_plan(self, plan: list[tuple[str, SpanQuery]], chunk_size: int) -> Iterator[SpanRecord]:
+        for key, sub in plan:
+            with self._lease(key) as tracer:
+                if tracer is not None:
+                    yield from tracer.iter_spans(query=sub, chunk_size=chunk_size)
+
+    def _drop(self, key: str) -> None:
+        with self._lock:
+            tracer = self._tracers.pop(key, None)
+            if key in self._keys:
+                self._keys.remove(key)
+            self._bounds.pop(key, None)
+            for trace_id in [t for t, k in self._routes.items() if k == key]:
+                del self._routes[trace_id]
+            self._dropped.add(key)
+            if tracer is not None and self._leases.get(key):
+                # Queries still iterate it; the last one removes the files. / 検索中なら最後のクエリが削除する。
+                self._retiring[key] = tracer
+                return
+        self._remove(key, tracer)
+
+    def _remove(self, key: str, tracer: SQLiteTracer | None) -> None:
+        if tracer is not None:
+            tracer.shutdown()
+        path = self.partition_path(key)
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(f"{path}{suffix}")
+            except FileNotFoundError:
+                pass
+
+    def _route(self, trace_id: str, key: str) -> None:
+        with self._lock:
+            self._routes[trace_id] = key
+            self._routes.move_to_end(trace_id)
+            while len(self._routes) > _MAX_ROUTES:
+                self._routes.popitem(last=False)
+
+    def _routed(self, trace_id: str | None) -> str | None:
+        if trace_id is None:
+            return None
+        with self._lock:
+            key = self._routes.get(trace_id)
+            return key if key in self._keys else None
+
+    def _locate(self, trace_id: str) -> str | None:
+        key = self._routed(trace_id)
+        if key is not None:
+            return key
+        keys = self.partitions()[::-1]
+        for key, found in zip(keys, self._map(lambda tracer: tracer.get_trace(trace_id) is not None, keys)):
+            if found:
+                self._route(trace_id, key)
+                return key
+        return None
+
+    def _trace_partitions(self, query: TraceQuery) -> list[str]:
+        if query.trace_id is not None:
+            key = self._locate(query.trace_id)
+            return [key] if key is not None else []
+        return self._prune(query.started_from, query.started_to)
+
+    def _span_plan(self, query: SpanQuery) -> list[tuple[str, SpanQuery]]:
+        if query.trace_id is not None:
+            key = self._locate(query.trace_id)
+            plan = [(key, query)] if key is not None else []
+        elif query.trace_ids is not None:
+            # Send each partition only the trace ids routed to it. / 各パーティションには属するtrace_idだけを渡す。
+            grouped: dict[str, list[str]] = {}
+            for trace_id in query.trace_ids:
+                key = self._locate(trace_id)
+                if key is not None:
+                    grouped.setdefault(key, []).append(trace_id)
+            plan = [(key, replace(query, trace_ids=grouped[key])) for key in sorted(grouped)]
+        else:
+            plan = [(key, query) for key in self._prune(query.started_from, query.started_to)]
+        if not query.cursor:
+            return plan
+        after_key, inner = _decode_cursor(query.cursor, _SPAN_CURSOR_KEY)
+        return [(key, replace(sub, cursor=inner if key == after_key else None)) for key, sub in plan if key >= after_key]
+
+    def _prune(self, started_from: datetime | None, started_to: datetime | None) -> list[str]:
+        # Nothing in a partition starts before its window, but long traces may run past it: skip by file name
+        # for started_to, and by the stored maxima for started_from. / パーティション内は窓の開始以降だが長いTraceは
+        # 窓を越え得るため、started_to はファイル名、started_from は保存済みの最大時刻で判定する。
+        lower = _normalize_query_dt(started_from, self.default_tz)
+        upper = _normalize_query_dt(started_to, self.default_tz)
+        keys = [key for key in self.partitions() if upper is None or self._window(key)[0] <= upper]
+        if lower is None:
+            return keys
+        kept = []
+        for key in keys:
+            if self._window(key)[1] > lower:
+                kept.append(key)
+                continue
+            max_started, max_ended = self._partition_bounds(key)
+            latest = max(filter(None, (max_started, max_ended)), default=None)
+            if latest is not None and latest >= lower:
+                kept.append(key)
+        return kept
+
+    def _partition_bounds(self, key: str) -> tuple[datetime | None, datetime | None]:
+        with self._lock:
+            cached = self._bounds.get(key)
+        if cached is not None:
+            return cached
+        bounds = self._call(key, lambda tracer: tracer.trace_time_bounds(), (None, None))
+        with self._lock:
+            self._bounds[key] = bounds
+        return bounds
+
+    def _map(self, fn: Callable[[SQLiteTracer], _T], keys: list[str], default: Any = None) -> list[_T]:
+        return self._parallel([functools.partial(self._call, key, fn, default) for key in keys])
+
+    def _parallel(self, calls: list[Callable[[], _T]]) -> list[_T]:
+        if len(calls) <= 1:
+            return [call() for call in calls]
+        futures = [self._pool().submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, self._max_workers), thread_name_prefix="kantan-llm-partition"
+                )
+            return self._executor
+
+
+def _merge_trace_rows(streams: list[Any], order_column: str, descending: bool) -> Iterator[Any]:
+    # Same order as SQLite: NULLs first ascending, then id as tie-breaker. / SQLiteと同じ順（昇順でNULLが先、同値はid）。
+    def key(row: Any) -> tuple[Any, ...]:
+        value = row[order_column]
+        return (value is not None, value, row["id"])
+
+    return heapq.merge(*streams, key=key, reverse=descending)
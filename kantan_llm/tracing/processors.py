@@ -1,16 +1,66 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import functools
+import itertools
 import json
+import logging
 import os
+import queue
+import re
 import sqlite3
 import sys
-from datetime import datetime, timezone
-from typing import Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import fields
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence, TypeVar
 
 from .processor_interface import TracingProcessor
-from ..errors import NotSupportedError
-from .search import SpanQuery, SpanRecord, TraceQuery, TraceRecord, TraceSearchCapabilities
+from ..errors import InvalidCursorError, NotSupportedError
+from .search import (
+    AggregateQuery,
+    AggregateRow,
+    And,
+    Compare,
+    Not,
+    Or,
+    Predicate,
+    SearchPage,
+    SpanQuery,
+    SpanRecord,
+    TraceQuery,
+    TraceRecord,
+    TraceSearchCapabilities,
+    UsageQuery,
+    UsageRow,
+)
+from .retention import RetentionPolicy, RetentionReport
 from .sanitize import sanitize_text
+from .storage import (
+    StorageProfile,
+    common_prefix_len,
+    decode_text,
+    dedupe_raw,
+    encode_delta,
+    encode_text,
+    is_delta,
+    join_blobs,
+    parse_delta,
+    restore_raw,
+    split_blobs,
+)
+
+_T = TypeVar("_T")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_logger = logging.getLogger(__name__)
 
 
 class PrintTracer(TracingProcessor):
@@ -105,56 +155,136 @@ def _to_text(value: Any) -> str:
 
 
 class SQLiteTracer(TracingProcessor):
-    """Persist traces/spans to SQLite. / Trace/SpanをSQLiteへ保存する。"""
-
-    def __init__(self, path: str = "kantan_llm_traces.sqlite3") -> None:
+    """Persist traces/spans to SQLite. / Trace/SpanをSQLiteへ保存する。
+
+    Safe to share across threads. With ``concurrent=True`` a dedicated writer thread owns the write
+    connection and searches run on a pool of read-only WAL connections.
+    / スレッド間で共有できる。``concurrent=True`` では専用の書き込みスレッドが書き込み接続を持ち、
+    検索はWAL上の読み取り専用接続プールで実行する。
+    """
+
+    def __init__(
+        self,
+        path: str = "kantan_llm_traces.sqlite3",
+        *,
+        concurrent: bool = False,
+        reader_pool_size: int = 4,
+        mmap_size: int = 256 * 1024 * 1024,
+        storage: StorageProfile | None = None,
+        retention: RetentionPolicy | None = None,
+        indexed_metadata_keys: Sequence[str] = (),
+    ) -> None:
+        if concurrent and _is_memory_path(path):
+            raise NotSupportedError("concurrent=True with in-memory database")
+        for key in indexed_metadata_keys:
+            if not _METADATA_KEY.fullmatch(key):
+                raise NotSupportedError(f"indexed metadata key {key!r}")
+        if indexed_metadata_keys and sqlite3.sqlite_version_info < (3, 31, 0):
+            raise NotSupportedError("indexed_metadata_keys (JSON1, SQLite >= 3.31)")
         self._path = path
         self._conn: sqlite3.Connection | None = None
         self._supports_json1: bool | None = None
+        self._supports_fts5: bool | None = None
         self.default_tz = datetime.now().astimezone().tzinfo or timezone.utc
+        self._storage = storage or StorageProfile()
+        self._lock = threading.RLock()
+        self._concurrent = concurrent
+        self._reader_pool_size = reader_pool_size
+        self._mmap_size = mmap_size
+        self._writer: _SQLiteWriter | None = None
+        self._readers: _SQLiteReaderPool | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._text: _TextResolver | None = None
+        self._retention = retention
+        # Indexed metadata key -> generated column on traces. / 索引付きメタデータキー -> tracesの生成列。
+        self._metadata_columns = {key: f"meta_{key}" for key in indexed_metadata_keys}
+        self._compactor: _SQLiteCompactor | None = None
+        # Writes through this tracer, plus a side connection whose data_version sees every commit.
+        # / このトレーサー経由の書き込み数と、全コミットをdata_versionで検知する別接続。
+        self._writes = 0
+        self._version_conn: sqlite3.Connection | None = None
+        self._version_lock = threading.Lock()
+        self._ingest = _IngestSignal()
+        self.last_retention_report: RetentionReport | None = None
+        self._active = threading.local()
 
     def _ensure_conn(self) -> sqlite3.Connection:
+        with self._lock:
+            return self._open_conn()
+
+    def _open_conn(self) -> sqlite3.Connection:
         if self._conn is None:
-            self._conn = sqlite3.connect(self._path)
-            self._conn.row_factory = sqlite3.Row
-            if self._supports_json1 is None:
-                self._supports_json1 = _detect_json1(self._conn)
-            self._conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS traces (
-                  id TEXT PRIMARY KEY,
-                  workflow_name TEXT,
-                  group_id TEXT,
-                  metadata_json TEXT
-                )
-                """
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            try:
+                self._setup_conn()
+            except BaseException:
+                # Never keep a half-initialized connection (and its file handle) around. / 初期化途中の接続は残さない。
+                conn, self._conn = self._conn, None
+                conn.close()
+                raise
+        return self._conn
+
+    def _setup_conn(self) -> None:
+        self._conn.row_factory = sqlite3.Row
+        self._text = _register_functions(self._conn)
+        if self._conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0:
+            # New database: let retention shrink the file. / 新規DBは保持ポリシーでファイルを縮められるようにする。
+            self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self._concurrent:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+        if self._supports_json1 is None:
+            self._supports_json1 = _detect_json1(self._conn)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traces (
+              id TEXT PRIMARY KEY,
+              workflow_name TEXT,
+              group_id TEXT,
+              metadata_json TEXT
             )
-            self._ensure_columns_traces()
-            self._conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS spans (
-                  id TEXT PRIMARY KEY,
-                  trace_id TEXT,
-                  parent_id TEXT,
-                  started_at TEXT,
-                  ended_at TEXT,
-                  span_type TEXT,
-                  name TEXT,
-                  ingest_seq INTEGER,
-                  input TEXT,
-                  output TEXT,
-                  output_kind TEXT,
-                  tool_calls_json TEXT,
-                  structured_json TEXT,
-                  rubric_json TEXT,
-                  error_json TEXT,
-                  raw_json TEXT
-                )
-                """
+            """
+        )
+        self._ensure_columns_traces()
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS spans (
+              id TEXT PRIMARY KEY,
+              trace_id TEXT,
+              parent_id TEXT,
+              started_at TEXT,
+              ended_at TEXT,
+              span_type TEXT,
+              name TEXT,
+              ingest_seq INTEGER,
+              input TEXT,
+              output TEXT,
+              output_kind TEXT,
+              tool_calls_json TEXT,
+              structured_json TEXT,
+              rubric_json TEXT,
+              error_json TEXT,
+              raw_json TEXT
             )
-            self._ensure_columns()
-            self._conn.commit()
-        return self._conn
+            """
+        )
+        self._ensure_columns()
+        self._ensure_trace_rollup()
+        self._ensure_metadata_columns()
+        self._ensure_usage_rollups()
+        self._ensure_blobs()
+        if self._supports_fts5 is None:
+            self._supports_fts5 = _detect_fts5(self._conn)
+        if self._supports_fts5:
+            self._ensure_fts()
+        self._conn.commit()
+        if self._concurrent:
+            # The writer manages transactions itself (one per batch). / 書き込みスレッドがバッチ単位でトランザクションを管理する。
+            self._conn.isolation_level = None
+            self._readers = _SQLiteReaderPool(self._path, self._reader_pool_size, self._mmap_size)
+            self._writer = _SQLiteWriter(self._conn, on_commit=self._ingest.notify)
+        if self._retention is not None:
+            self._compactor = _SQLiteCompactor(self, self._retention)
 
     def _ensure_columns_traces(self) -> None:
         conn = self._conn
@@ -163,6 +293,63 @@ class SQLiteTracer(TracingProcessor):
         cols = {row["name"] for row in conn.execute("PRAGMA table_info(traces)").fetchall()}
         if "metadata_json" not in cols:
             conn.execute("ALTER TABLE traces ADD COLUMN metadata_json TEXT")
+        if "created_at_us" not in cols:
+            # When the trace row was first written, so traces without spans still age out.
+            # / Trace行を最初に書いた時刻。Spanの無いTraceも保持期間で消せるようにする。
+            conn.execute("ALTER TABLE traces ADD COLUMN created_at_us INTEGER")
+            conn.execute("UPDATE traces SET created_at_us = ?", (_epoch_us(datetime.now(timezone.utc)),))
+        conn.commit()
+
+    def _ensure_metadata_columns(self) -> None:
+        # Virtual generated columns: json_extract runs once per write, and lookups hit a plain index.
+        # / 仮想生成列: 検索はjson_extractではなく通常の索引を引く。
+        conn = self._conn
+        if conn is None or not self._metadata_columns:
+            return
+        if not self._supports_json1 or sqlite3.sqlite_version_info < (3, 31, 0):
+            raise NotSupportedError("indexed_metadata_keys (JSON1, SQLite >= 3.31)")
+        cols = {row["name"] for row in conn.execute("PRAGMA table_xinfo(traces)").fetchall()}
+        for key, column in self._metadata_columns.items():
+            if column not in cols:
+                conn.execute(
+                    f"ALTER TABLE traces ADD COLUMN {column} "
+                    f"GENERATED ALWAYS AS (json_extract(metadata_json, '$.{key}')) VIRTUAL"
+                )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_traces_{column} ON traces({column}, started_at, id)")
+        conn.commit()
+
+    def _ensure_usage_rollups(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage_rollups'"
+        ).fetchone()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS usage_rollups (
+              bucket TEXT NOT NULL,
+              provider TEXT NOT NULL,
+              model TEXT NOT NULL,
+              workflow_name TEXT NOT NULL,
+              requests INTEGER NOT NULL DEFAULT 0,
+              errors INTEGER NOT NULL DEFAULT 0,
+              input_tokens INTEGER NOT NULL DEFAULT 0,
+              output_tokens INTEGER NOT NULL DEFAULT 0,
+              cached_tokens INTEGER NOT NULL DEFAULT 0,
+              reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+              PRIMARY KEY (bucket, provider, model, workflow_name)
+            ) WITHOUT ROWID
+            """
+        )
+        if exists is None:
+            # Backfill from generation spans written before the table existed. / 既存のgeneration Spanから埋める。
+            rows = conn.execute(
+                f"SELECT {_USAGE_ROLLUP_SOURCE}, t.workflow_name FROM spans s LEFT JOIN traces t ON t.id = s.trace_id "
+                "WHERE s.span_type = 'generation'"
+            ).fetchall()
+            for row in rows:
+                _apply_usage_rollup(conn, row, row["workflow_name"], 1)
         conn.commit()
 
     def _ensure_columns(self) -> None:
@@ -184,234 +371,1643 @@ class SQLiteTracer(TracingProcessor):
             conn.execute("ALTER TABLE spans ADD COLUMN tool_calls_json TEXT")
         if "structured_json" not in cols:
             conn.execute("ALTER TABLE spans ADD COLUMN structured_json TEXT")
+        if "input_base_id" not in cols:
+            # ingest_id of the span whose input this one extends (StorageProfile.delta_inputs). / 差分の基準Span。
+            conn.execute("ALTER TABLE spans ADD COLUMN input_base_id INTEGER")
+        if "input_depth" not in cols:
+            conn.execute("ALTER TABLE spans ADD COLUMN input_depth INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_spans_input_base ON spans(input_base_id) WHERE input_base_id IS NOT NULL"
+        )
+        if "ingest_id" not in cols:
+            # Global ingest order, also used as the FTS document id. / 全体の取り込み順（FTSの文書IDを兼ねる）。
+            conn.execute("ALTER TABLE spans ADD COLUMN ingest_id INTEGER")
+            conn.execute("UPDATE spans SET ingest_id = rowid WHERE ingest_id IS NULL")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_spans_ingest_id ON spans(ingest_id)")
+        # Persisted so ingest_id never goes back, even after purges delete the newest rows.
+        # / 最新の行を削除してもingest_idが戻らないよう永続化したカウンタ。
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute(
+            "INSERT OR IGNORE INTO counters(name, value) SELECT 'ingest_id', COALESCE(MAX(ingest_id), 0) FROM spans"
+        )
+        if "has_error" not in cols:
+            conn.execute("ALTER TABLE spans ADD COLUMN has_error INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE spans SET has_error = 1 WHERE error_json IS NOT NULL AND error_json != 'null'")
+        if "has_tool_call" not in cols:
+            # Same rule as _has_tool_call, evaluated once at migration. / _has_tool_callと同じ判定を移行時に1回だけ行う。
+            conn.execute("ALTER TABLE spans ADD COLUMN has_tool_call INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "UPDATE spans SET has_tool_call = 1 WHERE tool_calls_json IS NOT NULL "
+                "OR instr(raw_json, 'tool_calls') > 0 OR instr(raw_json, 'function_call') > 0"
+            )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_has_error ON spans(has_error, trace_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_has_tool_call ON spans(has_tool_call, trace_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_seq ON spans(ingest_seq, id)")
+        if "rubric_score" not in cols:
+            # Numeric rubric score for indexed judge filters. / judge条件を索引で引くための数値スコア。
+            conn.execute("ALTER TABLE spans ADD COLUMN rubric_score REAL")
+            rows = conn.execute("SELECT ingest_id, rubric_json FROM spans WHERE rubric_json IS NOT NULL").fetchall()
+            conn.executemany(
+                "UPDATE spans SET rubric_score = ? WHERE ingest_id = ?",
+                [(_rubric_score(_json_or_none(row["rubric_json"])), row["ingest_id"]) for row in rows],
+            )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_spans_rubric_score ON spans(rubric_score) WHERE rubric_score IS NOT NULL"
+        )
+        if "duration_ms" not in cols:
+            # Epoch microseconds and duration, so range filters and latency stats compare numbers, not ISO text.
+            # / 範囲条件やレイテンシ集計をISO文字列ではなく数値で比較するためのエポックマイクロ秒と所要時間。
+            conn.execute("ALTER TABLE spans ADD COLUMN started_at_us INTEGER")
+            conn.execute("ALTER TABLE spans ADD COLUMN ended_at_us INTEGER")
+            conn.execute("ALTER TABLE spans ADD COLUMN duration_ms INTEGER")
+            rows = conn.execute(
+                "SELECT ingest_id, started_at, ended_at FROM spans WHERE started_at IS NOT NULL OR ended_at IS NOT NULL"
+            ).fetchall()
+            conn.executemany(
+                "UPDATE spans SET started_at_us = ?, ended_at_us = ?, duration_ms = ? WHERE ingest_id = ?",
+                [(*_span_times(row["started_at"], row["ended_at"]), row["ingest_id"]) for row in rows],
+            )
+        if "model" not in cols:
+            # Generation attributes as indexed columns, read once from raw_json. / generationの属性を索引付き列にする。
+            for column in _MODEL_COLUMNS:
+                conn.execute(f"ALTER TABLE spans ADD COLUMN {column} TEXT")
+            rows = conn.execute(
+                f"SELECT ingest_id, {_resolved_column('raw_json')} FROM spans "
+                "WHERE span_type = 'generation' OR has_error = 1"
+            ).fetchall()
+            updates = []
+            for row in rows:
+                exported = _json_or_none(decode_text(row["raw_json"]))
+                values = _model_columns(exported if isinstance(exported, dict) else {})
+                if any(values.values()):
+                    updates.append((*values.values(), row["ingest_id"]))
+            conn.executemany(
+                f"UPDATE spans SET {', '.join(f'{column} = ?' for column in _MODEL_COLUMNS)} WHERE ingest_id = ?",
+                updates,
+            )
+        for column in _MODEL_COLUMNS:
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_spans_{column} ON spans({column}, started_at_us) "
+                f"WHERE {column} IS NOT NULL"
+            )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_started_at_us ON spans(started_at_us)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_duration_ms ON spans(duration_ms) WHERE duration_ms IS NOT NULL")
+        # Keyset cursors need a non-null sort key. / keysetカーソルのためNULLを埋める。
+        conn.execute("UPDATE spans SET ingest_seq = 0 WHERE ingest_seq IS NULL")
         conn.commit()
 
-    def _upsert_trace(self, trace) -> None:
-        exported = getattr(trace, "export", lambda: None)()
-        if not exported:
+    def _ensure_trace_rollup(self) -> None:
+        conn = self._conn
+        if conn is None:
             return
-        conn = self._ensure_conn()
+        cols = {row["name"] for row in conn.execute("PRAGMA table_info(traces)").fetchall()}
+        missing = [name for name, _ in _TRACE_ROLLUP_COLUMNS if name not in cols]
+        for name, decl in _TRACE_ROLLUP_COLUMNS:
+            if name in missing:
+                conn.execute(f"ALTER TABLE traces ADD COLUMN {name} {decl}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_traces_started_at ON traces(started_at, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_traces_error_count ON traces(error_count, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_traces_total_tokens ON traces(total_tokens, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_traces_duration_ms ON traces(duration_ms, id)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_traces_retained_at ON traces({_TRACE_AGE_SQL})")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_trace_seq ON spans(trace_id, ingest_seq)")
+        if missing:
+            # Backfill rollups for databases written before they existed. / 既存DBのrollupを埋める。
+            for row in conn.execute("SELECT id FROM traces").fetchall():
+                self._refresh_trace_rollup(conn, row["id"])
+        conn.commit()
+
+    def _refresh_trace_rollup(self, conn: sqlite3.Connection, trace_id: str) -> None:
+        rows = conn.execute(
+            "SELECT started_at, ended_at, started_at_us, usage_json, has_error, has_tool_call FROM spans "
+            "WHERE trace_id = ?",
+            (trace_id,),
+        ).fetchall()
+        started = [row["started_at"] for row in rows if row["started_at"]]
+        started_us = [row["started_at_us"] for row in rows if row["started_at_us"] is not None]
+        ended = [row["ended_at"] for row in rows if row["ended_at"]]
+        tokens = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        usage_total: dict[str, int | float] = {}
+        for row in rows:
+            usage = _json_or_none(row["usage_json"])
+            for key, value in _usage_tokens(usage).items():
+                tokens[key] += value
+            _add_usage_total(usage_total, usage)
         conn.execute(
-            "INSERT OR IGNORE INTO traces(id, workflow_name, group_id, metadata_json) VALUES(?,?,?,?)",
+            "UPDATE traces SET started_at = ?, ended_at = ?, started_at_us = ?, span_count = ?, error_count = ?, "
+            "tool_call_count = ?, input_tokens = ?, output_tokens = ?, total_tokens = ?, usage_total_json = ? "
+            "WHERE id = ?",
             (
-                exported.get("id") or getattr(trace, "trace_id", None),
-                exported.get("workflow_name") or getattr(trace, "name", None),
-                exported.get("group_id"),
-                json.dumps(exported.get("metadata"), ensure_ascii=False, default=str),
+                min(started) if started else None,
+                max(ended) if ended else None,
+                min(started_us) if started_us else None,
+                len(rows),
+                sum(row["has_error"] for row in rows),
+                sum(row["has_tool_call"] for row in rows),
+                tokens["input_tokens"],
+                tokens["output_tokens"],
+                tokens["total_tokens"],
+                _usage_total_json(usage_total),
+                trace_id,
             ),
         )
+        self._update_trace_duration(conn, trace_id)
+
+    def _update_trace_duration(self, conn: sqlite3.Connection, trace_id: str) -> None:
+        conn.execute(
+            "UPDATE traces SET duration_ms = CAST(ROUND((julianday(ended_at) - julianday(started_at)) * 86400000) "
+            "AS INTEGER) WHERE id = ?",
+            (trace_id,),
+        )
+
+    def _ensure_blobs(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        # Content-addressed segments shared by spans (StorageProfile.dedupe_blobs). / Span間で共有する内容アドレスの区間。
+        conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data) WITHOUT ROWID")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS span_blobs (ingest_id INTEGER, hash TEXT, PRIMARY KEY (ingest_id, hash)) "
+            "WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_span_blobs_hash ON span_blobs(hash)")
+        conn.commit()
+
+    def _ensure_fts(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spans_fts'").fetchone()
+        if exists:
+            return
+        # Contentless trigram index: substring semantics without a second copy of the text.
+        # / contentlessのtrigram索引: 本文を二重に持たずに部分一致を維持する。
+        conn.execute(
+            "CREATE VIRTUAL TABLE spans_fts USING fts5(input, output, tool_args, content='', tokenize='trigram')"
+        )
+        rows = conn.execute(f"SELECT ingest_id, {_FTS_SOURCE_COLUMNS} FROM spans").fetchall()
+        for row in rows:
+            conn.execute(
+                "INSERT INTO spans_fts(rowid, input, output, tool_args) VALUES(?,?,?,?)",
+                (
+                    row["ingest_id"],
+                    decode_text(row["input"]),
+                    decode_text(row["output"]),
+                    _tool_args_text(decode_text(row["tool_calls_json"])),
+                ),
+            )
+        conn.commit()
+
+    def _delete_fts_entry(self, conn: sqlite3.Connection, row: sqlite3.Row) -> None:
+        # Contentless tables need the original values to delete. / contentlessは削除時に元の値が必要。
+        conn.execute(
+            "INSERT INTO spans_fts(spans_fts, rowid, input, output, tool_args) VALUES('delete', ?, ?, ?, ?)",
+            (
+                row["ingest_id"],
+                decode_text(row["input"]),
+                decode_text(row["output"]),
+                _tool_args_text(decode_text(row["tool_calls_json"])),
+            ),
+        )
+
+    def _upsert_trace(self, conn: sqlite3.Connection, values: tuple[Any, ...] | None) -> None:
+        if values is None:
+            return
+        conn.execute(
+            "INSERT OR IGNORE INTO traces(id, workflow_name, group_id, metadata_json, created_at_us) VALUES(?,?,?,?,?)",
+            (*values, _epoch_us(datetime.now(timezone.utc))),
+        )
 
     def _update_trace_usage_cache(self, conn: sqlite3.Connection, trace_id: str, usage: dict[str, Any]) -> None:
-        row = conn.execute("SELECT metadata_json FROM traces WHERE id = ?", (trace_id,)).fetchone()
-        metadata = _json_or_none(row["metadata_json"]) if row else None
-        if metadata is None:
-            metadata = {}
-        usage_total = metadata.get("usage_total") or {}
-        for key, value in usage.items():
-            if isinstance(value, (int, float)):
-                usage_total[key] = usage_total.get(key, 0) + value
-        metadata["usage_total"] = usage_total
+        tokens = _usage_tokens(usage)
+        # Every numeric key of the normalized usage is summed (spec 9.3). / 正規化後の数値キーをすべて合算する。
+        found = conn.execute("SELECT usage_total_json FROM traces WHERE id = ?", (trace_id,)).fetchone()
+        usage_total = (_json_or_none(found["usage_total_json"]) if found is not None else None) or {}
+        _add_usage_total(usage_total, usage)
         conn.execute(
-            "UPDATE traces SET metadata_json = ? WHERE id = ?",
-            (json.dumps(metadata, ensure_ascii=False, default=str), trace_id),
+            "UPDATE traces SET input_tokens = input_tokens + ?, output_tokens = output_tokens + ?, "
+            "total_tokens = total_tokens + ?, usage_total_json = ? WHERE id = ?",
+            (
+                tokens["input_tokens"],
+                tokens["output_tokens"],
+                tokens["total_tokens"],
+                _usage_total_json(usage_total),
+                trace_id,
+            ),
         )
 
+    def _update_trace_rollup(
+        self,
+        conn: sqlite3.Connection,
+        trace_id: str,
+        started_at: str | None,
+        ended_at: str | None,
+        started_at_us: int | None,
+        has_error: bool,
+        has_tool_call: bool,
+    ) -> None:
+        conn.execute(
+            """
+            UPDATE traces SET
+              started_at = CASE WHEN ?1 IS NOT NULL AND (started_at IS NULL OR ?1 < started_at) THEN ?1 ELSE started_at END,
+              ended_at = CASE WHEN ?2 IS NOT NULL AND (ended_at IS NULL OR ?2 > ended_at) THEN ?2 ELSE ended_at END,
+              started_at_us = CASE WHEN ?6 IS NOT NULL AND (started_at_us IS NULL OR ?6 < started_at_us) THEN ?6
+                ELSE started_at_us END,
+              span_count = span_count + 1,
+              error_count = error_count + ?3,
+              tool_call_count = tool_call_count + ?4
+            WHERE id = ?5
+            """,
+            (started_at, ended_at, int(has_error), int(has_tool_call), trace_id, started_at_us),
+        )
+        self._update_trace_duration(conn, trace_id)
+
+    def _submit(self, job: Callable[[sqlite3.Connection], None]) -> None:
+        conn = self._ensure_conn()
+        if self._writer is not None:
+            self._writer.submit(job)
+            return
+        with self._lock:
+            with conn:
+                job(conn)
+            self._writes += 1
+        self._ingest.notify()
+
+    def data_version(self) -> tuple[int, int]:
+        """Value that changes whenever committed data may have changed. / コミット済みデータが変わり得ると変わる値。
+
+        ``PRAGMA data_version`` on a dedicated connection also sees commits from other connections and
+        processes; in-memory databases rely on the write counter. / 専用接続の ``PRAGMA data_version`` は
+        他の接続・プロセスのコミットも検知する。インメモリDBは書き込み数だけで判定する。
+        """
+
+        self._ensure_conn()
+        if _is_memory_path(self._path):
+            return self._writes, 0
+        with self._version_lock:
+            if self._version_conn is None:
+                uri = Path(self._path).resolve().as_uri() + "?mode=ro"
+                self._version_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return self._writes, self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        conn = self._ensure_conn()
+        if self._readers is not None:
+            with self._readers.connection() as reader:
+                with self._interruptible(reader):
+                    yield reader
+            return
+        with self._lock:
+            with self._interruptible(conn):
+                yield conn
+
+    @contextmanager
+    def _interruptible(self, conn: sqlite3.Connection) -> Iterator[None]:
+        call: _AsyncCall | None = getattr(self._active, "call", None)
+        if call is None:
+            yield
+            return
+        call.attach(conn)
+        try:
+            yield
+        finally:
+            call.detach()
+
     def on_trace_start(self, trace) -> None:
-        self._upsert_trace(trace)
-        self._ensure_conn().commit()
+        values = _trace_values(trace)
+        if values is not None:
+            self._submit(lambda conn: self._upsert_trace(conn, values))
 
     def on_trace_end(self, trace) -> None:
-        self._upsert_trace(trace)
-        self._ensure_conn().commit()
+        values = _trace_values(trace)
+        if values is not None:
+            self._submit(lambda conn: self._upsert_trace(conn, values))
 
     def on_span_start(self, span) -> None:
         return
 
     def on_span_end(self, span) -> None:
+        prepared = self._prepare_span(span)
+        if prepared is not None:
+            self._submit(lambda conn: self._write_span(conn, prepared))
+
+    def _prepare_span(self, span) -> dict[str, Any] | None:
+        # Serialize in the caller thread; the writer only runs SQL. / 直列化は呼び出し側で行い、書き込み側はSQLのみ実行する。
         exported = getattr(span, "export", lambda: None)()
         if not exported:
-            return
-
-        trace_id = exported.get("trace_id") or getattr(span, "trace_id", None)
-        if trace_id is None:
-            return
+            return None
+        columns = _span_columns(exported, getattr(span, "span_id", None), getattr(span, "trace_id", None))
+        if columns is None:
+            return None
 
-        span_data = exported.get("span_data") or {}
-        span_usage = exported.get("usage")
-        raw_in = span_data.get("input")
-        raw_out = span_data.get("output_raw", span_data.get("output"))
-        span_name = span_data.get("name")
-        usage = span_usage or _extract_usage(span_data)
+        trace_id = columns["trace_id"]
+        input_text = columns["input"]
+        output_text = columns["output"]
+        tool_calls_json = columns["tool_calls_json"]
+        structured_json = columns["structured_json"]
+        raw_json = columns["raw_json"]
+        profile = self._storage
+        stored_input = encode_text(input_text, profile)
+        stored_output = encode_text(output_text, profile)
+        input_blobs: dict[str, str] = {}
+        output_blobs: dict[str, str] = {}
+        if profile.dedupe_blobs:
+            input_manifest, input_blobs = split_blobs(input_text, profile)
+            output_manifest, output_blobs = split_blobs(output_text, profile)
+            if input_manifest is not None:
+                stored_input = input_manifest
+            if output_manifest is not None:
+                stored_output = output_manifest
+        if profile.dedupe_raw:
+            # Payloads already in input/output are rebuilt on read. / input/outputにある値は読み出し時に復元する。
+            stored_raw = dedupe_raw(exported, {"input": input_text, "output": output_text})
+            if stored_raw is not exported:
+                raw_json = json.dumps(stored_raw, ensure_ascii=False, default=str)
+        return {
+            **columns,
+            # Ensure trace row exists even if we didn't see on_trace_start (interop). / trace startを見ていなくてもtrace行を作る。
+            "trace_values": _trace_values(getattr(span, "_trace", None) or _TraceLike(trace_id=trace_id)),
+            # Column values as stored (compressed per the storage profile). / 保存形式の列値（プロファイルに応じて圧縮）。
+            "stored": {
+                "input": stored_input,
+                "output": stored_output,
+                "tool_calls_json": encode_text(tool_calls_json, profile),
+                "structured_json": encode_text(structured_json, profile),
+                "raw_json": encode_text(raw_json, profile),
+            },
+            "input_blobs": input_blobs,
+            "output_blobs": output_blobs,
+        }
+
+    def _write_span(self, conn: sqlite3.Connection, row: dict[str, Any]) -> None:
+        span_id = row["id"]
+        trace_id = row["trace_id"]
+        self._upsert_trace(conn, row["trace_values"])
+        replaced = conn.execute(
+            f"SELECT trace_id, ingest_id, {_FTS_SOURCE_COLUMNS}, {_USAGE_ROLLUP_SOURCE} FROM spans s WHERE id = ?",
+            (span_id,),
+        ).fetchone()
+        if replaced is not None:
+            # Take the old contribution out before counting the new one. / 旧Spanの寄与を差し引いてから加算する。
+            _apply_usage_rollup(conn, replaced, self._workflow_name(conn, replaced["trace_id"]), -1)
+        _apply_usage_rollup(conn, row, self._workflow_name(conn, trace_id), 1)
+        if replaced is not None and self._supports_fts5:
+            self._delete_fts_entry(conn, replaced)
+        if replaced is not None:
+            conn.execute("DELETE FROM span_blobs WHERE ingest_id = ?", (replaced["ingest_id"],))
+            self._materialize_dependents(conn, [replaced["ingest_id"]])
+        conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'ingest_id'")
+        ingest_id = conn.execute("SELECT value FROM counters WHERE name = 'ingest_id'").fetchone()[0]
+        stored_input = row["stored"]["input"]
+        blobs = {**row["input_blobs"], **row["output_blobs"]}
+        input_base_id = None
+        input_depth = 0
+        delta = self._input_delta(conn, row) if self._storage.delta_inputs else None
+        if delta is not None:
+            stored_input, input_base_id, input_depth = delta
+            blobs = dict(row["output_blobs"])
+        for key, segment in blobs.items():
+            # Only new blobs pay for compression. / 圧縮するのは新規blobだけ。
+            if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (key,)).fetchone() is None:
+                conn.execute("INSERT INTO blobs(hash, data) VALUES(?, ?)", (key, encode_text(segment, self._storage)))
+            conn.execute("INSERT OR IGNORE INTO span_blobs(ingest_id, hash) VALUES(?, ?)", (ingest_id, key))
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO spans(
+              id, trace_id, parent_id, started_at, ended_at, span_type, name, ingest_seq, ingest_id, input, output,
+              output_kind, tool_calls_json, structured_json, rubric_json, rubric_score, usage_json, error_json,
+              raw_json, has_error, has_tool_call, input_base_id, input_depth, started_at_us, ended_at_us, duration_ms,
+              model, provider, api_kind
+            ) VALUES(
+              ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(ingest_seq), 0) + 1 FROM spans WHERE trace_id = ?),
+              ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+            )
+            """,
+            (
+                span_id,
+                trace_id,
+                row["parent_id"],
+                row["started_at"],
+                row["ended_at"],
+                row["span_type"],
+                row["name"],
+                trace_id,
+                ingest_id,
+                stored_input,
+                row["stored"]["output"],
+                row["output_kind"],
+                row["stored"]["tool_calls_json"],
+                row["stored"]["structured_json"],
+                row["rubric_json"],
+                row["rubric_score"],
+                row["usage_json"],
+                row["error_json"],
+                row["stored"]["raw_json"],
+                int(row["has_error"]),
+                int(row["has_tool_call"]),
+                input_base_id,
+                input_depth,
+                row["started_at_us"],
+                row["ended_at_us"],
+                row["duration_ms"],
+                row["model"],
+                row["provider"],
+                row["api_kind"],
+            ),
+        )
+        if self._supports_fts5:
+            conn.execute(
+                "INSERT INTO spans_fts(rowid, input, output, tool_args) VALUES(?,?,?,?)",
+                (ingest_id, row["input"], row["output"], _tool_args_text(row["tool_calls_json"])),
+            )
+        if replaced is not None:
+            # Re-ingested span: recompute instead of double counting. / 再取り込みは再集計する。
+            self._refresh_trace_rollup(conn, trace_id)
+            if replaced["trace_id"] != trace_id:
+                self._refresh_trace_rollup(conn, replaced["trace_id"])
+        else:
+            self._update_trace_rollup(
+                conn,
+                trace_id,
+                row["started_at"],
+                row["ended_at"],
+                row["started_at_us"],
+                row["has_error"],
+                row["has_tool_call"],
+            )
+            if row["usage"]:
+                self._update_trace_usage_cache(conn, trace_id, row["usage"])
+
+    def _workflow_name(self, conn: sqlite3.Connection, trace_id: str) -> str | None:
+        found = conn.execute("SELECT workflow_name FROM traces WHERE id = ?", (trace_id,)).fetchone()
+        return found["workflow_name"] if found is not None else None
+
+    def _input_delta(self, conn: sqlite3.Connection, row: dict[str, Any]) -> tuple[bytes, int, int] | None:
+        # Store a generation's input as "previous input prefix + appended messages".
+        # / generationのinputを「直前のinputの先頭 + 追記メッセージ」として保存する。
+        text = row["input"]
+        if row["span_type"] != "generation" or not text or len(text) < _DELTA_MIN_PREFIX:
+            return None
+        base = self._delta_base(conn, row["trace_id"], row["id"])
+        if base is None or base["input_depth"] >= self._storage.delta_max_depth:
+            return None
+        prefix_len = common_prefix_len(self._text.span_input(base["ingest_id"]), text)
+        if prefix_len < _DELTA_MIN_PREFIX or prefix_len * 2 < len(text):
+            return None
+        return encode_delta(base["ingest_id"], prefix_len, text[prefix_len:]), base["ingest_id"], base["input_depth"] + 1
 
-        input_text = sanitize_text(_to_text(raw_in)) if raw_in is not None else None
-        output_text = sanitize_text(_to_text(span_data.get("output"))) if span_data.get("output") is not None else None
-        output_kind, tool_calls, structured, rubric = _extract_output_parts(span_data, raw_out)
+    def _delta_base(self, conn: sqlite3.Connection, trace_id: str, span_id: str) -> sqlite3.Row | None:
+        base = conn.execute(
+            "SELECT ingest_id, input_depth FROM spans WHERE trace_id = ? AND id != ? AND span_type = 'generation' "
+            "AND input IS NOT NULL ORDER BY ingest_seq DESC LIMIT 1",
+            (trace_id, span_id),
+        ).fetchone()
+        if base is not None:
+            return base
+        # First generation of a trace: continue from the latest trace in the same group. / 同じgroupの直近Traceから続ける。
+        return conn.execute(
+            "SELECT ingest_id, input_depth FROM spans WHERE trace_id IN ("
+            "  SELECT t.id FROM traces t JOIN traces cur ON cur.id = ? AND t.group_id = cur.group_id "
+            "  WHERE t.id != cur.id ORDER BY t.started_at DESC LIMIT 8"
+            ") AND span_type = 'generation' AND input IS NOT NULL ORDER BY ingest_id DESC LIMIT 1",
+            (trace_id,),
+        ).fetchone()
 
-        if isinstance(usage, dict):
-            usage = _normalize_usage(usage)
-        else:
-            usage = None
+    def _materialize_dependents(
+        self, conn: sqlite3.Connection, ingest_ids: list[int], exclude_trace_ids: list[str] | None = None
+    ) -> None:
+        # Before a delta base goes away, store its dependents' inputs in full. / 差分の基準が消える前に依存先を完全な値で保存する。
+        skip = set(exclude_trace_ids or ())
+        for ingest_id in ingest_ids:
+            dependents = conn.execute(
+                "SELECT ingest_id, trace_id, input FROM spans WHERE input_base_id = ?", (ingest_id,)
+            ).fetchall()
+            for dependent in dependents:
+                if dependent["trace_id"] in skip:
+                    continue
+                text = self._text.resolve(dependent["input"])
+                conn.execute(
+                    "UPDATE spans SET input = ?, input_base_id = NULL, input_depth = 0 WHERE ingest_id = ?",
+                    (encode_text(text, self._storage), dependent["ingest_id"]),
+                )
 
+    def purge(self, policy: RetentionPolicy | None = None) -> RetentionReport:
+        """Apply a retention policy now, one small batch per transaction. / 保持ポリシーを小さなバッチ単位で即時適用する。"""
+
+        policy = policy or self._retention
+        report = RetentionReport()
+        if policy is None:
+            return report
+        now = datetime.now(timezone.utc)
+        pages_before, _, page_size = self._run_write(_page_stats)
+        while True:
+            deleted = self._run_write(lambda conn: self._purge_batch(conn, policy, now))
+            if deleted is None:
+                break
+            report.deleted_traces += deleted[0]
+            report.deleted_spans += deleted[1]
+            report.deleted_blobs += deleted[2]
+        # Blobs orphaned by re-ingested spans. / 再取り込みで参照が無くなったblob。
+        while True:
+            swept = self._run_write(lambda conn: _sweep_orphan_blobs(conn, policy.batch_size))
+            report.deleted_blobs += swept
+            if swept < policy.batch_size:
+                break
+        # Return free pages to the OS a little at a time. / 空きページを少しずつOSへ返す。
+        while self._run_write(_incremental_vacuum_step):
+            pass
+        pages_after, free_pages, page_size = self._run_write(_page_stats)
+        report.reclaimed_bytes = max(0, pages_before - pages_after) * page_size
+        report.free_bytes = free_pages * page_size
+        self.last_retention_report = report
+        return report
+
+    def _run_write(self, job: Callable[[sqlite3.Connection], _T]) -> _T:
         conn = self._ensure_conn()
-        with conn:
-            # Ensure trace row exists even if we didn't see on_trace_start (interop). / trace startを見ていなくてもtrace行を作る。
-            self._upsert_trace(getattr(span, "_trace", None) or _TraceLike(trace_id=trace_id))
-            conn.execute(
-                """
-                INSERT OR REPLACE INTO spans(
-                  id, trace_id, parent_id, started_at, ended_at, span_type, name, ingest_seq, input, output,
-                  output_kind, tool_calls_json, structured_json, rubric_json, usage_json, error_json, raw_json
-                ) VALUES(
-                  ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(ingest_seq), 0) + 1 FROM spans WHERE trace_id = ?),
-                  ?, ?, ?, ?, ?, ?, ?, ?, ?
-                )
-                """,
-                (
-                    exported.get("id") or getattr(span, "span_id", None),
-                    trace_id,
-                    exported.get("parent_id"),
-                    exported.get("started_at"),
-                    exported.get("ended_at"),
-                    span_data.get("type"),
-                    span_name,
-                    trace_id,
-                    input_text,
-                    output_text,
-                    output_kind,
-                    json.dumps(tool_calls, ensure_ascii=False, default=str) if tool_calls is not None else None,
-                    json.dumps(structured, ensure_ascii=False, default=str) if structured is not None else None,
-                    json.dumps(rubric, ensure_ascii=False, default=str) if rubric is not None else None,
-                    json.dumps(usage, ensure_ascii=False, default=str) if usage is not None else None,
-                    json.dumps(exported.get("error"), ensure_ascii=False, default=str),
-                    json.dumps(exported, ensure_ascii=False, default=str),
-                ),
+        if self._writer is not None:
+            return self._writer.call(job)
+        with self._lock:
+            try:
+                with conn:
+                    return job(conn)
+            finally:
+                self._writes += 1
+
+    def _purge_batch(
+        self, conn: sqlite3.Connection, policy: RetentionPolicy, now: datetime
+    ) -> tuple[int, int, int] | None:
+        trace_ids = _purge_candidates(conn, policy, now)
+        if not trace_ids:
+            return None
+        return self._delete_traces(conn, trace_ids)
+
+    def _delete_traces(self, conn: sqlite3.Connection, trace_ids: list[str]) -> tuple[int, int, int]:
+        marks = ",".join("?" * len(trace_ids))
+        spans = conn.execute(
+            f"SELECT ingest_id, {_FTS_SOURCE_COLUMNS} FROM spans WHERE trace_id IN ({marks})", trace_ids
+        ).fetchall()
+        ingest_ids = [row["ingest_id"] for row in spans]
+        self._materialize_dependents(conn, ingest_ids, exclude_trace_ids=trace_ids)
+        if self._supports_fts5:
+            for row in spans:
+                self._delete_fts_entry(conn, row)
+        hashes: set[str] = set()
+        for chunk in _chunked(ingest_ids, _SQL_CHUNK):
+            id_marks = ",".join("?" * len(chunk))
+            hashes.update(
+                row[0] for row in conn.execute(f"SELECT hash FROM span_blobs WHERE ingest_id IN ({id_marks})", chunk)
             )
-            if usage:
-                self._update_trace_usage_cache(conn, trace_id, usage)
+            conn.execute(f"DELETE FROM span_blobs WHERE ingest_id IN ({id_marks})", chunk)
+        conn.execute(f"DELETE FROM spans WHERE trace_id IN ({marks})", trace_ids)
+        conn.execute(f"DELETE FROM traces WHERE id IN ({marks})", trace_ids)
+        deleted_blobs = 0
+        for chunk in _chunked(sorted(hashes), _SQL_CHUNK):
+            hash_marks = ",".join("?" * len(chunk))
+            deleted_blobs += conn.execute(
+                f"DELETE FROM blobs WHERE hash IN ({hash_marks}) "
+                "AND NOT EXISTS (SELECT 1 FROM span_blobs sb WHERE sb.hash = blobs.hash)",
+                chunk,
+            ).rowcount
+        return len(trace_ids), len(spans), deleted_blobs
 
     def capabilities(self) -> TraceSearchCapabilities:
+        self._ensure_conn()
         return TraceSearchCapabilities(
             supports_keywords=True,
             supports_has_tool_call=True,
             supports_metadata_query=bool(self._supports_json1),
             supports_limit=True,
             supports_since=True,
+            supports_full_text=bool(self._supports_fts5),
+            supports_cursor=True,
+            supports_rubric_score=True,
+            supports_trace_ids=True,
+            supports_aggregate=True,
+            supports_usage_rollups=True,
+            supports_watch=True,
+            span_predicate_fields=tuple(_span_predicate_fields(bool(self._supports_json1))),
+            trace_predicate_fields=tuple(_TRACE_PREDICATE_FIELDS),
         )
 
-    def search_traces(self, *, query: TraceQuery) -> list[TraceRecord]:
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        sql, params, order_column, order_key = self._trace_search_sql(query)
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_cursor = None
+        if order_key is not None and query.limit and len(rows) == query.limit:
+            next_cursor = _encode_cursor(order_key, [rows[-1][order_column], rows[-1]["id"]])
+        return SearchPage([_row_to_trace_record(row, query, self.default_tz) for row in rows], next_cursor)
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        sql, params, order_key = self._span_search_sql(query)
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_cursor = None
+        if order_key is not None and query.limit and len(rows) == query.limit:
+            next_cursor = _encode_cursor(order_key, [rows[-1]["ingest_seq"], rows[-1]["id"]])
+        return SearchPage([_row_to_span_record(row, query, self.default_tz) for row in rows], next_cursor)
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]:
+        """Stream matching traces in chunks. / 一致するTraceをチャンク単位で逐次返す。"""
+
+        sql, params, _, _ = self._trace_search_sql(query)
+        for row in self._iter_rows(sql, params, chunk_size):
+            yield _row_to_trace_record(row, query, self.default_tz)
+
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        """Stream matching spans in chunks. / 一致するSpanをチャンク単位で逐次返す。"""
+
+        sql, params, _ = self._span_search_sql(query)
+        for row in self._iter_rows(sql, params, chunk_size):
+            yield _row_to_span_record(row, query, self.default_tz)
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]:
+        """Stream spans of one trace in ingest order. / 1TraceのSpanを取り込み順に逐次返す。"""
+
+        sql = f"SELECT {_SPAN_COLUMNS} FROM spans WHERE trace_id = ? ORDER BY ingest_seq ASC"
+        for row in self._iter_rows(sql, [trace_id], chunk_size):
+            yield _row_to_span_record(row, None, self.default_tz)
+
+    def iter_trace_rows(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[sqlite3.Row]:
+        """Raw ``traces`` rows in search order, for merging partitions. / パーティション併合用に検索順のtraces行を返す。"""
+
+        sql, params, _, _ = self._trace_search_sql(query)
+        return self._iter_rows(sql, params, chunk_size)
+
+    def trace_time_bounds(self) -> tuple[datetime | None, datetime | None]:
+        """Latest stored trace start and end. / 保存済みTraceの最新の開始・終了時刻。"""
+
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT MAX(started_at) AS max_started, MAX(ended_at) AS max_ended FROM traces"
+            ).fetchone()
+        return _parse_dt(row["max_started"]), _parse_dt(row["max_ended"])
+
+    def _iter_rows(self, sql: str, params: list[Any], chunk_size: int) -> Iterator[sqlite3.Row]:
         conn = self._ensure_conn()
-        where, params = _build_trace_where(query, self.default_tz)
+        if self._readers is not None:
+            # One pooled reader for the iterator's lifetime. / イテレータの間は1つの読み取り接続を使う。
+            with self._readers.connection() as reader:
+                yield from _fetch_chunks(reader.execute(sql, params), chunk_size, None)
+            return
+        # Shared connection: lock per chunk so ingest is not blocked between chunks.
+        # / 共有接続: チャンクごとにロックし、チャンク間の取り込みを妨げない。
+        with self._lock:
+            cursor = conn.execute(sql, params)
+        yield from _fetch_chunks(cursor, chunk_size, self._lock)
+
+    def _trace_search_sql(self, query: TraceQuery) -> tuple[str, list[Any], str | None, str | None]:
+        # Feature detection (JSON1 / FTS5) happens on open. / JSON1・FTS5の検出は接続時に行う。
+        self._ensure_conn()
+        where, params = _build_trace_where(query, self.default_tz, fts=bool(self._supports_fts5))
         if query.metadata:
             if not self._supports_json1:
                 raise NotSupportedError("metadata query")
-            meta_where, meta_params = _build_metadata_where(query.metadata)
+            meta_where, meta_params = _build_metadata_where(query.metadata, self._metadata_columns)
             where.extend(meta_where)
             params.extend(meta_params)
-        sql = "SELECT id, workflow_name, group_id, metadata_json FROM traces"
-        if where:
-            sql += " WHERE " + " AND ".join(where)
-        sql += " ORDER BY id DESC"
-        if query.limit:
-            sql += " LIMIT ?"
-            params.append(query.limit)
-        rows = conn.execute(sql, params).fetchall()
-        records: list[TraceRecord] = []
-        for row in rows:
-            trace_id = row["id"]
-            started_at, ended_at = _trace_times(conn, trace_id)
-            records.append(
-                TraceRecord(
-                    trace_id=trace_id,
-                    workflow_name=row["workflow_name"] or "",
-                    group_id=row["group_id"],
-                    started_at=_return_dt(started_at, query, self.default_tz),
-                    ended_at=_return_dt(ended_at, query, self.default_tz),
-                    metadata=_json_or_none(row["metadata_json"]),
-                )
+        sql = f"SELECT {_TRACE_COLUMNS} FROM traces"
+        match = self._relevance_match(query)
+        if match is not None:
+            if query.cursor:
+                raise NotSupportedError("cursor with order_by=relevance")
+            # Best (lowest) bm25 rank over the trace's spans. / Trace内Spanの最良bm25順位。
+            sql += (
+                " LEFT JOIN (SELECT s.trace_id AS rel_trace_id, MIN(f.rank) AS rel_rank"
+                " FROM (SELECT rowid, rank FROM spans_fts WHERE spans_fts MATCH ?) f"
+                " JOIN spans s ON s.ingest_id = f.rowid GROUP BY s.trace_id) rel ON rel.rel_trace_id = traces.id"
             )
-        return records
-
-    def search_spans(self, *, query: SpanQuery) -> list[SpanRecord]:
-        conn = self._ensure_conn()
-        where, params = _build_span_where(query, self.default_tz)
-        sql = (
-            "SELECT id, trace_id, parent_id, span_type, name, started_at, ended_at, "
-            "COALESCE(ingest_seq, 0) AS ingest_seq, input, output, output_kind, tool_calls_json, structured_json, "
-            "rubric_json, usage_json, error_json, raw_json "
-            "FROM spans"
+            params.insert(0, match)
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY rel.rel_rank ASC, id DESC"
+            if query.limit:
+                sql += " LIMIT ?"
+                params.append(query.limit)
+            return sql, params, None, None
+
+        order_column, descending = _trace_order(query.order_by)
+        direction = "DESC" if descending else "ASC"
+        order_key = f"traces:{order_column}:{direction}"
+        segments: list[tuple[str, list[Any]]] = [("", [])]
+        if query.cursor:
+            segments = _keyset_after(order_column, descending, _decode_cursor(query.cursor, order_key))
+        parts: list[str] = []
+        part_params: list[Any] = []
+        for clause, clause_params in segments:
+            part_where = where + [clause] if clause else where
+            part = sql
+            if part_where:
+                part += " WHERE " + " AND ".join(part_where)
+            part += f" ORDER BY {order_column} {direction}, id {direction}"
+            part_params.extend(params)
+            part_params.extend(clause_params)
+            if query.limit:
+                part += " LIMIT ?"
+                part_params.append(query.limit)
+            parts.append(part)
+        if len(parts) == 1:
+            return parts[0], part_params, order_column, order_key
+        # Each segment is an index seek; the outer ORDER BY defines the page order (UNION ALL alone does not).
+        # / 各区間は索引シーク。ページの順序は外側のORDER BYで決める（UNION ALLだけでは保証されない）。
+        final_sql = " UNION ALL ".join(f"SELECT * FROM ({part})" for part in parts)
+        final_sql += f" ORDER BY {order_column} {direction}, id {direction}"
+        if query.limit:
+            final_sql += " LIMIT ?"
+            part_params.append(query.limit)
+        return final_sql, part_params, order_column, order_key
+
+    def _span_search_sql(self, query: SpanQuery) -> tuple[str, list[Any], str | None]:
+        # Feature detection (JSON1 / FTS5) happens on open. / JSON1・FTS5の検出は接続時に行う。
+        self._ensure_conn()
+        where, params = _build_span_where(
+            query, self.default_tz, fts=bool(self._supports_fts5), json1=bool(self._supports_json1)
         )
+        sql = f"SELECT {_span_select(query.fields)} FROM spans"
+        order = "ingest_seq ASC, id ASC"
+        if query.rubric_score_lt is not None or query.rubric_score_gte is not None:
+            # Score ranges are selective: seek idx_spans_rubric_score and sort, not scan in seq order.
+            # / スコア範囲は絞り込みが強いため、seq順の走査ではなくスコア索引を引いて並べ替える。
+            order = "+ingest_seq ASC, id ASC"
+        order_key: str | None = "spans:ingest_seq:ASC"
+        match = self._relevance_match(query)
+        if match is not None:
+            if query.cursor:
+                raise NotSupportedError("cursor with order_by=relevance")
+            sql += " JOIN (SELECT rowid AS rel_rowid, rank AS rel_rank FROM spans_fts WHERE spans_fts MATCH ?) rel"
+            sql += " ON rel.rel_rowid = spans.ingest_id"
+            params.insert(0, match)
+            order = "rel.rel_rank ASC, ingest_seq ASC, id ASC"
+            order_key = None
+        elif query.cursor:
+            # ingest_seq is never NULL, so a single index seek suffices. / ingest_seqはNULLにならない。
+            [(after, after_params)] = _keyset_after("ingest_seq", False, _decode_cursor(query.cursor, order_key))
+            where.append(after)
+            params.extend(after_params)
         if where:
             sql += " WHERE " + " AND ".join(where)
-        sql += " ORDER BY ingest_seq ASC"
+        sql += f" ORDER BY {order}"
         if query.limit:
             sql += " LIMIT ?"
             params.append(query.limit)
-        rows = conn.execute(sql, params).fetchall()
-        return [_row_to_span_record(row, query, self.default_tz) for row in rows]
+        return sql, params, order_key
+
+    def _relevance_match(self, query: TraceQuery | SpanQuery) -> str | None:
+        if query.order_by != "relevance":
+            if isinstance(query, SpanQuery) and query.order_by is not None:
+                raise NotSupportedError(f"order_by={query.order_by}")
+            return None
+        if not self._supports_fts5:
+            raise NotSupportedError("order_by=relevance (FTS5)")
+        indexed = _fts_keywords(query.keywords)
+        if not indexed:
+            return None
+        return " OR ".join(_fts_phrase(kw) for kw in indexed)
 
     def get_trace(self, trace_id: str) -> TraceRecord | None:
-        conn = self._ensure_conn()
-        row = conn.execute(
-            "SELECT id, workflow_name, group_id, metadata_json FROM traces WHERE id = ?",
-            (trace_id,),
-        ).fetchone()
+        with self._reader() as conn:
+            row = conn.execute(f"SELECT {_TRACE_COLUMNS} FROM traces WHERE id = ?", (trace_id,)).fetchone()
         if not row:
             return None
-        started_at, ended_at = _trace_times(conn, trace_id)
-        return TraceRecord(
-            trace_id=row["id"],
-            workflow_name=row["workflow_name"] or "",
-            group_id=row["group_id"],
-            started_at=_return_dt(started_at, None, self.default_tz),
-            ended_at=_return_dt(ended_at, None, self.default_tz),
-            metadata=_json_or_none(row["metadata_json"]),
-        )
+        return _row_to_trace_record(row, None, self.default_tz)
 
     def get_span(self, span_id: str) -> SpanRecord | None:
-        conn = self._ensure_conn()
-        row = conn.execute(
-            "SELECT id, trace_id, parent_id, span_type, name, started_at, ended_at, "
-            "COALESCE(ingest_seq, 0) AS ingest_seq, input, output, output_kind, tool_calls_json, structured_json, "
-            "rubric_json, usage_json, error_json, raw_json "
-            "FROM spans WHERE id = ?",
-            (span_id,),
-        ).fetchone()
+        with self._reader() as conn:
+            row = conn.execute(
+                f"SELECT {_SPAN_COLUMNS} "
+                "FROM spans WHERE id = ?",
+                (span_id,),
+            ).fetchone()
         if not row:
             return None
         return _row_to_span_record(row, None, self.default_tz)
 
     def get_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
-        conn = self._ensure_conn()
-        rows = conn.execute(
-            "SELECT id, trace_id, parent_id, span_type, name, started_at, ended_at, "
-            "COALESCE(ingest_seq, 0) AS ingest_seq, input, output, output_kind, tool_calls_json, structured_json, "
-            "rubric_json, usage_json, error_json, raw_json "
-            "FROM spans WHERE trace_id = ? ORDER BY ingest_seq ASC",
-            (trace_id,),
-        ).fetchall()
-        return [_row_to_span_record(row, None, self.default_tz) for row in rows]
+        return list(self.iter_spans_by_trace(trace_id))
 
     def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
-        conn = self._ensure_conn()
         since_value = since_seq or 0
-        rows = conn.execute(
-            "SELECT id, trace_id, parent_id, span_type, name, started_at, ended_at, "
-            "COALESCE(ingest_seq, 0) AS ingest_seq, input, output, output_kind, tool_calls_json, structured_json, "
-            "rubric_json, usage_json, error_json, raw_json "
-            "FROM spans WHERE trace_id = ? AND COALESCE(ingest_seq, 0) > ? "
-            "ORDER BY ingest_seq ASC",
-            (trace_id, since_value),
-        ).fetchall()
+        with self._reader() as conn:
+            rows = conn.execute(
+                f"SELECT {_SPAN_COLUMNS} "
+                "FROM spans WHERE trace_id = ? AND ingest_seq > ? "
+                "ORDER BY ingest_seq ASC",
+                (trace_id, since_value),
+            ).fetchall()
+        return [_row_to_span_record(row, None, self.default_tz) for row in rows]
+
+    def watch_spans(
+        self,
+        *,
+        trace_id: str | None = None,
+        group_id: str | None = None,
+        workflow_name: str | None = None,
+        since_seq: int | None = None,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 2.0,
+        timeout: float | None = None,
+    ) -> Iterator[SpanRecord]:
+        """Yield spans as they are ingested (live tail). / 取り込まれたSpanを順に返す（ライブ追跡）。
+
+        Starts after the spans already stored (or after ``since_seq`` within ``trace_id``). Commits from this
+        tracer wake the watcher immediately; commits from other processes are seen by polling
+        ``data_version()``, backing off from ``poll_interval`` to ``max_poll_interval`` while idle. Ends after
+        ``timeout`` seconds without new spans (``None`` = never). / 保存済みSpanの後（``trace_id`` 指定時は
+        ``since_seq`` の後）から始める。このトレーサーのコミットで即座に起き、他プロセスのコミットは
+        ``data_version()`` のポーリング（待機中は ``poll_interval`` から ``max_poll_interval`` まで間隔を延ばす）
+        で検知する。``timeout`` 秒新しいSpanが無ければ終了する（``None`` は無期限）。
+        """
+
+        watch = self._watch_open(trace_id, group_id, workflow_name, since_seq)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = poll_interval
+        while True:
+            seen = self._ingest.count()
+            records = self._watch_step(watch)
+            if records:
+                yield from records
+                interval = poll_interval
+                if deadline is not None:
+                    deadline = time.monotonic() + timeout
+                continue
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            woke = self._ingest.wait(seen, interval if remaining is None else min(interval, remaining))
+            interval = poll_interval if woke else min(interval * 2, max_poll_interval)
+
+    async def awatch_spans(
+        self,
+        *,
+        trace_id: str | None = None,
+        group_id: str | None = None,
+        workflow_name: str | None = None,
+        since_seq: int | None = None,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 2.0,
+        timeout: float | None = None,
+    ) -> AsyncIterator[SpanRecord]:
+        """Async watch_spans; queries run on a reader thread. / 読み取りスレッドで問い合わせるwatch_spans。"""
+
+        watch = await self._run_async(lambda: self._watch_open(trace_id, group_id, workflow_name, since_seq))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = poll_interval
+        while True:
+            seen = self._ingest.count()
+            records = await self._run_async(lambda: self._watch_step(watch))
+            if records:
+                for record in records:
+                    yield record
+                interval = poll_interval
+                if deadline is not None:
+                    deadline = time.monotonic() + timeout
+                continue
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            woke = await self._ingest.await_change(seen, interval if remaining is None else min(interval, remaining))
+            interval = poll_interval if woke else min(interval * 2, max_poll_interval)
+
+    def _watch_open(
+        self, trace_id: str | None, group_id: str | None, workflow_name: str | None, since_seq: int | None
+    ) -> _Watch:
+        if since_seq is not None and trace_id is None:
+            raise NotSupportedError("since_seq without trace_id")
+        where: list[str] = []
+        params: list[Any] = []
+        if trace_id is not None:
+            where.append("trace_id = ?")
+            params.append(trace_id)
+        for column, value in (("group_id", group_id), ("workflow_name", workflow_name)):
+            if value is not None:
+                where.append(f"trace_id IN (SELECT id FROM traces WHERE {column} = ?)")
+                params.append(value)
+        with self._reader() as conn:
+            cursor = conn.execute("SELECT value FROM counters WHERE name = 'ingest_id'").fetchone()[0]
+        return _Watch(where, params, cursor, since_seq)
+
+    def _watch_step(self, watch: _Watch) -> list[SpanRecord]:
+        # ingest_id grows with every committed write, so it is a global cursor across traces.
+        # / ingest_idはコミットごとに増えるため、Traceをまたぐカーソルに使える。
+        version = self.data_version()
+        if version == watch.version:
+            return []
+        where = list(watch.where)
+        params = list(watch.params)
+        if watch.since_seq is not None:
+            # Backlog of the watched trace first, in ingest_seq order. / まず対象Traceの既存分をingest_seq順に返す。
+            where += ["ingest_seq > ?", "ingest_id <= ?"]
+            params += [watch.since_seq, watch.cursor]
+            order = "ingest_seq"
+        else:
+            where.append("ingest_id > ?")
+            params.append(watch.cursor)
+            order = "ingest_id"
+        sql = f"SELECT ingest_id AS watch_id, {_SPAN_COLUMNS} FROM spans WHERE {' AND '.join(where)} ORDER BY {order}"
+        with self._reader() as conn:
+            rows = conn.execute(sql + " LIMIT ?", [*params, _WATCH_CHUNK]).fetchall()
+        if watch.since_seq is not None:
+            watch.since_seq = rows[-1]["ingest_seq"] if len(rows) == _WATCH_CHUNK else None
+        elif rows:
+            watch.cursor = rows[-1]["watch_id"]
+        # A full chunk may have more behind it: query again without waiting. / 上限まで返したら待たずに再取得する。
+        watch.version = None if len(rows) == _WATCH_CHUNK or watch.since_seq is not None else version
         return [_row_to_span_record(row, None, self.default_tz) for row in rows]
 
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        """Grouped span measures computed in SQL. / Spanの集計をSQLで計算する。"""
+
+        dimensions, measures = _aggregate_names(query)
+        self._ensure_conn()
+        if not self._supports_json1 and any(name in _AGGREGATE_JSON1 for name in dimensions + measures):
+            raise NotSupportedError("aggregate (JSON1)")
+        where, params = _build_span_where(
+            query.spans or SpanQuery(), self.default_tz, fts=bool(self._supports_fts5), json1=bool(self._supports_json1)
+        )
+        if query.workflow_name is not None:
+            where.append("trace_id IN (SELECT id FROM traces WHERE workflow_name = ?)")
+            params.append(query.workflow_name)
+        select = [f'{_AGGREGATE_DIMENSIONS[name]} AS "{name}"' for name in dimensions]
+        select += [f'{_AGGREGATE_MEASURES[name]} AS "{name}"' for name in measures]
+        sql = f"SELECT {', '.join(select)} FROM spans"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if dimensions:
+            sql += " GROUP BY " + ", ".join(f'"{name}"' for name in dimensions)
+        order = [f'"{name}" ASC' for name in dimensions]
+        if query.order_by:
+            name, descending = _aggregate_order(query.order_by, dimensions, measures)
+            order.insert(0, f'"{name}" {"DESC" if descending else "ASC"}')
+        if order:
+            sql += " ORDER BY " + ", ".join(order)
+        if query.limit:
+            sql += " LIMIT ?"
+            params.append(query.limit)
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            AggregateRow({name: row[name] for name in dimensions}, {name: row[name] for name in measures})
+            for row in rows
+        ]
+
+    def usage_rollups(self, *, query: UsageQuery) -> list[UsageRow]:
+        """Token usage from the hourly rollup table. / 1時間単位の集計表からトークン使用量を返す。
+
+        Reads the small ``usage_rollups`` table maintained at ingest, not spans. Retention purges leave it
+        untouched. / 取り込み時に更新する ``usage_rollups`` を読み、spansは走査しない。保持ポリシーの削除は
+        集計表に影響しない。
+        """
+
+        dimensions = list(query.group_by or [])
+        for name in dimensions:
+            if name not in _USAGE_DIMENSIONS:
+                raise NotSupportedError(f"usage group_by {name!r}")
+        self._ensure_conn()
+        where: list[str] = []
+        params: list[Any] = []
+        for column in ("provider", "model", "workflow_name"):
+            value = getattr(query, column)
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if query.started_from is not None:
+            where.append("bucket >= ?")
+            params.append(_usage_bucket(_epoch_us(_normalize_query_dt(query.started_from, self.default_tz))))
+        if query.started_to is not None:
+            where.append("bucket <= ?")
+            params.append(_usage_bucket(_epoch_us(_normalize_query_dt(query.started_to, self.default_tz))))
+        select = [f'{_USAGE_DIMENSIONS[name]} AS "{name}"' for name in dimensions]
+        select += [f"SUM({name}) AS {name}" for name in _USAGE_VALUES]
+        sql = f"SELECT {', '.join(select)} FROM usage_rollups"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if dimensions:
+            grouped = ", ".join(f'"{name}"' for name in dimensions)
+            sql += f" GROUP BY {grouped} ORDER BY {grouped}"
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            UsageRow({name: row[name] for name in dimensions}, **{name: row[name] or 0 for name in _USAGE_VALUES})
+            for row in rows
+            if row["requests"]
+        ]
+
+    async def asearch_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]:
+        """Async search_traces on a reader thread. / 読み取りスレッドで実行するsearch_traces。"""
+
+        return await self._run_async(lambda: self.search_traces(query=query))
+
+    async def asearch_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]:
+        """Async search_spans on a reader thread. / 読み取りスレッドで実行するsearch_spans。"""
+
+        return await self._run_async(lambda: self.search_spans(query=query))
+
+    async def aiter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> AsyncIterator[TraceRecord]:
+        """Async iter_traces, one chunk per thread hop. / チャンク単位でスレッドから受け取るiter_traces。"""
+
+        async for record in self._aiter(self.iter_traces(query=query, chunk_size=chunk_size), chunk_size):
+            yield record
+
+    async def aiter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> AsyncIterator[SpanRecord]:
+        """Async iter_spans, one chunk per thread hop. / チャンク単位でスレッドから受け取るiter_spans。"""
+
+        async for record in self._aiter(self.iter_spans(query=query, chunk_size=chunk_size), chunk_size):
+            yield record
+
+    async def aget_trace(self, trace_id: str) -> TraceRecord | None:
+        return await self._run_async(lambda: self.get_trace(trace_id))
+
+    async def aget_span(self, span_id: str) -> SpanRecord | None:
+        return await self._run_async(lambda: self.get_span(span_id))
+
+    async def aget_spans_by_trace(self, trace_id: str) -> list[SpanRecord]:
+        return await self._run_async(lambda: self.get_spans_by_trace(trace_id))
+
+    async def aget_spans_since(self, trace_id: str, since_seq: int | None = None) -> list[SpanRecord]:
+        return await self._run_async(lambda: self.get_spans_since(trace_id, since_seq))
+
+    async def aaggregate(self, *, query: AggregateQuery) -> list[AggregateRow]:
+        return await self._run_async(lambda: self.aggregate(query=query))
+
+    async def ausage_rollups(self, *, query: UsageQuery) -> list[UsageRow]:
+        return await self._run_async(lambda: self.usage_rollups(query=query))
+
+    async def _run_async(self, fn: Callable[[], _T]) -> _T:
+        # Cancelling the awaiting task interrupts the running query. / 待機側のキャンセルで実行中のクエリを中断する。
+        call = _AsyncCall()
+
+        def run() -> _T:
+            self._active.call = call
+            try:
+                return fn()
+            finally:
+                self._active.call = None
+
+        future = self._async_executor().submit(run)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancel():
+                call.interrupt()
+            raise
+
+    async def _aiter(self, records: Iterator[_T], chunk_size: int) -> AsyncIterator[_T]:
+        # The guard keeps close() from racing a _take still running on a reader thread after cancellation.
+        # / キャンセル後も読み取りスレッドで実行中の_takeとclose()が競合しないよう排他する。
+        guard = threading.Lock()
+
+        def take() -> list[_T]:
+            with guard:
+                return _take(records, chunk_size)
+
+        def close() -> None:
+            with guard:
+                records.close()
+
+        try:
+            while True:
+                chunk = await self._run_async(take)
+                if not chunk:
+                    return
+                for record in chunk:
+                    yield record
+        finally:
+            # Close on a reader thread, after any in-flight take. / 実行中のtakeの後に読み取りスレッドで閉じる。
+            try:
+                future = self._async_executor().submit(close)
+            except RuntimeError:
+                # No new threads (interpreter shutdown); nothing else is running. / スレッドを起動できない（終了処理中）。
+                close()
+            else:
+                await asyncio.shield(asyncio.wrap_future(future))
+
+    def _async_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, self._reader_pool_size), thread_name_prefix="kantan-llm-sqlite-reader"
+                )
+            return self._executor
+
     def shutdown(self) -> None:
-        if self._conn is not None:
-            self._conn.close()
-            self._conn = None
+        # Stop helper threads outside the lock; they may be waiting for it. / 補助スレッドはロック外で止める（ロック待ちの可能性）。
+        with self._lock:
+            compactor, self._compactor = self._compactor, None
+            executor, self._executor = self._executor, None
+        if compactor is not None:
+            compactor.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._readers is not None:
+                self._readers.close()
+                self._readers = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        with self._version_lock:
+            if self._version_conn is not None:
+                self._version_conn.close()
+                self._version_conn = None
 
     def force_flush(self) -> None:
-        if self._conn is not None:
-            self._conn.commit()
+        """Wait until queued writes are committed. / キュー済みの書き込みがコミットされるまで待つ。
+
+        In concurrent mode, raises the error of any batch that failed to commit since the last flush.
+        / 並行モードでは、前回のflush以降にコミットできなかったバッチの例外を送出する。
+        """
+
+        writer = self._writer
+        if writer is not None:
+            writer.flush()
+            return
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+
+class _SQLiteWriter:
+    """Single thread that owns the write connection. / 書き込み接続を専有する単一スレッド。"""
+
+    def __init__(
+        self, conn: sqlite3.Connection, batch_size: int = 256, on_commit: Callable[[], None] | None = None
+    ) -> None:
+        self._conn = conn
+        self._batch_size = batch_size
+        self._on_commit = on_commit
+        self._queue: queue.Queue[Any] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="kantan-llm-sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, job: Callable[[sqlite3.Connection], None]) -> None:
+        self._queue.put(job)
+
+    def flush(self) -> None:
+        """Wait until queued jobs are committed; raises if a commit failed since the last flush.
+        / キュー済みジョブのコミットを待つ。前回のflush以降にコミットが失敗していれば例外を送出する。"""
+
+        waiter = _WriteWaiter()
+        self._queue.put(waiter)
+        waiter.wait()
+
+    def call(self, fn: Callable[[sqlite3.Connection], _T]) -> _T:
+        """Run ``fn`` on the writer and return its result once committed. / 書き込みスレッドで ``fn`` を実行し、コミット後に結果を返す。"""
+
+        job = _CallJob(fn)
+        self._queue.put(job)
+        job.waiter.wait()
+        if "error" in job.box:
+            raise job.box["error"]
+        return job.box["result"]
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        # A failed commit is reported to the next flush() so dropped spans never go unnoticed.
+        # / コミットの失敗は次のflush()へ伝え、失われたSpanを見逃さない。
+        failed: BaseException | None = None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            jobs: list[Callable[[sqlite3.Connection], None]] = []
+            for item in batch:
+                if callable(item):
+                    jobs.append(item)
+                    continue
+                failed = self._commit(jobs) or failed
+                jobs = []
+                if item is None:
+                    return
+                item.finish(failed)
+                failed = None
+            failed = self._commit(jobs) or failed
+
+    def _commit(self, jobs: list[Callable[[sqlite3.Connection], None]]) -> BaseException | None:
+        # One transaction per batch; a savepoint keeps each job atomic. / バッチで1トランザクション、ジョブ単位はsavepointで原子的に。
+        if not jobs:
+            return None
+        error: BaseException | None = None
+        for attempt in range(_WRITE_RETRIES + 1):
+            try:
+                self._apply(jobs)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                # Only lock contention is worth retrying; the jobs rerun from scratch. / 再試行はロック競合のみ。ジョブは最初から再実行する。
+                if attempt == _WRITE_RETRIES or not _is_busy(e):
+                    break
+                time.sleep(_WRITE_BACKOFF * 2**attempt)
+        if error is not None:
+            _logger.error("SQLiteTracer dropped a batch of %d write jobs: %s", len(jobs), error)
+        for job in jobs:
+            if isinstance(job, _CallJob):
+                job.waiter.finish(error)
+        if error is None and self._on_commit is not None:
+            self._on_commit()
+        return error
+
+    def _apply(self, jobs: list[Callable[[sqlite3.Connection], None]]) -> None:
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        for job in jobs:
+            conn.execute("SAVEPOINT kantan_job")
+            try:
+                job(conn)
+            except Exception:
+                # Non-fatal like the other processors. / 他のProcessorと同じく非致命。
+                conn.execute("ROLLBACK TO kantan_job")
+            conn.execute("RELEASE kantan_job")
+        conn.execute("COMMIT")
+
+
+class _WriteWaiter:
+    """Completion of queued writes, carrying the commit error if any. / キュー済み書き込みの完了（失敗時はその例外）を伝える。"""
+
+    def __init__(self) -> None:
+        self._done = threading.Event()
+        self._error: BaseException | None = None
+
+    def finish(self, error: BaseException | None) -> None:
+        self._error = error
+        self._done.set()
+
+    def wait(self) -> None:
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+
+
+class _CallJob:
+    """Writer job whose result is handed back after commit. / コミット後に結果を返す書き込みジョブ。"""
+
+    def __init__(self, fn: Callable[[sqlite3.Connection], Any]) -> None:
+        self.fn = fn
+        self.box: dict[str, Any] = {}
+        self.waiter = _WriteWaiter()
+
+    def __call__(self, conn: sqlite3.Connection) -> None:
+        # A retried batch reruns the job, so start from an empty box. / 再試行では再実行されるため結果を入れ直す。
+        self.box.clear()
+        try:
+            self.box["result"] = self.fn(conn)
+        except BaseException as e:
+            self.box["error"] = e
+            raise
+
+
+def _is_busy(error: Exception) -> bool:
+    # SQLITE_BUSY / SQLITE_LOCKED surface as OperationalError. / ロック競合はOperationalErrorとして届く。
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+class _SQLiteCompactor:
+    """Background thread applying a retention policy. / 保持ポリシーを定期適用するスレッド。"""
+
+    def __init__(self, tracer: SQLiteTracer, policy: RetentionPolicy) -> None:
+        self._tracer = tracer
+        self._policy = policy
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kantan-llm-sqlite-compactor", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._policy.interval.total_seconds()):
+            try:
+                self._tracer.purge(self._policy)
+            except Exception:
+                # Non-fatal; retried on the next interval. / 非致命。次の周期で再試行する。
+                continue
+
+
+def _purge_candidates(conn: sqlite3.Connection, policy: RetentionPolicy, now: datetime) -> list[str]:
+    # Ages compare epoch microseconds, so mixed UTC offsets and precisions order correctly.
+    # / 経過時間はエポックマイクロ秒で比較し、UTCオフセットや精度の違いに左右されない。
+    judged = "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id AND s.rubric_json IS NOT NULL)"
+    if policy.max_age is not None:
+        where = [f"{_TRACE_AGE_SQL} < ?"]
+        params: list[Any] = [_epoch_us(now - policy.max_age)]
+        if policy.error_max_age is not None:
+            where.append(f"(error_count = 0 OR {_TRACE_AGE_SQL} < ?)")
+            params.append(_epoch_us(now - policy.error_max_age))
+        if policy.keep_judged:
+            where.append(f"NOT {judged}")
+        rows = conn.execute(
+            f"SELECT id FROM traces WHERE {' AND '.join(where)} ORDER BY {_TRACE_AGE_SQL} LIMIT ?",
+            [*params, policy.batch_size],
+        ).fetchall()
+        if rows:
+            return [row[0] for row in rows]
+    if policy.max_bytes is not None:
+        page_count, free_pages, page_size = _page_stats(conn)
+        if (page_count - free_pages) * page_size <= policy.max_bytes:
+            return []
+        # Oldest first; protected traces go last. / 古い順、保護対象は最後。
+        protected = []
+        if policy.error_max_age is not None:
+            protected.append("error_count > 0")
+        if policy.keep_judged:
+            protected.append(judged)
+        order = f"{_TRACE_AGE_SQL} ASC"
+        if protected:
+            order = f"({' OR '.join(protected)}) ASC, {order}"
+        rows = conn.execute(f"SELECT id FROM traces ORDER BY {order} LIMIT ?", (policy.batch_size,)).fetchall()
+        return [row[0] for row in rows]
+    return []
+
+
+def _sweep_orphan_blobs(conn: sqlite3.Connection, limit: int) -> int:
+    return conn.execute(
+        "DELETE FROM blobs WHERE hash IN (SELECT hash FROM blobs b "
+        "WHERE NOT EXISTS (SELECT 1 FROM span_blobs sb WHERE sb.hash = b.hash) LIMIT ?)",
+        (limit,),
+    ).rowcount
+
+
+def _page_stats(conn: sqlite3.Connection) -> tuple[int, int, int]:
+    return (
+        conn.execute("PRAGMA page_count").fetchone()[0],
+        conn.execute("PRAGMA freelist_count").fetchone()[0],
+        conn.execute("PRAGMA page_size").fetchone()[0],
+    )
+
+
+def _incremental_vacuum_step(conn: sqlite3.Connection) -> bool:
+    # No-op unless auto_vacuum=INCREMENTAL. / auto_vacuum=INCREMENTALのときだけ有効。
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2 or not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+        return False
+    conn.execute(f"PRAGMA incremental_vacuum({_VACUUM_PAGES})").fetchall()
+    return True
+
+
+def _chunked(items: list[Any], size: int) -> Iterator[list[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class _Watch:
+    """State of one watch_spans call. / watch_spans 1回分の状態。"""
+
+    def __init__(self, where: list[str], params: list[Any], cursor: int, since_seq: int | None) -> None:
+        self.where = where
+        self.params = params
+        self.cursor = cursor
+        self.since_seq = since_seq
+        self.version: Any = None
+
+
+class _IngestSignal:
+    """Wakes in-process watchers after each commit. / コミットごとに同一プロセス内の監視側を起こす。"""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._count = 0
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def notify(self) -> None:
+        with self._cond:
+            self._count += 1
+            self._cond.notify_all()
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The watcher's loop is already closed. / 監視側のループは終了済み。
+                pass
+
+    def count(self) -> int:
+        with self._cond:
+            return self._count
+
+    def wait(self, seen: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._count != seen, timeout)
+
+    async def await_change(self, seen: int, timeout: float) -> bool:
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._cond:
+            if self._count != seen:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+
+
+class _AsyncCall:
+    """Connection in use by one async call, for interruption. / 中断用に1回の非同期呼び出しが使う接続を保持する。"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._cancelled = False
+
+    def attach(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if self._cancelled:
+                raise sqlite3.OperationalError("interrupted")
+            self._conn = conn
+
+    def detach(self) -> None:
+        with self._lock:
+            self._conn = None
+
+    def interrupt(self) -> None:
+        # Only while attached, so a connection reused by others is never interrupted.
+        # / 接続中の間だけ中断し、他で再利用された接続は中断しない。
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+
+class _SQLiteReaderPool:
+    """Pool of read-only connections. / 読み取り専用接続のプール。"""
+
+    def __init__(self, path: str, size: int, mmap_size: int) -> None:
+        self._uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self._size = max(1, size)
+        self._mmap_size = int(mmap_size)
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._opened: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._opened) < self._size:
+                conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                _register_functions(conn)
+                conn.execute(f"PRAGMA mmap_size = {self._mmap_size}")
+                self._opened.append(conn)
+                return conn
+        return self._idle.get()
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened.clear()
+
+
+def _fetch_chunks(cursor: sqlite3.Cursor, chunk_size: int, lock: threading.RLock | None) -> Iterator[sqlite3.Row]:
+    try:
+        while True:
+            if lock is None:
+                rows = cursor.fetchmany(chunk_size)
+            else:
+                with lock:
+                    rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def _take(records: Iterator[_T], count: int) -> list[_T]:
+    return list(itertools.islice(records, count))
+
+
+def _trace_values(trace) -> tuple[Any, ...] | None:
+    exported = getattr(trace, "export", lambda: None)()
+    if not exported:
+        return None
+    return _trace_export_values(exported, getattr(trace, "trace_id", None), getattr(trace, "name", None))
+
+
+def _trace_export_values(exported: dict[str, Any], trace_id: str | None = None, name: str | None = None) -> tuple[Any, ...]:
+    return (
+        exported.get("id") or trace_id,
+        exported.get("workflow_name") or name,
+        exported.get("group_id"),
+        json.dumps(exported.get("metadata"), ensure_ascii=False, default=str),
+    )
+
+
+def _span_columns(
+    exported: dict[str, Any], span_id: str | None = None, trace_id: str | None = None
+) -> dict[str, Any] | None:
+    # Plain (unencoded) spans column values for one exported span. / エクスポートしたSpanのspans列の値（非圧縮）。
+    trace_id = exported.get("trace_id") or trace_id
+    if trace_id is None:
+        return None
+
+    span_data = exported.get("span_data") or {}
+    span_usage = exported.get("usage")
+    raw_in = span_data.get("input")
+    raw_out = span_data.get("output_raw", span_data.get("output"))
+    usage = span_usage or _extract_usage(span_data)
+
+    input_text = sanitize_text(_to_text(raw_in)) if raw_in is not None else None
+    output_text = sanitize_text(_to_text(span_data.get("output"))) if span_data.get("output") is not None else None
+    output_kind, tool_calls, structured, rubric = _extract_output_parts(span_data, raw_out)
+
+    if isinstance(usage, dict):
+        usage = _normalize_usage(usage)
+    else:
+        usage = None
+
+    tool_calls_json = json.dumps(tool_calls, ensure_ascii=False, default=str) if tool_calls is not None else None
+    structured_json = json.dumps(structured, ensure_ascii=False, default=str) if structured is not None else None
+    raw_json = json.dumps(exported, ensure_ascii=False, default=str)
+    started_at = exported.get("started_at")
+    ended_at = exported.get("ended_at")
+    return {
+        "id": exported.get("id") or span_id,
+        "trace_id": trace_id,
+        "parent_id": exported.get("parent_id"),
+        "started_at": started_at,
+        "ended_at": ended_at,
+        "span_type": span_data.get("type"),
+        "name": span_data.get("name"),
+        "input": input_text,
+        "output": output_text,
+        "output_kind": output_kind,
+        "tool_calls_json": tool_calls_json,
+        "structured_json": structured_json,
+        "rubric_json": json.dumps(rubric, ensure_ascii=False, default=str) if rubric is not None else None,
+        "rubric_score": _rubric_score(rubric),
+        "usage": usage,
+        "usage_json": json.dumps(usage, ensure_ascii=False, default=str) if usage is not None else None,
+        "error_json": json.dumps(exported.get("error"), ensure_ascii=False, default=str),
+        "raw_json": raw_json,
+        "has_error": exported.get("error") is not None,
+        "has_tool_call": _has_tool_call(tool_calls_json, raw_json),
+        **dict(zip(("started_at_us", "ended_at_us", "duration_ms"), _span_times(started_at, ended_at))),
+        **_model_columns(exported),
+    }
+
+
+def _model_columns(exported: dict[str, Any]) -> dict[str, str | None]:
+    # Generation span data first, then the wrapper's error payload. / generationのspan_data、なければエラー情報から。
+    span_data = exported.get("span_data") or {}
+    error = exported.get("error")
+    data = error.get("data") if isinstance(error, dict) else None
+    data = data if isinstance(data, dict) else {}
+    context = data.get("llm_context") if isinstance(data.get("llm_context"), dict) else {}
+    values = {
+        "model": span_data.get("model") or context.get("model"),
+        "provider": span_data.get("provider") or context.get("provider"),
+        "api_kind": span_data.get("api_kind") or data.get("api_kind"),
+    }
+    return {key: value if isinstance(value, str) and value else None for key, value in values.items()}
+
+
+def _span_times(started_at: str | None, ended_at: str | None) -> tuple[int | None, int | None, int | None]:
+    # (started_at_us, ended_at_us, duration_ms) from ISO strings. / ISO文字列からエポックマイクロ秒と所要時間を求める。
+    start = _parse_dt(started_at)
+    end = _parse_dt(ended_at)
+    start_us = _epoch_us(start) if start else None
+    end_us = _epoch_us(end) if end else None
+    duration = round((end_us - start_us) / 1000) if start_us is not None and end_us is not None else None
+    return start_us, end_us, duration
+
+
+def _epoch_us(value: datetime) -> int:
+    # Naive values are UTC, like time_iso output. / naiveはUTCとみなす（time_isoの出力と同じ）。
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _is_memory_path(path: str) -> bool:
+    return path == ":memory:" or path.startswith("file::memory:") or "mode=memory" in path
 
 
 class _TraceLike:
@@ -583,6 +2179,30 @@ def _normalize_usage(usage: dict[str, Any]) -> dict[str, Any]:
     return normalized
 
 
+def _rubric_score(rubric: Any) -> float | None:
+    score = rubric.get("score") if isinstance(rubric, dict) else None
+    if isinstance(score, (int, float)) and not isinstance(score, bool):
+        return float(score)
+    return None
+
+
+def _rubric_bucket(rubric: Any) -> str | None:
+    # First tag, else the first word of the comment. / 先頭のタグ、なければコメントの最初の語。
+    if not isinstance(rubric, dict):
+        return None
+    tags = rubric.get("tags")
+    if isinstance(tags, list) and tags:
+        first = tags[0]
+        if isinstance(first, str) and first:
+            return first
+    comment = rubric.get("comment")
+    if isinstance(comment, str):
+        token = comment.strip().split(" ", 1)[0]
+        if token:
+            return token
+    return "other"
+
+
 def _extract_rubric_from_output(output: Any) -> dict[str, Any] | None:
     if output is None:
         return None
@@ -649,9 +2269,13 @@ def _normalize_query_dt(value: datetime | None, default_tz) -> datetime | None:
     return value.astimezone(timezone.utc)
 
 
-def _build_trace_where(query: TraceQuery, default_tz) -> tuple[list[str], list[Any]]:
+def _build_trace_where(query: TraceQuery, default_tz, fts: bool = False) -> tuple[list[str], list[Any]]:
     where: list[str] = []
     params: list[Any] = []
+    if query.where is not None:
+        sql, predicate_params = _build_predicate(query.where, _TRACE_PREDICATE_FIELDS)
+        where.append(sql)
+        params.extend(predicate_params)
     if query.trace_id:
         where.append("id = ?")
         params.append(query.trace_id)
@@ -661,73 +2285,218 @@ def _build_trace_where(query: TraceQuery, default_tz) -> tuple[list[str], list[A
     if query.group_id:
         where.append("group_id = ?")
         params.append(query.group_id)
-    # keywords on spans input/output (AND over keywords)
+    # keywords on spans input/output/tool args (AND over keywords)
     if query.keywords:
+        indexed = _fts_keywords(query.keywords) if fts else []
+        for kw in indexed:
+            where.append(
+                "id IN (SELECT s.trace_id FROM spans s "
+                "WHERE s.ingest_id IN (SELECT rowid FROM spans_fts WHERE spans_fts MATCH ?))"
+            )
+            params.append(_fts_phrase(kw))
         for kw in query.keywords:
+            if kw in indexed:
+                continue
             where.append(
-                "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id "
-                "AND (LOWER(COALESCE(s.input,'')) LIKE ? OR LOWER(COALESCE(s.output,'')) LIKE ?))"
+                "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id AND "
+                + _keyword_like_clause("s.")
+                + ")"
             )
             like = f"%{kw.lower()}%"
-            params.extend([like, like])
+            params.extend([like, like, like])
     if query.has_error is True:
-        where.append(
-            "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id "
-            "AND s.error_json IS NOT NULL AND s.error_json != 'null')"
-        )
+        where.append("error_count > 0")
     if query.has_error is False:
-        where.append(
-            "NOT EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id "
-            "AND s.error_json IS NOT NULL AND s.error_json != 'null')"
-        )
+        where.append("error_count = 0")
     if query.has_tool_call is True:
-        where.append(
-            "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id "
-            "AND (s.tool_calls_json IS NOT NULL "
-            "OR s.raw_json LIKE '%tool_calls%' OR s.raw_json LIKE '%function_call%'))"
-        )
+        where.append("tool_call_count > 0")
     if query.has_tool_call is False:
-        where.append(
-            "NOT EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id "
-            "AND (s.tool_calls_json IS NOT NULL "
-            "OR s.raw_json LIKE '%tool_calls%' OR s.raw_json LIKE '%function_call%'))"
-        )
+        where.append("tool_call_count = 0")
+    # A trace matches when any of its spans starts in the range. / 範囲内に開始したSpanを1つでも持つTraceが一致する。
     started_from = _normalize_query_dt(query.started_from, default_tz=default_tz)
     started_to = _normalize_query_dt(query.started_to, default_tz=default_tz)
     if started_from or started_to:
         clause = "EXISTS (SELECT 1 FROM spans s WHERE s.trace_id = traces.id"
         if started_from:
-            clause += " AND s.started_at >= ?"
-            params.append(started_from.isoformat())
+            clause += " AND s.started_at_us >= ?"
+            params.append(_epoch_us(started_from))
         if started_to:
-            clause += " AND s.started_at <= ?"
-            params.append(started_to.isoformat())
-        clause += ")"
-        where.append(clause)
+            clause += " AND s.started_at_us <= ?"
+            params.append(_epoch_us(started_to))
+        where.append(clause + ")")
     return where, params
 
 
-def _build_metadata_where(metadata: dict[str, Any]) -> tuple[list[str], list[Any]]:
+def _build_metadata_where(
+    metadata: dict[str, Any], columns: dict[str, str] | None = None
+) -> tuple[list[str], list[Any]]:
     where: list[str] = []
     params: list[Any] = []
     for key, value in metadata.items():
-        path = f"$.{key}"
+        column = (columns or {}).get(key)
+        # Indexed keys compare their generated column (same value as json_extract). / 索引付きキーは生成列で比較する。
+        expr = column if column is not None else "json_extract(metadata_json, ?)"
+        path = [] if column is not None else [f"$.{key}"]
         if value is None:
-            where.append("json_extract(metadata_json, ?) IS NULL")
-            params.append(path)
+            where.append(f"{expr} IS NULL")
+            params.extend(path)
             continue
         if isinstance(value, bool):
-            where.append("json_extract(metadata_json, ?) = ?")
-            params.extend([path, 1 if value else 0])
+            where.append(f"{expr} = ?")
+            params.extend([*path, 1 if value else 0])
             continue
         if isinstance(value, (int, float, str)):
-            where.append("json_extract(metadata_json, ?) = ?")
-            params.extend([path, value])
+            where.append(f"{expr} = ?")
+            params.extend([*path, value])
             continue
         raise NotSupportedError("metadata query (non-scalar)")
     return where, params
 
 
+def _keyword_like_clause(alias: str) -> str:
+    return (
+        f"(LOWER(COALESCE({_text_expr(alias + 'input')},'')) LIKE ? "
+        f"OR LOWER(COALESCE({_text_expr(alias + 'output')},'')) LIKE ? "
+        f"OR LOWER(COALESCE({_text_expr(alias + 'tool_calls_json')},'')) LIKE ?)"
+    )
+
+
+def _text_expr(column: str) -> str:
+    # Only compressed (BLOB) values go through the Python function. / 圧縮値（BLOB）だけPython関数で展開する。
+    return f"CASE WHEN typeof({column}) = 'blob' THEN kantan_text({column}) ELSE {column} END"
+
+
+def _register_functions(conn: sqlite3.Connection) -> _TextResolver:
+    resolver = _TextResolver(conn)
+    conn.create_function("kantan_text", 1, resolver.resolve)
+    conn.create_function("kantan_bucket", 1, lambda text: _rubric_bucket(_json_or_none(text)), deterministic=True)
+    conn.create_aggregate("kantan_percentile", 2, _Percentile)
+    return resolver
+
+
+class _Percentile:
+    """SQLite aggregate: linear-interpolated percentile. / SQLite集計関数: 線形補間のパーセンタイル。"""
+
+    def __init__(self) -> None:
+        self._values: list[float] = []
+        self._percent = 50.0
+
+    def step(self, value: Any, percent: float) -> None:
+        if value is not None:
+            self._values.append(value)
+            self._percent = percent
+
+    def finalize(self) -> float | None:
+        return _percentile(self._values, self._percent)
+
+
+def _percentile(values: list[float], percent: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class _TextResolver:
+    """Rebuild stored text (blob manifests, input deltas) on one connection. / 1接続上で保存テキストを復元する。"""
+
+    def __init__(self, conn: sqlite3.Connection, max_inputs: int = 64) -> None:
+        self._conn = conn
+        self._max_inputs = max_inputs
+        self._inputs: OrderedDict[int, tuple[Any, str]] = OrderedDict()
+        # Blobs are immutable (keyed by content), so caching is always safe. / blobは内容で決まり不変なので常にキャッシュできる。
+        self.blob = functools.lru_cache(maxsize=1024)(self._load_blob)
+
+    def resolve(self, value: Any) -> Any:
+        if is_delta(value):
+            base_id, prefix_len, suffix = parse_delta(value)
+            return self.span_input(base_id)[:prefix_len] + suffix
+        return join_blobs(value, self.blob)
+
+    def span_input(self, ingest_id: int) -> str:
+        row = self._conn.execute("SELECT input FROM spans WHERE ingest_id = ?", (ingest_id,)).fetchone()
+        stored = row[0] if row is not None else None
+        # Keyed by the stored value too, so rewritten rows never hit a stale entry. / 保存値も照合し古いキャッシュを使わない。
+        cached = self._inputs.get(ingest_id)
+        if cached is not None and cached[0] == stored:
+            self._inputs.move_to_end(ingest_id)
+            return cached[1]
+        text = self.resolve(stored) or ""
+        self._inputs[ingest_id] = (stored, text)
+        if len(self._inputs) > self._max_inputs:
+            self._inputs.popitem(last=False)
+        return text
+
+    def _load_blob(self, key: str) -> str:
+        row = self._conn.execute("SELECT data FROM blobs WHERE hash = ?", (key,)).fetchone()
+        return decode_text(row[0]) if row is not None else ""
+
+
+def _resolved_column(column: str) -> str:
+    # Blob manifests (b"r") and input deltas (b"d") are rebuilt in SQL; compressed values stay lazy.
+    # / マニフェストと差分はSQLで復元し、圧縮値は遅延展開のまま。
+    return (
+        f"CASE WHEN typeof({column}) = 'blob' AND substr({column}, 1, 1) IN (X'64', X'72') "
+        f"THEN kantan_text({column}) ELSE {column} END AS {column}"
+    )
+
+
+# Metadata keys that can become generated columns (plain identifiers). / 生成列にできるメタデータキー。
+_METADATA_KEY = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# Generation attributes stored as indexed span columns. / 索引付き列として保存するgenerationの属性。
+_MODEL_COLUMNS = ("model", "provider", "api_kind")
+# Host parameters per statement, below SQLite's historical 999 limit. / 1文あたりのパラメータ数（旧上限999未満）。
+_SQL_CHUNK = 500
+# Pages released per incremental_vacuum step. / incremental_vacuum 1回で解放するページ数。
+_VACUUM_PAGES = 1024
+# Extra attempts (each after the busy timeout) when another connection holds the write lock.
+# / 別接続が書き込みロックを持つ場合の再試行回数（各回ともbusy timeout後）。
+_WRITE_RETRIES = 3
+# First retry delay in seconds, doubled per attempt. / 初回の再試行待ち（秒）。回ごとに倍にする。
+_WRITE_BACKOFF = 0.05
+
+# Shorter shared prefixes are cheaper to store in full. / これより短い共通部分は差分にしない。
+_DELTA_MIN_PREFIX = 256
+
+# Trigram tokens need at least 3 characters; shorter keywords use LIKE. / trigramは3文字以上のみ索引可能。
+_FTS_MIN_KEYWORD_CHARS = 3
+
+
+def _fts_keywords(keywords: list[str] | None) -> list[str]:
+    return [kw for kw in keywords or [] if len(kw) >= _FTS_MIN_KEYWORD_CHARS]
+
+
+def _fts_phrase(keyword: str) -> str:
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+def _tool_args_text(tool_calls_json: str | None) -> str | None:
+    tool_calls = _json_or_none(tool_calls_json)
+    if not isinstance(tool_calls, list):
+        return None
+    parts: list[str] = []
+    for call in tool_calls:
+        if not isinstance(call, dict):
+            continue
+        function = call.get("function") if isinstance(call.get("function"), dict) else {}
+        for value in (call.get("name"), function.get("name"), call.get("arguments"), function.get("arguments")):
+            if value is not None:
+                parts.append(value if isinstance(value, str) else _to_text(value))
+    return "\n".join(parts) or None
+
+
+def _detect_fts5(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.kantan_fts5_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.kantan_fts5_probe")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
 def _detect_json1(conn: sqlite3.Connection) -> bool:
     try:
         conn.execute("SELECT json_extract('{\"a\":1}', '$.a')").fetchone()
@@ -736,75 +2505,539 @@ def _detect_json1(conn: sqlite3.Connection) -> bool:
     return True
 
 
-def _build_span_where(query: SpanQuery, default_tz) -> tuple[list[str], list[Any]]:
+def _build_span_where(
+    query: SpanQuery, default_tz, fts: bool = False, json1: bool = True
+) -> tuple[list[str], list[Any]]:
     where: list[str] = []
     params: list[Any] = []
+    if query.where is not None:
+        sql, predicate_params = _build_predicate(query.where, _span_predicate_fields(json1))
+        where.append(sql)
+        params.extend(predicate_params)
     if query.span_id:
         where.append("id = ?")
         params.append(query.span_id)
     if query.trace_id:
         where.append("trace_id = ?")
         params.append(query.trace_id)
+    if query.trace_ids is not None:
+        # Callers chunk long lists (SQLite host parameter limit). / 長いリストは呼び出し側で分割する。
+        where.append(f"trace_id IN ({','.join('?' * len(query.trace_ids))})" if query.trace_ids else "0")
+        params.extend(query.trace_ids)
     if query.span_type:
         where.append("span_type = ?")
         params.append(query.span_type)
     if query.name:
         where.append("name = ?")
         params.append(query.name)
-    if query.has_error is True:
-        where.append("error_json IS NOT NULL AND error_json != 'null'")
-    if query.has_error is False:
-        where.append("(error_json IS NULL OR error_json = 'null')")
+    for column in _MODEL_COLUMNS:
+        value = getattr(query, column)
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if query.has_error is not None:
+        where.append("has_error = ?")
+        params.append(int(query.has_error))
+    if query.has_tool_call is not None:
+        where.append("has_tool_call = ?")
+        params.append(int(query.has_tool_call))
+    if query.rubric_score_gte is not None:
+        where.append("rubric_score >= ?")
+        params.append(query.rubric_score_gte)
+    if query.rubric_score_lt is not None:
+        where.append("rubric_score < ?")
+        params.append(query.rubric_score_lt)
     if query.keywords:
+        indexed = _fts_keywords(query.keywords) if fts else []
+        if indexed:
+            where.append("ingest_id IN (SELECT rowid FROM spans_fts WHERE spans_fts MATCH ?)")
+            params.append(" AND ".join(_fts_phrase(kw) for kw in indexed))
         for kw in query.keywords:
-            where.append("(LOWER(COALESCE(input,'')) LIKE ? OR LOWER(COALESCE(output,'')) LIKE ?)")
+            if kw in indexed:
+                continue
+            where.append(_keyword_like_clause(""))
             like = f"%{kw.lower()}%"
-            params.extend([like, like])
-    if query.started_from or query.started_to:
-        # started_at is stored as ISO string in UTC
-        if query.started_from:
-            params.append(_normalize_query_dt(query.started_from, default_tz).isoformat())
-            where.append("started_at >= ?")
-        if query.started_to:
-            params.append(_normalize_query_dt(query.started_to, default_tz).isoformat())
-            where.append("started_at <= ?")
+            params.extend([like, like, like])
+    # Epoch microseconds: numeric, offset-independent comparison. / エポックマイクロ秒でオフセットに依らず比較する。
+    if query.started_from:
+        where.append("started_at_us >= ?")
+        params.append(_epoch_us(_normalize_query_dt(query.started_from, default_tz)))
+    if query.started_to:
+        where.append("started_at_us <= ?")
+        params.append(_epoch_us(_normalize_query_dt(query.started_to, default_tz)))
     return where, params
 
 
+class _LazyField:
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __get__(self, instance: Any, owner: type) -> Any:
+        if instance is None:
+            return self
+        row, query, default_tz = instance.__dict__["_lazy_source"]
+        value = owner._decoders[self._name](row, query, default_tz)
+        # Cache on the instance; it shadows this non-data descriptor afterwards. / 以降はインスタンス側の値を使う。
+        instance.__dict__[self._name] = value
+        return value
+
+
+class _LazyRecord:
+    """Decode row columns on first attribute access. / 属性アクセス時に初めて列をデコードする。"""
+
+    _record_type: type
+    _decoders: dict[str, Callable[[sqlite3.Row, Any, Any], Any]] = {}
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        for name in cls._decoders:
+            setattr(cls, name, _LazyField(name))
+
+    @classmethod
+    def _from_row(cls, row: sqlite3.Row, query: Any, default_tz) -> Any:
+        record = cls.__new__(cls)
+        record.__dict__["_lazy_source"] = (row, query, default_tz)
+        return record
+
+    def _values(self) -> tuple[Any, ...]:
+        return tuple(getattr(self, f.name) for f in fields(self._record_type))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, self._record_type):
+            return NotImplemented
+        return self._values() == tuple(getattr(other, f.name) for f in fields(self._record_type))
+
+    def __repr__(self) -> str:
+        return repr(self._record_type(*self._values()))
+
+    def __reduce__(self):
+        # Copies/pickles become plain records. / コピーやpickleは通常のRecordにする。
+        return self._record_type, self._values()
+
+
+def _column(row: sqlite3.Row, name: str) -> Any:
+    return decode_text(row[name]) if name in row.keys() else None
+
+
+def _span_dt(column: str) -> Callable[[sqlite3.Row, Any, Any], Any]:
+    return lambda row, query, tz: _return_dt(_parse_dt(_column(row, column)), query, tz)
+
+
+def _span_json(column: str) -> Callable[[sqlite3.Row, Any, Any], Any]:
+    return lambda row, query, tz: _json_or_none(_column(row, column))
+
+
+def _span_text(column: str) -> Callable[[sqlite3.Row, Any, Any], Any]:
+    return lambda row, query, tz: _column(row, column)
+
+
+def _span_raw(row: sqlite3.Row, query: Any, tz: Any) -> Any:
+    raw = _json_or_none(_column(row, "raw_json"))
+    return restore_raw(raw, {"input": _column(row, "input"), "output": _column(row, "output")})
+
+
+class _LazySpanRecord(_LazyRecord, SpanRecord):
+    _record_type = SpanRecord
+    _decoders = {
+        "trace_id": _span_text("trace_id"),
+        "span_id": _span_text("id"),
+        "parent_id": _span_text("parent_id"),
+        "span_type": _span_text("span_type"),
+        "name": _span_text("name"),
+        "started_at": _span_dt("started_at"),
+        "ended_at": _span_dt("ended_at"),
+        "ingest_seq": lambda row, query, tz: int(_column(row, "ingest_seq") or 0),
+        "input": _span_text("input"),
+        "output": _span_text("output"),
+        "output_kind": _span_text("output_kind"),
+        "tool_calls": _span_json("tool_calls_json"),
+        "structured": _span_json("structured_json"),
+        "rubric": _span_json("rubric_json"),
+        "usage": _span_json("usage_json"),
+        "error": _span_json("error_json"),
+        "raw": _span_raw,
+    }
+
+
+def _trace_usage_total(row: sqlite3.Row, query: Any, tz: Any) -> dict[str, Any] | None:
+    return _json_or_none(row["usage_total_json"])
+
+
+def _trace_metadata(row: sqlite3.Row, query: Any, tz: Any) -> dict[str, Any] | None:
+    metadata = _json_or_none(row["metadata_json"])
+    usage_total = _trace_usage_total(row, query, tz)
+    if usage_total is not None:
+        metadata = dict(metadata) if isinstance(metadata, dict) else {}
+        metadata["usage_total"] = usage_total
+    return metadata
+
+
+class _LazyTraceRecord(_LazyRecord, TraceRecord):
+    _record_type = TraceRecord
+    _decoders = {
+        "trace_id": _span_text("id"),
+        "workflow_name": lambda row, query, tz: row["workflow_name"] or "",
+        "group_id": _span_text("group_id"),
+        "started_at": _span_dt("started_at"),
+        "ended_at": _span_dt("ended_at"),
+        "metadata": _trace_metadata,
+        "duration_ms": _span_text("duration_ms"),
+        "span_count": lambda row, query, tz: int(row["span_count"] or 0),
+        "error_count": lambda row, query, tz: int(row["error_count"] or 0),
+        "tool_call_count": lambda row, query, tz: int(row["tool_call_count"] or 0),
+        "usage_total": _trace_usage_total,
+    }
+
+
 def _row_to_span_record(row: sqlite3.Row, query: SpanQuery | None, default_tz) -> SpanRecord:
-    started_at = _parse_dt(row["started_at"])
-    ended_at = _parse_dt(row["ended_at"])
-    return SpanRecord(
-        trace_id=row["trace_id"],
-        span_id=row["id"],
-        parent_id=row["parent_id"],
-        span_type=row["span_type"],
-        name=row["name"],
-        started_at=_return_dt(started_at, query, default_tz),
-        ended_at=_return_dt(ended_at, query, default_tz),
-        ingest_seq=int(row["ingest_seq"] or 0),
-        input=row["input"],
-        output=row["output"],
-        output_kind=row["output_kind"],
-        tool_calls=_json_or_none(row["tool_calls_json"]),
-        structured=_json_or_none(row["structured_json"]),
-        rubric=_json_or_none(row["rubric_json"]),
-        usage=_json_or_none(row["usage_json"]),
-        error=_json_or_none(row["error_json"]),
-        raw=_json_or_none(row["raw_json"]),
+    return _LazySpanRecord._from_row(row, query, default_tz)
+
+
+def _row_to_trace_record(row: sqlite3.Row, query: TraceQuery | None, default_tz) -> TraceRecord:
+    return _LazyTraceRecord._from_row(row, query, default_tz)
+
+
+# SpanRecord field -> spans column (id/trace_id/ingest_seq are always selected for ordering and cursors).
+# / SpanRecordのフィールドとspans列の対応。
+_SPAN_FIELD_COLUMNS = {
+    "trace_id": "trace_id",
+    "span_id": "id",
+    "parent_id": "parent_id",
+    "span_type": "span_type",
+    "name": "name",
+    "started_at": "started_at",
+    "ended_at": "ended_at",
+    "ingest_seq": "ingest_seq",
+    "input": "input",
+    "output": "output",
+    "output_kind": "output_kind",
+    "tool_calls": "tool_calls_json",
+    "structured": "structured_json",
+    "rubric": "rubric_json",
+    "usage": "usage_json",
+    "error": "error_json",
+    "raw": "raw_json",
+}
+
+
+def _span_select(fields: list[str] | None) -> str:
+    if fields is None:
+        return _SPAN_COLUMNS
+    columns = ["id", "trace_id", "ingest_seq"]
+    for name in fields:
+        column = _SPAN_FIELD_COLUMNS.get(name)
+        if column is None:
+            raise NotSupportedError(f"fields={name}")
+        for selected in (column, *_SPAN_FIELD_DEPENDENCIES.get(name, ())):
+            if selected not in columns:
+                columns.append(selected)
+    return ", ".join(_resolved_column(c) if c in ("input", "output") else c for c in columns)
+
+
+# raw may be rebuilt from input/output (StorageProfile.dedupe_raw). / rawはinput/outputから復元される場合がある。
+_SPAN_FIELD_DEPENDENCIES = {"raw": ("input", "output")}
+
+
+_TRACE_ROLLUP_COLUMNS = (
+    ("started_at", "TEXT"),
+    ("ended_at", "TEXT"),
+    ("duration_ms", "INTEGER"),
+    # Earliest span start in epoch microseconds (retention). / 最初のSpan開始のエポックマイクロ秒（保持ポリシー用）。
+    ("started_at_us", "INTEGER"),
+    ("span_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("error_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("tool_call_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("input_tokens", "INTEGER NOT NULL DEFAULT 0"),
+    ("output_tokens", "INTEGER NOT NULL DEFAULT 0"),
+    ("total_tokens", "INTEGER NOT NULL DEFAULT 0"),
+    # Sum of every numeric usage key (usage_total). / usageの全数値キーの合計（usage_total）。
+    ("usage_total_json", "TEXT"),
+)
+
+# A trace's age for retention: its first span, or when the row was written if it has none.
+# / 保持ポリシー上のTraceの時刻。最初のSpan、Spanが無ければ行を書いた時刻。
+_TRACE_AGE_SQL = "COALESCE(started_at_us, created_at_us)"
+
+_TRACE_COLUMNS = "id, workflow_name, group_id, metadata_json, " + ", ".join(name for name, _ in _TRACE_ROLLUP_COLUMNS)
+
+_SPAN_COLUMNS = (
+    "id, trace_id, parent_id, span_type, name, started_at, ended_at, ingest_seq, "
+    f"{_resolved_column('input')}, {_resolved_column('output')}, output_kind, "
+    "tool_calls_json, structured_json, rubric_json, usage_json, error_json, raw_json"
+)
+
+_FTS_SOURCE_COLUMNS = f"{_resolved_column('input')}, {_resolved_column('output')}, tool_calls_json"
+
+_USAGE_TOKEN_KEYS = ("input_tokens", "output_tokens", "total_tokens")
+
+# Spans fetched per watch_spans query. / watch_spansが1回の問い合わせで取得するSpan数。
+_WATCH_CHUNK = 256
+
+# Span columns a usage rollup is computed from (alias "s"). / usage rollupの計算に使うSpan列（別名 "s"）。
+_USAGE_ROLLUP_SOURCE = "s.span_type, s.started_at_us, s.provider, s.model, s.usage_json, s.has_error"
+
+_USAGE_VALUES = ("requests", "errors", "input_tokens", "output_tokens", "cached_tokens", "reasoning_tokens")
+
+# UsageQuery.group_by -> SQL over usage_rollups ('' keys come back as NULL). / ''のキーはNULLとして返す。
+_USAGE_DIMENSIONS = {
+    "hour": "bucket",
+    "day": "substr(bucket, 1, 10)",
+    "month": "substr(bucket, 1, 7)",
+    "provider": "NULLIF(provider, '')",
+    "model": "NULLIF(model, '')",
+    "workflow_name": "NULLIF(workflow_name, '')",
+}
+
+# order_by values for search_traces ("-" prefix = descending). / search_tracesの並び順（"-"は降順）。
+_TRACE_ORDER_COLUMNS = {
+    "started_at",
+    "ended_at",
+    "duration_ms",
+    "span_count",
+    "error_count",
+    "tool_call_count",
+    "input_tokens",
+    "output_tokens",
+    "total_tokens",
+}
+
+
+# Aggregate dimensions and measures as SQL over spans. / 集計の次元と指標（spansに対するSQL式）。
+
+_AGGREGATE_DIMENSIONS = {
+    "span_type": "span_type",
+    "name": "name",
+    "trace_id": "trace_id",
+    "model": "model",
+    "provider": "provider",
+    "api_kind": "api_kind",
+    "rubric_bucket": "kantan_bucket(rubric_json)",
+    "workflow_name": "(SELECT workflow_name FROM traces WHERE traces.id = spans.trace_id)",
+    "day": "strftime('%Y-%m-%d', started_at_us / 1000000, 'unixepoch')",
+    "hour": "strftime('%Y-%m-%dT%H', started_at_us / 1000000, 'unixepoch')",
+}
+
+
+def _usage_token_sql(key: str) -> str:
+    # Numeric values only (NULL otherwise), like _usage_tokens. / _usage_tokensと同様に数値のみ（それ以外はNULL）。
+    return (
+        f"CASE WHEN json_type(usage_json, '$.{key}') IN ('integer', 'real') "
+        f"THEN json_extract(usage_json, '$.{key}') END"
+    )
+
+
+def _token_sum_sql(key: str) -> str:
+    return f"COALESCE(SUM({_usage_token_sql(key)}), 0)"
+
+
+_AGGREGATE_MEASURES = {
+    "count": "COUNT(*)",
+    "error_count": "SUM(has_error)",
+    "error_rate": "AVG(has_error)",
+    **{key: _token_sum_sql(key) for key in _USAGE_TOKEN_KEYS},
+    "duration_avg": "AVG(duration_ms)",
+    "duration_p50": "kantan_percentile(duration_ms, 50)",
+    "duration_p95": "kantan_percentile(duration_ms, 95)",
+    "duration_p99": "kantan_percentile(duration_ms, 99)",
+    "rubric_score_avg": "AVG(rubric_score)",
+}
+
+_AGGREGATE_JSON1 = set(_USAGE_TOKEN_KEYS)
+
+
+# Compare predicate fields as SQL over spans / traces. / Compare条件のフィールド（spans / tracesに対するSQL式）。
+_SPAN_PREDICATE_FIELDS = {
+    **{column: column for column in ("span_type", "name", "output_kind", *_MODEL_COLUMNS)},
+    **{column: column for column in ("has_error", "has_tool_call", "rubric_score", "duration_ms")},
+}
+_SPAN_TOKEN_PREDICATE_FIELDS = {key: _usage_token_sql(key) for key in _USAGE_TOKEN_KEYS}
+_TRACE_PREDICATE_FIELDS = {
+    column: column
+    for column in ("workflow_name", "group_id", "duration_ms", "span_count", "error_count", "tool_call_count")
+    + _USAGE_TOKEN_KEYS
+}
+_PREDICATE_OPS = ("=", "!=", "<", "<=", ">", ">=")
+
+
+def _span_predicate_fields(json1: bool) -> dict[str, str]:
+    # Token fields read usage_json with JSON1. / tokenはJSON1でusage_jsonを読む。
+    return {**_SPAN_PREDICATE_FIELDS, **_SPAN_TOKEN_PREDICATE_FIELDS} if json1 else _SPAN_PREDICATE_FIELDS
+
+
+def _check_compare(predicate: Compare, fields: Any) -> None:
+    if predicate.field not in fields:
+        raise NotSupportedError(f"predicate field {predicate.field}")
+    if predicate.op not in _PREDICATE_OPS:
+        raise NotSupportedError(f"predicate op {predicate.op}")
+    value = predicate.value
+    if value is None and predicate.op not in ("=", "!="):
+        raise NotSupportedError(f"predicate {predicate.op} None")
+    if value is not None and not isinstance(value, (bool, int, float, str)):
+        raise NotSupportedError("predicate value (non-scalar)")
+
+
+def _build_predicate(predicate: Predicate, fields: dict[str, str]) -> tuple[str, list[Any]]:
+    """Compile a predicate to parameterized SQL. / 条件をパラメータ化したSQLに変換する。"""
+
+    if isinstance(predicate, Compare):
+        _check_compare(predicate, fields)
+        expr = fields[predicate.field]
+        if predicate.value is None:
+            return f"{expr} IS {'NOT ' if predicate.op == '!=' else ''}NULL", []
+        value = int(predicate.value) if isinstance(predicate.value, bool) else predicate.value
+        return f"{expr} {predicate.op} ?", [value]
+    if isinstance(predicate, (And, Or)):
+        if not predicate.predicates:
+            return ("1" if isinstance(predicate, And) else "0"), []
+        parts = [_build_predicate(item, fields) for item in predicate.predicates]
+        joiner = " AND " if isinstance(predicate, And) else " OR "
+        return "(" + joiner.join(sql for sql, _ in parts) + ")", [value for _, params in parts for value in params]
+    if isinstance(predicate, Not):
+        sql, params = _build_predicate(predicate.predicate, fields)
+        return f"NOT ({sql})", params
+    raise NotSupportedError(f"predicate {type(predicate).__name__}")
+
+
+def _aggregate_names(query: AggregateQuery) -> tuple[list[str], list[str]]:
+    dimensions = list(query.group_by or [])
+    measures = list(query.measures or ["count"])
+    for name in dimensions:
+        if name not in _AGGREGATE_DIMENSIONS:
+            raise NotSupportedError(f"group_by={name}")
+    for name in measures:
+        if name not in _AGGREGATE_MEASURES:
+            raise NotSupportedError(f"measure={name}")
+    spans = query.spans
+    if spans is not None and (spans.limit or spans.cursor or spans.order_by):
+        raise NotSupportedError("aggregate with SpanQuery.limit/cursor/order_by")
+    return dimensions, measures
+
+
+def _aggregate_order(order_by: str, dimensions: list[str], measures: list[str]) -> tuple[str, bool]:
+    descending = order_by.startswith("-")
+    name = order_by[1:] if descending else order_by
+    if name not in dimensions and name not in measures:
+        raise NotSupportedError(f"order_by={order_by}")
+    return name, descending
+
+
+def _trace_order(order_by: str | None) -> tuple[str, bool]:
+    key = order_by or "-started_at"
+    descending = key.startswith("-")
+    column = key[1:] if descending else key
+    if column not in _TRACE_ORDER_COLUMNS:
+        raise NotSupportedError(f"order_by={order_by}")
+    return column, descending
+
+
+def _encode_cursor(order_key: str, values: list[Any]) -> str:
+    payload = json.dumps({"o": order_key, "k": values}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, order_key: str) -> list[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except Exception as e:
+        raise InvalidCursorError(cursor) from e
+    if not isinstance(payload, dict) or payload.get("o") != order_key:
+        raise InvalidCursorError(cursor)
+    values = payload.get("k")
+    if not isinstance(values, list) or len(values) != 2 or values[1] is None:
+        raise InvalidCursorError(cursor)
+    return values
+
+
+def _keyset_after(column: str, descending: bool, values: list[Any]) -> list[tuple[str, list[Any]]]:
+    # Rows strictly after (value, id) in "ORDER BY column, id", as ordered segments that can each seek the
+    # (column, id) index; NULLs sort first in SQLite. / (value, id) より後ろの行を索引で引ける区間に分けて返す。
+    value, last_id = values
+    if descending:
+        if value is None:
+            return [(f"{column} IS NULL AND id < ?", [last_id])]
+        return [(f"({column}, id) < (?, ?)", [value, last_id]), (f"{column} IS NULL", [])]
+    if value is None:
+        return [(f"{column} IS NULL AND id > ?", [last_id]), (f"{column} IS NOT NULL", [])]
+    return [(f"({column}, id) > (?, ?)", [value, last_id])]
+
+
+def _usage_tokens(usage: Any) -> dict[str, int | float]:
+    tokens: dict[str, int | float] = {key: 0 for key in _USAGE_TOKEN_KEYS}
+    if not isinstance(usage, dict):
+        return tokens
+    for key in _USAGE_TOKEN_KEYS:
+        value = usage.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            tokens[key] = value
+    return tokens
+
+
+def _usage_detail(usage: dict[str, Any], key: str, *parents: str) -> int | float:
+    # Flat key first, then the OpenAI-style *_details objects. / まず平坦なキー、次に *_details を見る。
+    for container in (usage, *(usage.get(parent) for parent in parents)):
+        value = container.get(key) if isinstance(container, dict) else None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+    return 0
+
+
+def _usage_bucket(started_at_us: int) -> str:
+    return (_EPOCH + timedelta(microseconds=started_at_us)).strftime("%Y-%m-%dT%H")
+
+
+def _apply_usage_rollup(conn: sqlite3.Connection, span: Any, workflow_name: str | None, sign: int) -> None:
+    """Add (sign=1) or remove (sign=-1) one generation span from usage_rollups.
+    / generation Spanひとつ分をusage_rollupsに加算（sign=1）または減算（sign=-1）する。
+    """
+
+    if span["span_type"] != "generation" or span["started_at_us"] is None:
+        return
+    usage = _json_or_none(span["usage_json"])
+    usage = usage if isinstance(usage, dict) else {}
+    tokens = _usage_tokens(usage)
+    key = (_usage_bucket(span["started_at_us"]), span["provider"] or "", span["model"] or "", workflow_name or "")
+    values = (
+        sign,
+        sign * int(bool(span["has_error"])),
+        sign * tokens["input_tokens"],
+        sign * tokens["output_tokens"],
+        sign * _usage_detail(usage, "cached_tokens", "input_tokens_details", "prompt_tokens_details"),
+        sign * _usage_detail(usage, "reasoning_tokens", "output_tokens_details", "completion_tokens_details"),
+    )
+    conn.execute(
+        f"""
+        INSERT INTO usage_rollups(bucket, provider, model, workflow_name, {", ".join(_USAGE_VALUES)})
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(bucket, provider, model, workflow_name) DO UPDATE SET
+        {", ".join(f"{name} = {name} + excluded.{name}" for name in _USAGE_VALUES)}
+        """,
+        (*key, *values),
     )
+    if sign < 0:
+        conn.execute(
+            "DELETE FROM usage_rollups WHERE bucket = ? AND provider = ? AND model = ? AND workflow_name = ? "
+            "AND requests <= 0",
+            key,
+        )
+
+
+def _add_usage_total(total: dict[str, Any], usage: Any) -> None:
+    if not isinstance(usage, dict):
+        return
+    for key, value in usage.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
 
 
-def _trace_times(conn: sqlite3.Connection, trace_id: str) -> tuple[datetime | None, datetime | None]:
-    row = conn.execute(
-        "SELECT MIN(started_at) AS started_at, MAX(ended_at) AS ended_at FROM spans WHERE trace_id = ?",
-        (trace_id,),
-    ).fetchone()
-    if not row:
-        return None, None
-    return _parse_dt(row["started_at"]), _parse_dt(row["ended_at"])
+def _usage_total_json(total: dict[str, Any]) -> str | None:
+    return json.dumps(total, ensure_ascii=False) if total else None
 
 
+def _has_tool_call(tool_calls_json: str | None, raw_json: str | None) -> bool:
+    if tool_calls_json is not None:
+        return True
+    return bool(raw_json) and ("tool_calls" in raw_json or "function_call" in raw_json)
 
 
 class OTELTracer(TracingProcessor):
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import timedelta
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """Which traces SQLiteTracer may delete. / SQLiteTracerが削除してよいTraceの条件。
+
+    Age limits apply to the trace start. Error/judged traces are protected from ``max_age`` and are
+    deleted last when ``max_bytes`` forces eviction. / 経過時間はTrace開始時刻で判定する。エラー/評価付き
+    Traceは ``max_age`` の対象外で、``max_bytes`` による削除では最後に回す。
+    """
+
+    max_age: timedelta | None = None
+    max_bytes: int | None = None
+    error_max_age: timedelta | None = None
+    keep_judged: bool = False
+    batch_size: int = 100
+    interval: timedelta = timedelta(minutes=10)
+
+
+@dataclass
+class RetentionReport:
+    """Result of one purge run. / 1回の削除処理の結果。"""
+
+    deleted_traces: int = 0
+    deleted_spans: int = 0
+    deleted_blobs: int = 0
+    reclaimed_bytes: int = 0
+    free_bytes: int = 0
@@ -2,7 +2,55 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import datetime, tzinfo
-from typing import Any, Protocol, Sequence
+from typing import Any, AsyncIterator, Iterable, Iterator, List, Protocol, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+class Predicate:
+    """Composable filter condition; combine with ``&`` / ``|`` / ``~``. / ``&`` / ``|`` / ``~`` で組み合わせる条件。"""
+
+    def __and__(self, other: Predicate) -> Predicate:
+        return And(self, other)
+
+    def __or__(self, other: Predicate) -> Predicate:
+        return Or(self, other)
+
+    def __invert__(self) -> Predicate:
+        return Not(self)
+
+
+@dataclass(frozen=True)
+class Compare(Predicate):
+    """``field op value`` with op in ``= != < <= > >=``. / 比較条件。
+
+    ``None`` with ``=`` / ``!=`` tests for a missing value. / ``None`` は値が無いことの判定（``=`` / ``!=`` のみ）。
+    """
+
+    field: str
+    op: str
+    value: Any
+
+
+@dataclass(frozen=True, init=False)
+class And(Predicate):
+    predicates: tuple[Predicate, ...]
+
+    def __init__(self, *predicates: Predicate) -> None:
+        object.__setattr__(self, "predicates", predicates)
+
+
+@dataclass(frozen=True, init=False)
+class Or(Predicate):
+    predicates: tuple[Predicate, ...]
+
+    def __init__(self, *predicates: Predicate) -> None:
+        object.__setattr__(self, "predicates", predicates)
+
+
+@dataclass(frozen=True)
+class Not(Predicate):
+    predicate: Predicate
 
 
 @dataclass
@@ -16,20 +64,84 @@ class TraceQuery:
     has_tool_call: bool | None = None
     keywords: list[str] | None = None
     metadata: dict[str, Any] | None = None
+    where: Predicate | None = None
     limit: int | None = None
+    order_by: str | None = None
+    cursor: str | None = None
 
 
 @dataclass
 class SpanQuery:
     trace_id: str | None = None
+    trace_ids: list[str] | None = None
     span_id: str | None = None
     span_type: str | None = None
     name: str | None = None
+    model: str | None = None
+    provider: str | None = None
+    api_kind: str | None = None
     started_from: datetime | None = None
     started_to: datetime | None = None
     has_error: bool | None = None
+    has_tool_call: bool | None = None
     keywords: list[str] | None = None
+    rubric_score_gte: float | None = None
+    rubric_score_lt: float | None = None
+    where: Predicate | None = None
     limit: int | None = None
+    order_by: str | None = None
+    cursor: str | None = None
+    fields: list[str] | None = None
+
+
+@dataclass
+class AggregateQuery:
+    """Grouped measures over spans. / Spanをグループ化して集計する。
+
+    ``spans`` filters the spans (limit / cursor / order_by are not allowed) and ``order_by`` names a dimension or
+    measure ("-" prefix = descending). / ``spans`` は対象Spanの条件（limit / cursor / order_by は不可）。
+    ``order_by`` は次元名か指標名（"-"は降順）。
+    """
+
+    group_by: list[str] | None = None
+    measures: list[str] | None = None
+    spans: SpanQuery | None = None
+    workflow_name: str | None = None
+    order_by: str | None = None
+    limit: int | None = None
+
+
+@dataclass
+class AggregateRow:
+    group: dict[str, Any]
+    values: dict[str, Any]
+
+
+@dataclass
+class UsageQuery:
+    """Token usage from the hourly rollup table. / 1時間単位の集計表から使用量を引く。
+
+    ``group_by`` takes "hour" / "day" / "month" (UTC) / "provider" / "model" / "workflow_name"; ranges are
+    matched per hour bucket. / 期間は1時間単位のバケットで判定する。
+    """
+
+    group_by: list[str] | None = None
+    provider: str | None = None
+    model: str | None = None
+    workflow_name: str | None = None
+    started_from: datetime | None = None
+    started_to: datetime | None = None
+
+
+@dataclass
+class UsageRow:
+    group: dict[str, Any]
+    requests: int = 0
+    errors: int = 0
+    input_tokens: int | float = 0
+    output_tokens: int | float = 0
+    cached_tokens: int | float = 0
+    reasoning_tokens: int | float = 0
 
 
 @dataclass
@@ -40,6 +152,11 @@ class TraceRecord:
     started_at: datetime | None
     ended_at: datetime | None
     metadata: dict[str, Any] | None
+    duration_ms: int | None = None
+    span_count: int = 0
+    error_count: int = 0
+    tool_call_count: int = 0
+    usage_total: dict[str, Any] | None = None
 
 
 @dataclass
@@ -70,14 +187,38 @@ class TraceSearchCapabilities:
     supports_metadata_query: bool
     supports_limit: bool
     supports_since: bool
+    supports_full_text: bool = False
+    supports_cursor: bool = False
+    supports_rubric_score: bool = False
+    supports_trace_ids: bool = False
+    supports_aggregate: bool = False
+    supports_usage_rollups: bool = False
+    supports_watch: bool = False
+    # Fields usable in Compare predicates. / Compare 条件で使えるフィールド。
+    span_predicate_fields: tuple[str, ...] = ()
+    trace_predicate_fields: tuple[str, ...] = ()
+
+
+class SearchPage(List[T]):
+    """Search results with a cursor for the next page. / 次ページ用カーソル付きの検索結果。"""
+
+    def __init__(self, items: Iterable[T] = (), next_cursor: str | None = None) -> None:
+        super().__init__(items)
+        self.next_cursor = next_cursor
 
 
 class TraceSearchService(Protocol):
     default_tz: tzinfo
 
-    def search_traces(self, *, query: TraceQuery) -> Sequence[TraceRecord]: ...
+    def search_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]: ...
+
+    def search_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]: ...
+
+    def iter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> Iterator[TraceRecord]: ...
 
-    def search_spans(self, *, query: SpanQuery) -> Sequence[SpanRecord]: ...
+    def iter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> Iterator[SpanRecord]: ...
+
+    def iter_spans_by_trace(self, trace_id: str, chunk_size: int = 256) -> Iterator[SpanRecord]: ...
 
     def get_trace(self, trace_id: str) -> TraceRecord | None: ...
 
@@ -87,4 +228,30 @@ class TraceSearchService(Protocol):
 
     def get_spans_since(self, trace_id: str, since_seq: int | None = None) -> Sequence[SpanRecord]: ...
 
+    def aggregate(self, *, query: AggregateQuery) -> list[AggregateRow]: ...
+
     def capabilities(self) -> TraceSearchCapabilities: ...
+
+
+class AsyncTraceSearchService(Protocol):
+    """Async counterpart of TraceSearchService. / TraceSearchServiceの非同期版。"""
+
+    default_tz: tzinfo
+
+    async def asearch_traces(self, *, query: TraceQuery) -> SearchPage[TraceRecord]: ...
+
+    async def asearch_spans(self, *, query: SpanQuery) -> SearchPage[SpanRecord]: ...
+
+    def aiter_traces(self, *, query: TraceQuery, chunk_size: int = 256) -> AsyncIterator[TraceRecord]: ...
+
+    def aiter_spans(self, *, query: SpanQuery, chunk_size: int = 256) -> AsyncIterator[SpanRecord]: ...
+
+    async def aget_trace(self, trace_id: str) -> TraceRecord | None: ...
+
+    async def aget_span(self, span_id: str) -> SpanRecord | None: ...
+
+    async def aget_spans_by_trace(self, trace_id: str) -> Sequence[SpanRecord]: ...
+
+    async def aget_spans_since(self, trace_id: str, since_seq: int | None = None) -> Sequence[SpanRecord]: ...
+
+    async def aaggregate(self, *, query: AggregateQuery) -> list[AggregateRow]: ...
@@ -37,6 +37,8 @@ class GenerationSpanData(SpanData):
     output_raw: Any | None = None
     model: str | None = None
     usage: dict[str, Any] | None = None
+    provider: str | None = None
+    api_kind: str | None = None
 
     def export(self) -> dict[str, Any]:
         return {
@@ -46,4 +48,6 @@ class GenerationSpanData(SpanData):
             "output_raw": self.output_raw,
             "model": self.model,
             "usage": self.usage,
+            "provider": self.provider,
+            "api_kind": self.api_kind,
         }
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from ..errors import MissingDependencyError, NotSupportedError
+
+# Compressed values are stored as BLOBs: one codec byte + payload. Plain values stay TEXT.
+# / 圧縮値はBLOB（先頭1バイトがcodec）として保存し、非圧縮値はTEXTのまま。
+_CODEC_ZLIB = b"z"
+_CODEC_ZSTD = b"s"
+# Manifest of literal parts and blob hashes (StorageProfile.dedupe_blobs). / リテラルとblobハッシュの並び。
+_CODEC_REFS = b"r"
+# Prefix of another span's input + appended text (StorageProfile.delta_inputs). / 別Spanのinputの先頭 + 追記分。
+_CODEC_DELTA = b"d"
+
+# Key in the deduplicated raw_json that lists span_data fields rebuilt from columns.
+# / 重複排除したraw_jsonで、列から復元するspan_dataフィールドを示すキー。
+_DERIVED_KEY = "_kantan_llm_derived"
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    """How SQLiteTracer stores span payloads. / SQLiteTracerのSpanペイロード保存方式。"""
+
+    dedupe_raw: bool = False
+    compression: str | None = None
+    compress_min_bytes: int = 1024
+    compression_level: int | None = None
+    dedupe_blobs: bool = False
+    blob_min_bytes: int = 256
+    delta_inputs: bool = False
+    delta_max_depth: int = 16
+
+    @classmethod
+    def compact(cls) -> "StorageProfile":
+        """Input deltas + shared blobs + deduplicated raw_json + zlib. / input差分 + blob共有 + raw_json重複排除 + zlib。"""
+
+        return cls(
+            dedupe_raw=True,
+            compression="zlib",
+            compress_min_bytes=512,
+            dedupe_blobs=True,
+            delta_inputs=True,
+        )
+
+    def __post_init__(self) -> None:
+        if self.compression not in (None, "zlib", "zstd"):
+            raise NotSupportedError(f"compression={self.compression}")
+        if self.compression == "zstd":
+            _zstd()
+
+
+def encode_text(value: str | None, profile: StorageProfile) -> str | bytes | None:
+    """Compress a text value when the profile asks for it. / プロファイルに応じてテキストを圧縮する。"""
+
+    if value is None or profile.compression is None:
+        return value
+    data = value.encode("utf-8")
+    if len(data) < profile.compress_min_bytes:
+        return value
+    if profile.compression == "zstd":
+        level = profile.compression_level if profile.compression_level is not None else 3
+        packed = _CODEC_ZSTD + _zstd().ZstdCompressor(level=level).compress(data)
+    else:
+        level = profile.compression_level if profile.compression_level is not None else 6
+        packed = _CODEC_ZLIB + zlib.compress(data, level)
+    # Keep incompressible values as text. / 縮まない値はテキストのまま。
+    return packed if len(packed) < len(data) else value
+
+
+def decode_text(value: Any) -> Any:
+    """Inverse of encode_text; non-BLOB values pass through. / encode_textの逆変換（BLOB以外はそのまま）。"""
+
+    if not isinstance(value, bytes):
+        return value
+    codec, payload = value[:1], value[1:]
+    if codec == _CODEC_ZLIB:
+        return zlib.decompress(payload).decode("utf-8")
+    if codec == _CODEC_ZSTD:
+        return _zstd().ZstdDecompressor().decompress(payload).decode("utf-8")
+    raise NotSupportedError(f"stored codec={codec!r}")
+
+
+def split_blobs(text: str | None, profile: StorageProfile) -> tuple[bytes | None, dict[str, str]]:
+    """Split text into shared blobs and a manifest. / テキストを共有blobとマニフェストに分割する。
+
+    Returns ``(manifest, {hash: segment})``; the manifest is None when nothing is large enough to share.
+    / 共有に足る大きさの区間が無い場合、マニフェストはNone。
+    """
+
+    if text is None or not profile.dedupe_blobs:
+        return None, {}
+    parts: list[Any] = []
+    blobs: dict[str, str] = {}
+    for segment in _segments(text, profile.blob_min_bytes):
+        if len(segment.encode("utf-8")) >= profile.blob_min_bytes:
+            key = blob_hash(segment)
+            blobs[key] = segment
+            parts.append([key])
+        elif parts and isinstance(parts[-1], str):
+            parts[-1] += segment
+        else:
+            parts.append(segment)
+    if not blobs:
+        return None, {}
+    return _CODEC_REFS + json.dumps(parts, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), blobs
+
+
+def is_blob_manifest(value: Any) -> bool:
+    return isinstance(value, bytes) and value[:1] == _CODEC_REFS
+
+
+def join_blobs(value: Any, load: Callable[[str], str]) -> Any:
+    """Reassemble a manifest with ``load(hash)``; other values are decoded. / マニフェストを復元する。"""
+
+    if not is_blob_manifest(value):
+        return decode_text(value)
+    parts = json.loads(value[1:].decode("utf-8"))
+    return "".join(part if isinstance(part, str) else load(part[0]) for part in parts)
+
+
+def blob_hashes(value: Any) -> list[str]:
+    """Blob hashes referenced by a stored value. / 保存値が参照するblobハッシュ。"""
+
+    if not is_blob_manifest(value):
+        return []
+    return [part[0] for part in json.loads(value[1:].decode("utf-8")) if not isinstance(part, str)]
+
+
+def encode_delta(base_id: int, prefix_len: int, suffix: str) -> bytes:
+    """Encode text as ``base[:prefix_len] + suffix``. / ``base[:prefix_len] + suffix`` として符号化する。"""
+
+    return _CODEC_DELTA + json.dumps([base_id, prefix_len]).encode("utf-8") + b"\n" + suffix.encode("utf-8")
+
+
+def is_delta(value: Any) -> bool:
+    return isinstance(value, bytes) and value[:1] == _CODEC_DELTA
+
+
+def parse_delta(value: bytes) -> tuple[int, int, str]:
+    header, _, suffix = value[1:].partition(b"\n")
+    base_id, prefix_len = json.loads(header.decode("utf-8"))
+    return base_id, prefix_len, suffix.decode("utf-8")
+
+
+def common_prefix_len(a: str, b: str) -> int:
+    # Binary search over slice comparisons (C speed). / スライス比較の二分探索。
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def blob_hash(segment: str) -> str:
+    return hashlib.blake2b(segment.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Content-defined boundaries keep chunking stable when text is inserted before a repeated block;
+# the line cap bounds chunks made of repeated lines. / 内容で境界を決めるため前方の挿入に強い。行数上限は同一行の連続用。
+_BOUNDARY_MASK = 0x7
+_MAX_CHUNK_LINES = 16
+
+
+def _segments(text: str, min_bytes: int) -> list[str]:
+    segments: list[str] = []
+    current: list[str] = []
+    for line in text.splitlines(keepends=True):
+        if len(line) >= min_bytes:
+            if current:
+                segments.append("".join(current))
+                current = []
+            segments.append(line)
+            continue
+        current.append(line)
+        if zlib.crc32(line.encode("utf-8")) & _BOUNDARY_MASK == 0 or len(current) >= _MAX_CHUNK_LINES:
+            segments.append("".join(current))
+            current = []
+    if current:
+        segments.append("".join(current))
+    return segments
+
+
+def dedupe_raw(exported: dict[str, Any], columns: dict[str, str | None]) -> dict[str, Any]:
+    """Drop span_data values already stored as columns. / 列に保存済みのspan_data値を取り除く。"""
+
+    span_data = exported.get("span_data")
+    if not isinstance(span_data, dict):
+        return exported
+    residual = dict(span_data)
+    derived: dict[str, str] = {}
+    for key, text in columns.items():
+        if key not in residual or text is None:
+            continue
+        value = residual[key]
+        if isinstance(value, str):
+            if value == text:
+                derived[key] = "text"
+                del residual[key]
+            continue
+        try:
+            same = json.loads(text) == value
+        except ValueError:
+            same = False
+        if same:
+            derived[key] = "json"
+            del residual[key]
+    if not derived:
+        return exported
+    return {**exported, "span_data": residual, _DERIVED_KEY: derived}
+
+
+def restore_raw(raw: Any, columns: dict[str, str | None]) -> Any:
+    """Rebuild the full export from a deduplicated raw_json. / 重複排除したraw_jsonから元のexportを復元する。"""
+
+    if not isinstance(raw, dict) or _DERIVED_KEY not in raw:
+        return raw
+    raw = dict(raw)
+    derived = raw.pop(_DERIVED_KEY)
+    span_data = dict(raw.get("span_data") or {})
+    for key, kind in derived.items():
+        text = columns.get(key)
+        if text is None:
+            continue
+        span_data[key] = text if kind == "text" else json.loads(text)
+    raw["span_data"] = span_data
+    return raw
+
+
+def _zstd():
+    try:
+        import zstandard  # type: ignore
+    except Exception as e:
+        raise MissingDependencyError("zstandard") from e
+    return zstandard
@@ -436,6 +436,8 @@ def _traced_llm_stream_async(
         output=None,
         model=model,
         parent=auto_trace if auto_trace is not None else None,
+        provider=provider,
+        api_kind=api_kind,
     )
     span.start(mark_as_current=True)
 
@@ -471,6 +473,8 @@ def _run_with_generation_span(
         output=None,
         model=model,
         parent=parent_trace,
+        provider=provider,
+        api_kind=api_kind,
     )
     with span:
         try:
@@ -512,6 +516,8 @@ async def _run_with_generation_span_async(
         output=None,
         model=model,
         parent=parent_trace,
+        provider=provider,
+        api_kind=api_kind,
     )
     with span:
         try:
@@ -100,6 +100,46 @@ def test_usage_recorded_in_span_and_trace(tmp_path):
     assert trace_record.metadata["usage_total"]["total_tokens"] == 6
 
 
+def test_usage_total_keeps_every_numeric_key(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing import MemoryTracer
+
+    tracer = _setup_tracer(tmp_path)
+    memory = MemoryTracer()
+    set_trace_processors([tracer, memory])
+    with trace("usage-keys") as t:
+        for _ in range(2):
+            with generation_span(
+                input="hello",
+                model="gpt-4",
+                usage={"prompt_tokens": 3, "completion_tokens": 1, "cached_tokens": 2, "note": "x"},
+            ):
+                pass
+
+    expected = {
+        "prompt_tokens": 6,
+        "completion_tokens": 2,
+        "cached_tokens": 4,
+        "input_tokens": 6,
+        "output_tokens": 2,
+        "total_tokens": 8,
+    }
+    assert tracer.get_trace(t.trace_id).usage_total == expected
+    assert tracer.get_trace(t.trace_id).metadata["usage_total"] == expected
+    assert memory.get_trace(t.trace_id).usage_total == expected
+    tracer.shutdown()
+
+    # Older databases are recomputed from their spans. / 既存DBはSpanから再計算する。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("ALTER TABLE traces DROP COLUMN usage_total_json")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    assert reopened.get_trace(t.trace_id).usage_total == expected
+    reopened.shutdown()
+
+
 def test_usage_normalization_minimal(tmp_path):
     tracer = _setup_tracer(tmp_path)
 
@@ -217,3 +257,1342 @@ def test_time_return_naive_or_aware(tmp_path):
     spans = tracer.search_spans(query=SpanQuery(started_from=naive_from, started_to=naive_to))
     assert spans
     assert spans[0].started_at is None or spans[0].started_at.tzinfo is None
+
+
+def test_keywords_use_fts_index_with_like_fallback(tmp_path, monkeypatch):
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    assert tracer.capabilities().supports_full_text
+
+    spans = tracer.search_spans(query=SpanQuery(keywords=["HELLO", "world"]))
+    assert [s.input for s in spans] == ["hello world"]
+    # Short keywords cannot use the trigram index and fall back to LIKE.
+    spans = tracer.search_spans(query=SpanQuery(keywords=["ok"]))
+    assert spans and all("ok" in (s.output or "") for s in spans)
+    traces = tracer.search_traces(query=TraceQuery(keywords=["score me", "tool check"]))
+    assert [t.trace_id for t in traces] == [trace_id]
+
+    monkeypatch.setattr("kantan_llm.tracing.processors._detect_fts5", lambda conn: False)
+    fallback = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    assert not fallback.capabilities().supports_full_text
+    spans = fallback.search_spans(query=SpanQuery(keywords=["HELLO", "world"]))
+    assert [s.input for s in spans] == ["hello world"]
+
+
+def test_keywords_match_tool_arguments_and_rank_by_relevance(tmp_path):
+    tracer = _setup_tracer(tmp_path)
+    with trace("fts"):
+        with generation_span(
+            input="plan",
+            output={"tool_calls": [{"name": "lookup", "arguments": '{"city": "Kyoto"}'}]},
+            model="gpt-4",
+        ):
+            pass
+        with generation_span(input="kyoto", output="kyoto kyoto kyoto", model="gpt-4"):
+            pass
+
+    spans = tracer.search_spans(query=SpanQuery(keywords=["kyoto"], order_by="relevance"))
+    assert len(spans) == 2
+    assert spans[0].input == "kyoto"
+
+    tracer.on_span_end(_ReplayedSpan(tracer.get_span(spans[0].span_id)))
+    assert len(tracer.search_spans(query=SpanQuery(keywords=["kyoto"]))) == 2
+
+
+class _ReplayedSpan:
+    def __init__(self, record) -> None:
+        self._raw = dict(record.raw)
+
+    def export(self):
+        return self._raw
+
+
+def test_trace_rollup_maintained_on_ingest(tmp_path):
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    with trace("later") as later:
+        with generation_span(input="x", output="y", model="gpt-4", usage={"input_tokens": 40, "output_tokens": 2}):
+            pass
+        with custom_span(name="step") as failing:
+            failing.set_error({"message": "boom", "data": None})
+
+    record = tracer.get_trace(trace_id)
+    assert record.span_count == 5
+    assert record.error_count == 0
+    assert record.tool_call_count == 1
+    assert record.usage_total == {"input_tokens": 3, "output_tokens": 2, "total_tokens": 5}
+    assert record.duration_ms is not None and record.duration_ms >= 0
+    assert record.started_at <= record.ended_at
+
+    latest_first = tracer.search_traces(query=TraceQuery())
+    assert [t.trace_id for t in latest_first] == [later.trace_id, trace_id]
+    by_cost = tracer.search_traces(query=TraceQuery(order_by="-total_tokens", limit=1))
+    assert by_cost[0].trace_id == later.trace_id
+    assert by_cost[0].error_count == 1
+    by_errors = tracer.search_traces(query=TraceQuery(order_by="error_count"))
+    assert [t.trace_id for t in by_errors] == [trace_id, later.trace_id]
+
+
+def test_trace_rollup_backfilled_for_existing_db(tmp_path):
+    import sqlite3
+
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    tracer.shutdown()
+
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("DROP INDEX idx_traces_started_at")
+    conn.execute("DROP INDEX idx_traces_error_count")
+    conn.execute("DROP INDEX idx_traces_total_tokens")
+    conn.execute("DROP INDEX idx_traces_duration_ms")
+    for column in ("span_count", "total_tokens"):
+        conn.execute(f"ALTER TABLE traces DROP COLUMN {column}")
+    conn.commit()
+    conn.close()
+
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    record = reopened.get_trace(trace_id)
+    assert record.span_count == 5
+    assert record.usage_total["total_tokens"] == 5
+
+
+def test_error_and_tool_call_flags_filter_spans_and_traces(tmp_path):
+    import sqlite3
+
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    with trace("failing") as failing:
+        with custom_span(name="step") as span:
+            span.set_error({"message": "boom", "data": None})
+
+    tool_spans = tracer.search_spans(query=SpanQuery(has_tool_call=True))
+    assert [s.output_kind for s in tool_spans] == ["tool_calls"]
+    error_spans = tracer.search_spans(query=SpanQuery(has_error=True))
+    assert [s.trace_id for s in error_spans] == [failing.trace_id]
+    assert [t.trace_id for t in tracer.search_traces(query=TraceQuery(has_error=False))] == [trace_id]
+    assert [t.trace_id for t in tracer.search_traces(query=TraceQuery(has_tool_call=False))] == [failing.trace_id]
+    tracer.shutdown()
+
+    # Older databases get the flags backfilled once. / 既存DBは移行時にフラグを埋める。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("DROP INDEX idx_spans_has_error")
+    conn.execute("DROP INDEX idx_spans_has_tool_call")
+    conn.execute("ALTER TABLE spans DROP COLUMN has_error")
+    conn.execute("ALTER TABLE spans DROP COLUMN has_tool_call")
+    conn.commit()
+    conn.close()
+
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    assert [s.trace_id for s in reopened.search_spans(query=SpanQuery(has_error=True))] == [failing.trace_id]
+    assert [s.output_kind for s in reopened.search_spans(query=SpanQuery(has_tool_call=True))] == ["tool_calls"]
+
+
+def test_cursor_pagination_for_traces_and_spans(tmp_path):
+    import pytest
+
+    from kantan_llm.errors import InvalidCursorError
+
+    tracer = _setup_tracer(tmp_path)
+    trace_ids = [_record_sample() for _ in range(5)]
+    with trace("no spans yet") as empty:
+        pass
+    assert tracer.capabilities().supports_cursor
+
+    seen: list[str] = []
+    page = tracer.search_traces(query=TraceQuery(limit=2))
+    seen.extend(t.trace_id for t in page)
+    while page.next_cursor:
+        page = tracer.search_traces(query=TraceQuery(limit=2, cursor=page.next_cursor))
+        seen.extend(t.trace_id for t in page)
+    # Traces without spans have no start time and come last. / Span未記録のTraceは末尾。
+    assert seen == list(reversed(trace_ids)) + [empty.trace_id]
+
+    spans: list[str] = []
+    query = SpanQuery(span_type="generation", limit=4)
+    page = tracer.search_spans(query=query)
+    spans.extend(s.span_id for s in page)
+    while page.next_cursor:
+        page = tracer.search_spans(query=SpanQuery(span_type="generation", limit=4, cursor=page.next_cursor))
+        spans.extend(s.span_id for s in page)
+    assert len(spans) == len(set(spans)) == 15
+
+    first = tracer.search_traces(query=TraceQuery(limit=1))
+    with pytest.raises(InvalidCursorError):
+        tracer.search_traces(query=TraceQuery(limit=1, order_by="error_count", cursor=first.next_cursor))
+
+
+def test_iter_spans_streams_in_chunks(tmp_path):
+    import types
+
+    tracer = _setup_tracer(tmp_path)
+    trace_ids = [_record_sample() for _ in range(3)]
+
+    stream = tracer.iter_spans(query=SpanQuery(span_type="generation"), chunk_size=2)
+    assert isinstance(stream, types.GeneratorType)
+    first = next(stream)
+    assert first.span_type == "generation"
+    stream.close()
+
+    streamed = [s.span_id for s in tracer.iter_spans(query=SpanQuery(span_type="generation"), chunk_size=2)]
+    assert streamed == [s.span_id for s in tracer.search_spans(query=SpanQuery(span_type="generation"))]
+    assert len(list(tracer.iter_spans(query=SpanQuery(limit=4), chunk_size=3))) == 4
+    assert [t.trace_id for t in tracer.iter_traces(query=TraceQuery(), chunk_size=1)] == list(reversed(trace_ids))
+    assert [s.span_id for s in tracer.iter_spans_by_trace(trace_ids[0], chunk_size=2)] == [
+        s.span_id for s in tracer.get_spans_by_trace(trace_ids[0])
+    ]
+
+
+def test_span_projection_and_lazy_decoding(tmp_path):
+    import copy
+
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+    from kantan_llm.tracing import SpanRecord
+
+    tracer = _setup_tracer(tmp_path)
+    _record_sample()
+
+    judges = tracer.search_spans(query=SpanQuery(name="judge", fields=["span_id", "rubric"]))
+    assert judges[0].rubric["score"] == 0.7
+    assert judges[0].input is None and judges[0].raw is None
+    assert judges[0].ingest_seq > 0
+
+    span = tracer.search_spans(query=SpanQuery(span_type="generation", limit=1))[0]
+    assert "raw" not in vars(span) and "started_at" not in vars(span)
+    assert span.raw["span_data"]["input"] == "hello world"
+    assert "raw" in vars(span)
+
+    plain = copy.copy(span)
+    assert type(plain) is SpanRecord
+    assert plain == span and span == plain
+
+    with pytest.raises(NotSupportedError):
+        tracer.search_spans(query=SpanQuery(fields=["nope"]))
+
+
+def test_concurrent_writer_and_pooled_readers(tmp_path):
+    import threading
+
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+
+    tracer = SQLiteTracer(str(tmp_path / "traces.sqlite3"), concurrent=True, reader_pool_size=2)
+    set_trace_processors([tracer])
+    errors: list[BaseException] = []
+
+    def ingest(worker: int) -> None:
+        try:
+            for i in range(10):
+                with trace(f"worker-{worker}"):
+                    with function_span(name="tool", input=f"job {worker}-{i}", output="done"):
+                        pass
+                tracer.search_spans(query=SpanQuery(name="tool", limit=5))
+        except BaseException as exc:  # pragma: no cover - surfaced below
+            errors.append(exc)
+
+    threads = [threading.Thread(target=ingest, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracer.force_flush()
+
+    assert errors == []
+    assert len(tracer.search_traces(query=TraceQuery())) == 40
+    assert len(list(tracer.iter_spans(query=SpanQuery(name="tool"), chunk_size=7))) == 40
+    [record] = tracer.search_traces(query=TraceQuery(workflow_name="worker-3", keywords=["job 3-9"]))
+    assert record.span_count == 1
+    tracer.shutdown()
+    set_trace_processors([])
+
+    with pytest.raises(NotSupportedError):
+        SQLiteTracer(":memory:", concurrent=True)
+
+
+def test_concurrent_writer_reports_batches_it_cannot_commit(tmp_path, caplog):
+    import logging
+    import sqlite3
+
+    import pytest
+
+    path = str(tmp_path / "traces.sqlite3")
+    tracer = SQLiteTracer(path, concurrent=True)
+    set_trace_processors([tracer])
+    tracer.capabilities()
+    tracer._conn.execute("PRAGMA busy_timeout = 20")
+    # Another process holding the write lock past the busy timeout. / busy timeoutを超えて書き込みロックを持つ別プロセス。
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    with caplog.at_level(logging.ERROR, logger="kantan_llm.tracing.processors"):
+        _record_sample()
+        with pytest.raises(sqlite3.OperationalError):
+            tracer.force_flush()
+    assert "dropped a batch" in caplog.text
+    holder.execute("ROLLBACK")
+    holder.close()
+
+    trace_id = _record_sample()
+    tracer.force_flush()
+    assert tracer.get_trace(trace_id).span_count == 5
+    tracer.shutdown()
+    set_trace_processors([])
+
+
+def test_async_search_and_cancellation_interrupts_query(tmp_path):
+    import asyncio
+    import sqlite3
+
+    import pytest
+
+    outcome: list[BaseException] = []
+
+    class SlowSQLiteTracer(SQLiteTracer):
+        def slow_count(self) -> int:
+            try:
+                with self._reader() as conn:
+                    return conn.execute(
+                        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+                    ).fetchone()[0]
+            except sqlite3.OperationalError as exc:
+                outcome.append(exc)
+                raise
+
+    tracer = SlowSQLiteTracer(str(tmp_path / "traces.sqlite3"), concurrent=True)
+    set_trace_processors([tracer])
+    trace_id = _record_sample()
+    tracer.force_flush()
+
+    async def _run():
+        spans = await tracer.asearch_spans(query=SpanQuery(span_type="function"))
+        assert [s.name for s in spans] == ["tool_a"]
+        assert (await tracer.aget_trace(trace_id)).span_count == 5
+        streamed = [s.span_id async for s in tracer.aiter_spans(query=SpanQuery(trace_id=trace_id), chunk_size=2)]
+        assert streamed == [s.span_id for s in await tracer.aget_spans_by_trace(trace_id)]
+        assert len(await tracer.aget_spans_since(trace_id, since_seq=3)) == 2
+
+        task = asyncio.ensure_future(tracer._run_async(tracer.slow_count))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The reader is released promptly and usable again. / 読み取り接続はすぐ解放され再利用できる。
+        return await asyncio.wait_for(tracer.aget_span(spans[0].span_id), timeout=5)
+
+    assert asyncio.run(_run()).name == "tool_a"
+    tracer.shutdown()
+    set_trace_processors([])
+    assert len(outcome) == 1 and "interrupted" in str(outcome[0])
+
+
+def test_aiter_cancelled_mid_chunk_closes_on_reader_thread(tmp_path):
+    import asyncio
+    import threading
+    import time
+
+    import pytest
+
+    closed_in: list[str] = []
+    taking = threading.Event()
+
+    class SlowIterTracer(SQLiteTracer):
+        def iter_spans(self, *, query, chunk_size=256):
+            def slow():
+                try:
+                    yield from SQLiteTracer.iter_spans(self, query=query, chunk_size=chunk_size)
+                    taking.set()
+                    time.sleep(0.3)
+                    yield None
+                finally:
+                    closed_in.append(threading.current_thread().name)
+
+            return slow()
+
+    tracer = SlowIterTracer(str(tmp_path / "traces.sqlite3"))
+    set_trace_processors([tracer])
+    _record_sample()
+
+    async def _run() -> None:
+        records = tracer.aiter_spans(query=SpanQuery(), chunk_size=100)
+        task = asyncio.ensure_future(records.__anext__())
+        while not taking.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        # close() waits for the running chunk instead of raising "generator already executing".
+        # / close()は実行中のチャンクを待ち、「generator already executing」にならない。
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_run())
+    assert len(closed_in) == 1 and closed_in[0].startswith("kantan-llm-sqlite-reader")
+    tracer.shutdown()
+
+
+def test_compact_storage_profile_compresses_and_dedupes_raw(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing.storage import StorageProfile
+
+    path = tmp_path / "traces.sqlite3"
+    tracer = SQLiteTracer(str(path), storage=StorageProfile.compact())
+    set_trace_processors([tracer])
+    long_input = "needle in the prompt " + "lorem ipsum " * 200
+    with trace("compact") as t:
+        with generation_span(input=long_input, output="short answer", model="gpt-4"):
+            pass
+        with function_span(name="tool", input={"q": "x" * 1000}, output="ok"):
+            pass
+
+    conn = sqlite3.connect(path)
+    stored = conn.execute("SELECT typeof(input), typeof(output), raw_json FROM spans ORDER BY ingest_seq").fetchall()
+    assert stored[0][:2] == ("blob", "text")
+    assert "lorem ipsum" not in str(stored[0][2])
+
+    spans = tracer.get_spans_by_trace(t.trace_id)
+    assert spans[0].input == long_input
+    assert spans[0].raw["span_data"]["input"] == long_input
+    assert spans[0].raw["span_data"]["model"] == "gpt-4"
+    assert spans[1].raw["span_data"]["input"] == {"q": "x" * 1000}
+    [projected] = tracer.search_spans(query=SpanQuery(name="tool", fields=["raw"]))
+    assert projected.raw == spans[1].raw
+
+    # Both the FTS index and the LIKE fallback see through compression. / FTSとLIKEの両方で圧縮値を検索できる。
+    assert [r.trace_id for r in tracer.search_traces(query=TraceQuery(keywords=["needle"]))] == [t.trace_id]
+    assert [r.trace_id for r in tracer.search_traces(query=TraceQuery(keywords=["ip"]))] == [t.trace_id]
+    assert len(tracer.search_spans(query=SpanQuery(keywords=["lorem"]))) == 1
+
+
+def test_repeated_prompt_segments_stored_once_as_blobs(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing.storage import StorageProfile
+
+    path = tmp_path / "traces.sqlite3"
+    tracer = SQLiteTracer(str(path), storage=StorageProfile(dedupe_blobs=True))
+    set_trace_processors([tracer])
+    system = "You are a careful assistant. " * 200
+    tools = [{"name": f"tool_{n}", "description": "Look things up " * 10, "parameters": {"q": "string"}} for n in range(5)]
+    with trace("agent") as t:
+        for turn in range(20):
+            messages = [{"role": "system", "content": system}, {"role": "user", "content": f"question {turn}"}]
+            with generation_span(input={"messages": messages, "tools": tools}, output=f"answer {turn}", model="gpt-4"):
+                pass
+
+    conn = sqlite3.connect(path)
+    blob_count, blob_bytes = conn.execute("SELECT count(*), sum(length(data)) FROM blobs").fetchone()
+    input_bytes = conn.execute("SELECT sum(length(input)) FROM spans").fetchone()[0]
+    spans = tracer.get_spans_by_trace(t.trace_id)
+    full_bytes = sum(len(s.input.encode("utf-8")) for s in spans)
+    shared = conn.execute("SELECT count(*) FROM (SELECT hash FROM span_blobs GROUP BY hash HAVING count(*) >= 15)").fetchone()
+    assert shared[0] >= 2
+    assert blob_count <= shared[0] + 20
+    assert (blob_bytes + input_bytes) * 4 < full_bytes
+    assert '"question 7"' in spans[7].input and system in spans[7].input
+
+    [hit] = tracer.search_spans(query=SpanQuery(keywords=["question 7"]))
+    assert hit.input == spans[7].input
+    assert len(tracer.search_spans(query=SpanQuery(keywords=["careful assistant", '"question 1"']))) == 1
+    assert len(tracer.search_traces(query=TraceQuery(keywords=["to"]))) == 1
+
+
+def test_multi_turn_inputs_stored_as_deltas(tmp_path):
+    import json
+    import sqlite3
+
+    from kantan_llm.tracing.storage import StorageProfile
+
+    path = tmp_path / "traces.sqlite3"
+    tracer = SQLiteTracer(str(path), storage=StorageProfile(delta_inputs=True, delta_max_depth=4))
+    set_trace_processors([tracer])
+    messages = [{"role": "system", "content": "Be brief. " * 50}]
+    with trace("chat", group_id="conv-1") as t:
+        for turn in range(9):
+            messages.append({"role": "user", "content": f"turn {turn} question"})
+            with generation_span(input=list(messages), output=f"reply {turn}", model="gpt-4"):
+                pass
+            messages.append({"role": "assistant", "content": f"reply {turn}"})
+    with trace("chat", group_id="conv-1") as next_trace:
+        messages.append({"role": "user", "content": "follow-up"})
+        with generation_span(input=list(messages), output="done", model="gpt-4"):
+            pass
+
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT input_base_id, input_depth, length(input) FROM spans ORDER BY ingest_id").fetchall()
+    assert rows[0][0] is None
+    assert [depth for _, depth, _ in rows] == [0, 1, 2, 3, 4, 0, 1, 2, 3, 4]
+    assert rows[1][0] is not None and rows[1][2] < 200
+    assert rows[5][0] is None and rows[5][2] > 500  # keyframe after the depth cap
+
+    spans = tracer.get_spans_by_trace(t.trace_id)
+    assert [json.loads(s.input) for s in spans] == [messages[: 2 * n + 2] for n in range(9)]
+    assert spans[3].raw["span_data"]["input"] == json.loads(spans[3].input)
+    [follow_up] = tracer.get_spans_by_trace(next_trace.trace_id)
+    assert json.loads(follow_up.input) == messages
+    assert conn.execute("SELECT input_base_id FROM spans WHERE id = ?", (follow_up.span_id,)).fetchone()[0]
+
+    hits = tracer.search_spans(query=SpanQuery(trace_id=t.trace_id, keywords=["turn 0 question"]))
+    assert len(hits) == 9
+
+    # Re-ingesting a delta base stores its dependents in full first. / 基準Spanの再取り込み前に依存先を完全な値にする。
+    expected = spans[2].input
+    tracer.on_span_end(_ReplayedSpan(spans[1]))
+    assert tracer.get_span(spans[2].span_id).input == expected
+    assert tracer.get_span(spans[1].span_id).input == spans[1].input
+
+
+def test_retention_purges_old_traces_and_reclaims_space(tmp_path):
+    import json
+    import os
+    import sqlite3
+
+    from kantan_llm.tracing import RetentionPolicy
+    from kantan_llm.tracing.storage import StorageProfile
+
+    path = tmp_path / "traces.sqlite3"
+    tracer = SQLiteTracer(str(path), storage=StorageProfile.compact())
+    set_trace_processors([tracer])
+    messages = [{"role": "system", "content": "Answer politely. " * 40}]
+    with trace("chat", group_id="conv-1") as old:
+        messages.append({"role": "user", "content": "Kyoto weather?" + " filler" * 500})
+        with generation_span(input=list(messages), output="sunny", model="gpt-4"):
+            pass
+        with function_span(name="fetch", input="x", output=os.urandom(32 * 1024).hex()):
+            pass
+    with trace("chat", group_id="conv-1") as follow_up:
+        messages.append({"role": "user", "content": "and tomorrow?"})
+        with generation_span(input=list(messages), output="rain", model="gpt-4"):
+            pass
+    with trace("failed") as failed:
+        with custom_span(name="step") as span:
+            span.set_error({"message": "boom", "data": None})
+    with trace("judged") as judged:
+        with custom_span(name="judge", data={"rubric": {"score": 0.1}}):
+            pass
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert conn.execute("SELECT input_base_id FROM spans WHERE trace_id = ?", (follow_up.trace_id,)).fetchone()[0]
+    stale = (datetime.now(timezone.utc) - timedelta(days=30)).timestamp()
+    with conn:
+        conn.execute("UPDATE traces SET started_at_us = ? WHERE id != ?", (int(stale * 1e6), follow_up.trace_id))
+    blobs_before = conn.execute("SELECT count(*) FROM blobs").fetchone()[0]
+
+    policy = RetentionPolicy(max_age=timedelta(days=7), error_max_age=timedelta(days=90), keep_judged=True)
+    report = tracer.purge(policy)
+    assert (report.deleted_traces, report.deleted_spans) == (1, 2)
+    assert tracer.get_trace(old.trace_id) is None
+    assert tracer.get_trace(failed.trace_id) is not None
+    assert tracer.get_trace(judged.trace_id) is not None
+    # The follow-up's delta base was purged; its input was stored in full first. / 基準削除前に完全な値へ。
+    [span] = tracer.get_spans_by_trace(follow_up.trace_id)
+    assert json.loads(span.input) == messages
+    assert conn.execute("SELECT count(*) FROM blobs").fetchone()[0] <= blobs_before
+    assert report.reclaimed_bytes > 0
+    assert tracer.search_spans(query=SpanQuery(keywords=["Kyoto weather"]))[0].trace_id == follow_up.trace_id
+    assert tracer.purge(policy).deleted_traces == 0
+
+    # A size budget evicts the oldest traces, protected ones last. / 容量上限では古い順、保護対象は最後。
+    report = tracer.purge(RetentionPolicy(max_bytes=1, keep_judged=True, batch_size=1))
+    assert report.deleted_traces == 3
+    assert tracer.search_traces(query=TraceQuery()) == []
+
+
+def test_retention_ages_traces_by_epoch_and_purges_traces_without_spans(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing import RetentionPolicy
+
+    path = str(tmp_path / "traces.sqlite3")
+    tracer = _setup_tracer(tmp_path)
+    with trace("offset") as offset:
+        with custom_span(name="step"):
+            pass
+    with trace("utc") as utc:
+        with custom_span(name="step"):
+            pass
+    with trace("empty") as empty:
+        pass
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    with conn:
+        # Older than the cutoff, but written with +09:00 it sorts after it as text. / +09:00表記だと文字列比較では新しく見える。
+        old = (datetime.now(timezone.utc) - timedelta(days=7, hours=5)).astimezone(timezone(timedelta(hours=9)))
+        conn.execute("UPDATE spans SET started_at = ? WHERE trace_id = ?", (old.isoformat(), offset.trace_id))
+        conn.execute(
+            "UPDATE spans SET started_at_us = ? WHERE trace_id = ?", (int(old.timestamp() * 1e6), offset.trace_id)
+        )
+        conn.execute(
+            "UPDATE traces SET created_at_us = created_at_us - ? WHERE id = ?",
+            (int(timedelta(days=10).total_seconds() * 1e6), empty.trace_id),
+        )
+    for trace_id in (offset.trace_id, utc.trace_id):
+        tracer._refresh_trace_rollup(conn, trace_id)
+    conn.commit()
+    assert conn.execute("SELECT span_count FROM traces WHERE id = ?", (empty.trace_id,)).fetchone()[0] == 0
+
+    report = tracer.purge(RetentionPolicy(max_age=timedelta(days=7)))
+    assert report.deleted_traces == 2
+    assert tracer.get_trace(offset.trace_id) is None
+    assert tracer.get_trace(empty.trace_id) is None
+    assert tracer.get_trace(utc.trace_id) is not None
+    tracer.shutdown()
+
+
+def test_concurrent_purge_returns_while_another_connection_holds_the_write_lock(tmp_path):
+    import sqlite3
+    import threading
+
+    import pytest
+
+    from kantan_llm.tracing import RetentionPolicy
+
+    path = str(tmp_path / "traces.sqlite3")
+    tracer = SQLiteTracer(path, concurrent=True)
+    set_trace_processors([tracer])
+    _record_sample()
+    tracer.force_flush()
+    tracer._conn.execute("PRAGMA busy_timeout = 20")
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    policy = RetentionPolicy(max_age=timedelta(seconds=0))
+    outcome: list[BaseException | None] = []
+
+    def purge() -> None:
+        try:
+            tracer.purge(policy)
+            outcome.append(None)
+        except BaseException as exc:
+            outcome.append(exc)
+
+    worker = threading.Thread(target=purge, daemon=True)
+    worker.start()
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+    assert isinstance(outcome[0], sqlite3.OperationalError)
+    holder.execute("ROLLBACK")
+    holder.close()
+
+    assert tracer.purge(policy).deleted_traces == 1
+    tracer.shutdown()
+    set_trace_processors([])
+
+
+def test_partitioned_tracer_routes_by_day_and_merges_searches(tmp_path):
+    from types import SimpleNamespace
+
+    from kantan_llm.tracing import PartitionedSQLiteTracer
+
+    directory = tmp_path / "traces"
+    tracer = PartitionedSQLiteTracer(str(directory))
+    # Probing capabilities creates no partition. / capabilitiesの問い合わせでパーティションを作らない。
+    assert tracer.capabilities().supports_cursor
+    assert tracer.partitions() == [] and list(directory.glob("*.sqlite3")) == []
+    set_trace_processors([tracer])
+    with trace("today") as today:
+        with custom_span(name="step", data={"n": 1}):
+            pass
+        with custom_span(name="step", data={"n": 2}):
+            pass
+    template = tracer.get_spans_by_trace(today.trace_id)[0]
+    now = datetime.now(timezone.utc)
+    for days in (3, 2):
+        started = (now - timedelta(days=days)).isoformat()
+        raw = {**template.raw, "id": f"span-{days}", "trace_id": f"trace-{days}", "started_at": started, "ended_at": started}
+        tracer.on_span_end(_ReplayedSpan(SimpleNamespace(raw=raw)))
+    assert len(tracer.partitions()) == 3
+    assert all(tracer.partition_path(key).exists() for key in tracer.partitions())
+
+    reopened = PartitionedSQLiteTracer(str(directory))
+    expected = [today.trace_id, "trace-2", "trace-3"]
+    assert [t.trace_id for t in reopened.search_traces(query=TraceQuery())] == expected
+    first = reopened.search_traces(query=TraceQuery(limit=2))
+    rest = reopened.search_traces(query=TraceQuery(limit=2, cursor=first.next_cursor))
+    assert [t.trace_id for t in [*first, *rest]] == expected
+    recent = reopened.search_traces(query=TraceQuery(started_from=now - timedelta(hours=1)))
+    assert [t.trace_id for t in recent] == [today.trace_id]
+    assert [t.trace_id for t in reopened.iter_traces(query=TraceQuery(order_by="started_at"))] == expected[::-1]
+
+    spans, cursor = [], None
+    while True:
+        page = reopened.search_spans(query=SpanQuery(limit=1, cursor=cursor))
+        spans.extend(page)
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert [s.trace_id for s in spans] == ["trace-3", "trace-2", today.trace_id, today.trace_id]
+    assert reopened.get_trace("trace-3") is not None
+    assert reopened.get_span("span-2").trace_id == "trace-2"
+    assert [s.span_id for s in reopened.get_spans_since(today.trace_id, spans[2].ingest_seq)] == [spans[3].span_id]
+
+    # A drop waits for queries still iterating the partition. / 走査中のパーティションは走査終了後に削除する。
+    streaming = reopened.iter_spans(query=SpanQuery(), chunk_size=1)
+    assert next(streaming).trace_id == "trace-3"
+    dropped = reopened.drop_partitions(before=now - timedelta(days=1))
+    assert len(dropped) == 2
+    assert reopened.partition_path(dropped[0]).exists()
+    # Partitions not reached yet are skipped, not recreated. / 未到達の破棄済みパーティションは読み飛ばす。
+    assert [s.trace_id for s in streaming] == [today.trace_id, today.trace_id]
+    assert not any((directory / f"traces-{key}.sqlite3").exists() for key in dropped)
+    assert [t.trace_id for t in reopened.search_traces(query=TraceQuery())] == [today.trace_id]
+    reopened.shutdown()
+
+
+def test_jsonl_tracer_flushes_the_tail_when_writes_pause(tmp_path):
+    import time
+
+    from kantan_llm.tracing import JSONLTraceReader, JSONLTracer
+
+    directory = tmp_path / "jsonl"
+    tracer = JSONLTracer(str(directory), fsync_interval=timedelta(milliseconds=50))
+    set_trace_processors([tracer])
+    trace_id = _record_sample()
+    reader = JSONLTraceReader(str(directory))
+    # No further write and no force_flush: the background flush makes the tail visible.
+    # / 後続の書き込みもforce_flushも無いが、裏のflushで末尾が読めるようになる。
+    deadline = time.monotonic() + 5
+    while len(reader.get_spans_by_trace(trace_id)) < 5 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(reader.get_spans_by_trace(trace_id)) == 5
+    tracer.shutdown()
+    set_trace_processors([])
+
+
+def test_jsonl_reader_seeks_gzipped_segments_for_trace_lookups(tmp_path, monkeypatch):
+    import gzip
+
+    from kantan_llm.tracing import JSONLTraceReader, JSONLTracer
+    from kantan_llm.tracing import jsonl
+
+    directory = tmp_path / "jsonl"
+    tracer = JSONLTracer(str(directory), max_bytes=2048, compress=True)
+    set_trace_processors([tracer])
+    trace_ids = [_record_sample() for _ in range(3)]
+    tracer.shutdown()
+    set_trace_processors([])
+    segments = list(directory.glob("*.jsonl.gz"))
+    assert len(segments) > 1
+
+    inflated: list[int] = []
+    original = gzip.decompress
+
+    def decompress(data: bytes) -> bytes:
+        inflated.append(len(data))
+        return original(data)
+
+    monkeypatch.setattr(jsonl.gzip, "decompress", decompress)
+    reader = JSONLTraceReader(str(directory))
+    # trace_id lookups read the indexed lines only. / trace_id指定は索引にある行だけを読む。
+    assert len(reader.get_spans_by_trace(trace_ids[1])) == 5
+    assert reader.get_trace(trace_ids[2]).span_count == 5
+    assert inflated == []
+    # Full scans inflate each segment once and reuse it. / 全件走査は各セグメントを1回だけ展開して再利用する。
+    assert len(reader.search_spans(query=SpanQuery())) == 15
+    assert len(reader.search_spans(query=SpanQuery(name="tool_a"))) == 3
+    assert len(inflated) == len(segments)
+
+
+def test_jsonl_tracer_rotates_and_reader_searches_segments(tmp_path):
+    from kantan_llm.tracing import JSONLTraceReader, JSONLTracer
+
+    directory = tmp_path / "jsonl"
+    tracer = JSONLTracer(str(directory), max_bytes=2048, compress=True)
+    set_trace_processors([tracer])
+    trace_ids = [_record_sample() for _ in range(3)]
+    tracer.force_flush()
+
+    reader = JSONLTraceReader(str(directory))
+    # The active segment is readable before rotation completes. / 書き込み中のセグメントも読める。
+    assert len(reader.get_spans_by_trace(trace_ids[-1])) == 5
+    tracer.shutdown()
+    assert list(directory.glob("*.jsonl")) == []
+    segments = sorted(directory.glob("*.jsonl.gz"))
+    assert len(segments) > 1 and len(list(directory.glob("*.idx"))) == len(segments)
+
+    assert [t.trace_id for t in reader.search_traces(query=TraceQuery(order_by="started_at"))] == trace_ids
+    record = reader.get_trace(trace_ids[0])
+    assert (record.workflow_name, record.span_count, record.error_count) == ("workflow", 5, 0)
+    assert record.usage_total == {"input_tokens": 3, "output_tokens": 2, "total_tokens": 5}
+    assert [t.trace_id for t in reader.search_traces(query=TraceQuery(keywords=["score me", "tool check"]))] == trace_ids[::-1]
+
+    failed = find_failed_judges(reader, threshold=0.8, limit=10)
+    assert [s.rubric["score"] for s in failed] == [0.7, 0.7, 0.7]
+    scoped = find_failed_judges(reader, threshold=0.8, trace_query=TraceQuery(trace_id=trace_ids[1]))
+    assert [s.trace_id for s in scoped] == [trace_ids[1]]
+
+    spans, cursor = [], None
+    while True:
+        page = reader.search_spans(query=SpanQuery(limit=4, cursor=cursor))
+        spans.extend(page)
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert len(spans) == 15 and [s.ingest_seq for s in spans] == sorted(s.ingest_seq for s in spans)
+    first = reader.get_spans_by_trace(trace_ids[0])
+    assert reader.get_spans_since(trace_ids[0], first[1].ingest_seq) == first[2:]
+    assert reader.get_span(first[0].span_id).input == "hello world"
+
+
+def test_memory_tracer_matches_sqlite_semantics_and_bounds_memory(tmp_path):
+    from dataclasses import asdict
+
+    from kantan_llm.tracing import MemoryTracer
+
+    sqlite_tracer = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    memory = MemoryTracer(capacity=100)
+    set_trace_processors([sqlite_tracer, memory])
+    trace_ids = [_record_sample() for _ in range(2)]
+    with trace("failing", metadata={"env": "dev"}):
+        with custom_span(name="step") as span:
+            span.set_error({"message": "boom", "data": None})
+
+    def spans(service, query):
+        return [asdict(s) for s in service.search_spans(query=query)]
+
+    def traces(service, query):
+        records = service.search_traces(query=query)
+        return [(t.trace_id, t.workflow_name, t.span_count, t.error_count, t.usage_total) for t in records]
+
+    for query in (
+        SpanQuery(),
+        SpanQuery(trace_id=trace_ids[0], span_type="generation"),
+        SpanQuery(keywords=["HELLO", "world"]),
+        SpanQuery(has_error=True),
+        SpanQuery(has_tool_call=True, started_from=datetime.now() - timedelta(minutes=1)),
+    ):
+        assert spans(memory, query) == spans(sqlite_tracer, query)
+    for query in (
+        TraceQuery(),
+        TraceQuery(keywords=["score me", "tool check"]),
+        TraceQuery(has_error=False, order_by="span_count"),
+        TraceQuery(metadata={"env": "dev"}),
+    ):
+        assert traces(memory, query) == traces(sqlite_tracer, query)
+    first = memory.search_spans(query=SpanQuery(limit=4))
+    rest = memory.search_spans(query=SpanQuery(limit=4, cursor=first.next_cursor))
+    assert [s.span_id for s in [*first, *rest]] == [s.span_id for s in memory.search_spans(query=SpanQuery())][:8]
+    by_trace = memory.get_spans_by_trace(trace_ids[1])
+    assert memory.get_spans_since(trace_ids[1], by_trace[2].ingest_seq) == by_trace[3:]
+
+    # Oldest spans are evicted past capacity. / 上限を超えると古いSpanから捨てる。
+    small = MemoryTracer(capacity=6)
+    set_trace_processors([small])
+    old, new = _record_sample(), _record_sample()
+    assert len(small.search_spans(query=SpanQuery())) == 6
+    assert small.get_trace(old) is None or small.get_trace(old).span_count == 1
+    assert small.get_trace(new).span_count == 5
+
+    # Span-less traces go first; a trace keeps its row while its spans remain. / Spanが残るTraceの行は残す。
+    tiny = MemoryTracer(capacity=2)
+    set_trace_processors([tiny])
+    with trace("kept") as kept:
+        with custom_span(name="step"):
+            pass
+    for n in range(3):
+        with trace(f"empty-{n}"):
+            pass
+    assert tiny.get_trace(kept.trace_id).workflow_name == "kept"
+    assert [t.workflow_name for t in tiny.search_traces(query=TraceQuery(workflow_name="kept"))] == ["kept"]
+
+
+def test_find_failed_judges_filters_rubric_score_in_sql(tmp_path):
+    import sqlite3
+
+    tracer = _setup_tracer(tmp_path)
+    with trace("judge"):
+        for n in range(10):
+            with custom_span(name="judge", data={"rubric": {"score": 0.9}}):
+                pass
+        with custom_span(name="judge", data={"rubric": {"score": 0.1, "comment": "late failure"}}):
+            pass
+
+    # The failure after ten passing judges is found even with limit=5. / 合格10件の後の失敗もlimit=5で見つかる。
+    failed = find_failed_judges(tracer, threshold=0.6, limit=5)
+    assert [s.rubric["score"] for s in failed] == [0.1]
+    spans = tracer.search_spans(query=SpanQuery(rubric_score_gte=0.5, rubric_score_lt=1.0))
+    assert len(spans) == 10
+    tracer.shutdown()
+
+    # Existing databases get rubric_score backfilled once. / 既存DBは移行時に1回だけ埋める。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("DROP INDEX idx_spans_rubric_score")
+    conn.execute("ALTER TABLE spans DROP COLUMN rubric_score")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    assert [s.rubric["score"] for s in find_failed_judges(reopened, threshold=0.6, limit=5)] == [0.1]
+
+
+def test_find_failed_judges_batches_trace_ids(tmp_path):
+    from kantan_llm.tracing import MemoryTracer, PartitionedSQLiteTracer
+
+    tracer = _setup_tracer(tmp_path)
+    memory = MemoryTracer()
+    partitioned = PartitionedSQLiteTracer(str(tmp_path / "parts"))
+    set_trace_processors([tracer, memory, partitioned])
+    for n in range(3):
+        with trace(f"judge-{n}"):
+            with custom_span(name="judge", data={"rubric": {"score": 0.1 * n}}):
+                pass
+            with custom_span(name="judge", data={"rubric": {"score": 0.9}}):
+                pass
+    trace_ids = [record.trace_id for record in tracer.search_traces(query=TraceQuery(order_by="started_at"))]
+
+    for service in (tracer, memory, partitioned):
+        assert service.capabilities().supports_trace_ids
+        spans = service.search_spans(query=SpanQuery(trace_ids=trace_ids[:2], name="judge"))
+        assert sorted({s.trace_id for s in spans}) == sorted(trace_ids[:2])
+        assert len(spans) == 4
+        assert list(service.search_spans(query=SpanQuery(trace_ids=[]))) == []
+
+    # One span query per chunk, results in trace order. / チャンクごとに1回の検索、結果はTrace順。
+    calls = []
+    original = tracer.search_spans
+
+    def counting(*, query):
+        calls.append(query)
+        return original(query=query)
+
+    tracer.search_spans = counting
+    failed = find_failed_judges(tracer, threshold=0.5, trace_query=TraceQuery(order_by="-started_at"))
+    assert [s.trace_id for s in failed] == trace_ids[::-1]
+    assert len(calls) == 1 and calls[0].trace_ids == trace_ids[::-1]
+    assert [s.trace_id for s in find_failed_judges(tracer, threshold=0.5, limit=2, trace_query=TraceQuery())] == (
+        trace_ids[::-1][:2]
+    )
+    partitioned.shutdown()
+    tracer.shutdown()
+
+
+def test_aggregate_groups_spans_in_sql():
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+    from kantan_llm.tracing import AggregateQuery, MemoryTracer
+
+    tracer = SQLiteTracer(":memory:")
+    memory = MemoryTracer()
+    set_trace_processors([tracer, memory])
+    for n in range(4):
+        with trace("chat" if n % 2 else "batch"):
+            with generation_span(
+                input="q", output="a", model="gpt-4" if n < 3 else "gpt-4o-mini", usage={"input_tokens": 10 + n}
+            ):
+                pass
+            with custom_span(name="judge", data={"rubric": {"score": 0.2 * n, "tags": ["tone" if n else "fact"]}}):
+                pass
+
+    query = AggregateQuery(
+        group_by=["model"],
+        measures=["count", "error_rate", "input_tokens", "duration_p50", "duration_p99"],
+        spans=SpanQuery(span_type="generation"),
+        order_by="-count",
+    )
+    rows = tracer.aggregate(query=query)
+    assert [(r.group["model"], r.values["count"], r.values["input_tokens"]) for r in rows] == [
+        ("gpt-4", 3, 33),
+        ("gpt-4o-mini", 1, 13),
+    ]
+    assert rows[0].values["error_rate"] == 0
+    assert 0 <= rows[0].values["duration_p50"] <= rows[0].values["duration_p99"]
+
+    # Python implementations return the same groups. / Python実装も同じ集計を返す。
+    by_bucket = AggregateQuery(group_by=["workflow_name", "rubric_bucket"], spans=SpanQuery(name="judge"))
+    expected = [(r.group, r.values) for r in tracer.aggregate(query=by_bucket)]
+    assert expected == [
+        ({"workflow_name": "batch", "rubric_bucket": "fact"}, {"count": 1}),
+        ({"workflow_name": "batch", "rubric_bucket": "tone"}, {"count": 1}),
+        ({"workflow_name": "chat", "rubric_bucket": "tone"}, {"count": 2}),
+    ]
+    assert [(r.group, r.values) for r in memory.aggregate(query=by_bucket)] == expected
+    totals = AggregateQuery(measures=["count", "rubric_score_avg"], workflow_name="chat")
+    assert [r.values for r in tracer.aggregate(query=totals)] == [r.values for r in memory.aggregate(query=totals)]
+
+    with pytest.raises(NotSupportedError):
+        tracer.aggregate(query=AggregateQuery(group_by=["nope"]))
+    tracer.shutdown()
+
+
+def test_span_epoch_columns_drive_range_filters_and_backfill(tmp_path):
+    import sqlite3
+
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    span = tracer.search_spans(query=SpanQuery(trace_id=trace_id, span_type="generation"))[0]
+    tracer.shutdown()
+
+    # Existing databases get the epoch columns backfilled once. / 既存DBは移行時に1回だけ埋める。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    for index in ("started_at_us", "duration_ms", "model", "provider", "api_kind"):
+        conn.execute(f"DROP INDEX idx_spans_{index}")
+    for column in ("started_at_us", "ended_at_us", "duration_ms"):
+        conn.execute(f"ALTER TABLE spans DROP COLUMN {column}")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+
+    # Bounds in another offset compare as instants, not as text. / 別オフセットの境界も時刻として比較する。
+    tokyo = timezone(timedelta(hours=9))
+    start = span.started_at.astimezone(tokyo)
+    hits = reopened.search_spans(query=SpanQuery(trace_id=trace_id, started_from=start, started_to=start))
+    assert [s.span_id for s in hits] == [span.span_id]
+    later = reopened.search_spans(query=SpanQuery(trace_id=trace_id, started_from=start + timedelta(microseconds=1)))
+    assert span.span_id not in [s.span_id for s in later]
+    reopened.shutdown()
+
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    started_us, duration = conn.execute(
+        "SELECT started_at_us, duration_ms FROM spans WHERE id = ?", (span.span_id,)
+    ).fetchone()
+    conn.close()
+    assert started_us == round(span.started_at.timestamp() * 1_000_000)
+    assert duration is not None and duration >= 0
+
+
+def test_model_provider_api_kind_are_span_columns(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing import AggregateQuery, MemoryTracer
+
+    tracer = _setup_tracer(tmp_path)
+    memory = MemoryTracer()
+    set_trace_processors([tracer, memory])
+    with trace("chat"):
+        with generation_span(input="a", model="gpt-4.1-mini", provider="openai", api_kind="responses"):
+            pass
+        with generation_span(input="b", model="llama3", provider="ollama", api_kind="chat.completions"):
+            pass
+        # Older wrappers recorded provider/api_kind only in the error payload. / 旧形式はエラー情報にだけ残る。
+        with generation_span(input="c", model="llama3") as span:
+            span.set_error(
+                {"message": "boom", "data": {"api_kind": "chat.completions", "llm_context": {"provider": "ollama"}}}
+            )
+
+    for service in (tracer, memory):
+        spans = service.search_spans(query=SpanQuery(model="gpt-4.1-mini"))
+        assert [s.input for s in spans] == ["a"]
+        spans = service.search_spans(query=SpanQuery(provider="ollama", api_kind="chat.completions"))
+        assert [s.input for s in spans] == ["b", "c"]
+    rows = tracer.aggregate(query=AggregateQuery(group_by=["provider"], measures=["count", "error_count"]))
+    assert [(r.group["provider"], r.values["count"], r.values["error_count"]) for r in rows] == [
+        ("ollama", 2, 1),
+        ("openai", 1, 0),
+    ]
+    tracer.shutdown()
+
+    # Existing databases get the columns backfilled once. / 既存DBは移行時に1回だけ埋める。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    for column in ("model", "provider", "api_kind"):
+        conn.execute(f"DROP INDEX idx_spans_{column}")
+        conn.execute(f"ALTER TABLE spans DROP COLUMN {column}")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    spans = reopened.search_spans(query=SpanQuery(provider="ollama", model="llama3"))
+    assert [s.input for s in spans] == ["b", "c"]
+    reopened.shutdown()
+
+
+def test_indexed_metadata_keys_use_generated_columns(tmp_path, monkeypatch):
+    import sqlite3
+
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+
+    tracer = _setup_tracer(tmp_path)
+    for n in range(6):
+        with trace(f"run-{n}", metadata={"tenant": f"t{n % 3}", "flag": n % 2 == 0}):
+            with custom_span(name="step", data={}):
+                pass
+    tracer.shutdown()
+
+    # Keys can be added to an existing database. / 既存DBにも後からキーを追加できる。
+    indexed = SQLiteTracer(str(tmp_path / "traces.sqlite3"), indexed_metadata_keys=["tenant", "flag"])
+    query = TraceQuery(metadata={"tenant": "t1", "flag": False})
+    assert [t.workflow_name for t in indexed.search_traces(query=query)] == ["run-1"]
+    assert {t.workflow_name for t in indexed.search_traces(query=TraceQuery(metadata={"tenant": "t0"}))} == {
+        "run-0",
+        "run-3",
+    }
+    sql, params, _, _ = indexed._trace_search_sql(TraceQuery(metadata={"tenant": "t1"}))
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    plan = " ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+    conn.close()
+    assert "idx_traces_meta_tenant" in plan
+    indexed.shutdown()
+
+    with pytest.raises(NotSupportedError):
+        SQLiteTracer(str(tmp_path / "traces.sqlite3"), indexed_metadata_keys=["a.b"])
+
+    # Without JSON1 the open fails and the connection is closed, not kept half-initialized.
+    # / JSON1が無ければ開く処理が失敗し、初期化途中の接続は閉じる。
+    from kantan_llm.tracing import processors
+
+    closed: list[sqlite3.Connection] = []
+    connect = sqlite3.connect
+
+    class _Conn(sqlite3.Connection):
+        def close(self) -> None:
+            closed.append(self)
+            super().close()
+
+    monkeypatch.setattr(processors, "_detect_json1", lambda conn: False)
+    monkeypatch.setattr(processors.sqlite3, "connect", lambda *a, **kw: connect(*a, factory=_Conn, **kw))
+    broken = SQLiteTracer(str(tmp_path / "traces.sqlite3"), indexed_metadata_keys=["tenant"])
+    with pytest.raises(NotSupportedError):
+        broken.capabilities()
+    assert broken._conn is None and len(closed) == 1
+
+
+def test_predicates_compile_to_sql_and_match_python():
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+    from kantan_llm.tracing import Compare, MemoryTracer, Not
+
+    tracer = SQLiteTracer(":memory:")
+    memory = MemoryTracer()
+    set_trace_processors([tracer, memory])
+    with trace("big"):
+        with generation_span(input="long", model="m", usage={"input_tokens": 9000}):
+            pass
+        with generation_span(input="failed", model="m", usage={"input_tokens": 9500}) as span:
+            span.set_error({"message": "boom"})
+    with trace("small"):
+        with generation_span(input="short", model="m", usage={"input_tokens": 10}):
+            pass
+        with generation_span(input="no usage", model="m"):
+            pass
+
+    # "More than 8k input tokens or slow, and no error". / 「8k token超か遅い、かつエラーなし」。
+    predicate = (Compare("input_tokens", ">", 8000) | Compare("duration_ms", ">", 20_000)) & ~Compare(
+        "has_error", "=", True
+    )
+    for service in (tracer, memory):
+        assert "input_tokens" in service.capabilities().span_predicate_fields
+        spans = service.search_spans(query=SpanQuery(where=predicate))
+        assert [s.input for s in spans] == ["long"]
+        # Missing values never match a comparison, even negated (SQL NULL). / 値が無ければ否定しても一致しない。
+        spans = service.search_spans(query=SpanQuery(where=Not(Compare("input_tokens", "<", 100))))
+        assert [s.input for s in spans] == ["long", "failed"]
+        spans = service.search_spans(query=SpanQuery(span_type="generation", where=Compare("input_tokens", "=", None)))
+        assert [s.input for s in spans] == ["no usage"]
+        traces = service.search_traces(query=TraceQuery(where=Compare("input_tokens", ">=", 18000)))
+        assert [t.workflow_name for t in traces] == ["big"]
+
+    sql, params, _ = tracer._span_search_sql(SpanQuery(where=predicate))
+    assert "json_extract(usage_json, '$.input_tokens') END > ?" in sql and params[:3] == [8000, 20_000, 1]
+    with pytest.raises(NotSupportedError):
+        tracer.search_spans(query=SpanQuery(where=Compare("raw_json", "=", "x")))
+    with pytest.raises(NotSupportedError):
+        memory.search_spans(query=SpanQuery(where=Compare("duration_ms", "~", 1)))
+    tracer.shutdown()
+
+
+def test_usage_rollups_track_generation_tokens(tmp_path):
+    import sqlite3
+
+    from kantan_llm.tracing import UsageQuery
+
+    tracer = _setup_tracer(tmp_path)
+    with trace("chat"):
+        for model in ("gpt-4.1-mini", "gpt-4.1-mini", "llama3"):
+            with generation_span(
+                input="q",
+                model=model,
+                provider="ollama" if model == "llama3" else "openai",
+                usage={
+                    "input_tokens": 10,
+                    "output_tokens": 4,
+                    "input_tokens_details": {"cached_tokens": 6},
+                    "output_tokens_details": {"reasoning_tokens": 2},
+                },
+            ) as span:
+                pass
+        with custom_span(name="judge", data={"usage": {"input_tokens": 99}}):
+            pass
+    # Re-ingesting a span replaces its contribution. / 再取り込みは寄与を置き換える。
+    tracer.on_span_end(span)
+
+    rows = tracer.usage_rollups(query=UsageQuery(group_by=["provider", "model"]))
+    assert [(r.group, r.requests, r.input_tokens, r.cached_tokens, r.reasoning_tokens) for r in rows] == [
+        ({"provider": "ollama", "model": "llama3"}, 1, 10, 6, 2),
+        ({"provider": "openai", "model": "gpt-4.1-mini"}, 2, 20, 12, 4),
+    ]
+    [total] = tracer.usage_rollups(query=UsageQuery(group_by=["day", "workflow_name"], provider="openai"))
+    assert total.group["workflow_name"] == "chat" and total.output_tokens == 8 and total.errors == 0
+    assert tracer.capabilities().supports_usage_rollups
+    tracer.shutdown()
+
+    # Databases written before the table existed are backfilled. / 既存DBは移行時に埋める。
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("DROP TABLE usage_rollups")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteTracer(str(tmp_path / "traces.sqlite3"))
+    assert [r.requests for r in reopened.usage_rollups(query=UsageQuery())] == [3]
+    reopened.shutdown()
+
+
+def test_cached_search_service_reuses_results_until_data_changes(tmp_path):
+    import sqlite3
+
+    import pytest
+
+    from kantan_llm.errors import NotSupportedError
+    from kantan_llm.tracing import AggregateQuery, CachedTraceSearchService, MemoryTracer
+
+    tracer = _setup_tracer(tmp_path)
+    _record_sample()
+    cached = CachedTraceSearchService(tracer, maxsize=2)
+    query = TraceQuery(workflow_name="workflow", metadata={"b": 1, "a": 2})
+    first = cached.search_traces(query=query)
+    # Equal queries (dict order aside) hit the cache. / dictの順序が違っても同じキャッシュに当たる。
+    assert cached.search_traces(query=TraceQuery(workflow_name="workflow", metadata={"a": 2, "b": 1})) == first
+    assert (cached.hits, cached.misses) == (1, 1)
+
+    _record_sample()
+    assert cached.hits == 1
+    assert len(cached.search_traces(query=TraceQuery(workflow_name="workflow"))) == 2
+
+    # Commits from another connection invalidate too. / 別接続のコミットでも無効になる。
+    cached.aggregate(query=AggregateQuery())
+    conn = sqlite3.connect(str(tmp_path / "traces.sqlite3"))
+    conn.execute("DELETE FROM spans WHERE span_type = 'generation'")
+    conn.commit()
+    conn.close()
+    [row] = cached.aggregate(query=AggregateQuery())
+    assert row.values["count"] == len(tracer.search_spans(query=SpanQuery()))
+
+    # LRU: the oldest of three queries is evicted. / 3件目で最も古い結果を追い出す。
+    hits = cached.hits
+    for name in ("a", "b", "c", "a"):
+        cached.search_spans(query=SpanQuery(name=name))
+    assert cached.hits == hits
+
+    memory = MemoryTracer()
+    cached_memory = CachedTraceSearchService(memory)
+    assert cached_memory.search_spans(query=SpanQuery()) == []
+    set_trace_processors([memory])
+    _record_sample()
+    assert cached_memory.search_spans(query=SpanQuery())
+
+    with pytest.raises(NotSupportedError):
+        CachedTraceSearchService(object())
+    tracer.shutdown()
+
+
+def test_watch_spans_tails_new_spans(tmp_path):
+    import asyncio
+    import threading
+
+    tracer = _setup_tracer(tmp_path)
+    trace_id = _record_sample()
+    backlog = [span.span_id for span in tracer.get_spans_by_trace(trace_id)]
+
+    # since_seq replays the trace's backlog first. / since_seqは既存分から返す。
+    replayed = tracer.watch_spans(trace_id=trace_id, since_seq=0, timeout=0.2)
+    assert [span.span_id for span in replayed] == backlog
+
+    def record_later() -> None:
+        with trace("other"):
+            with custom_span(name="skipped"):
+                pass
+        with trace("workflow"):
+            with custom_span(name="live"):
+                pass
+
+    timer = threading.Timer(0.1, record_later)
+    timer.start()
+    watched = tracer.watch_spans(workflow_name="workflow", timeout=1.0)
+    assert next(watched).name == "live"
+    watched.close()
+    timer.join()
+
+    async def tail() -> list[str]:
+        names = []
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: threading.Thread(target=record_later).start())
+        async for span in tracer.awatch_spans(workflow_name="workflow", timeout=1.0):
+            names.append(span.name)
+            break
+        return names
+
+    assert asyncio.run(tail()) == ["live"]
+    assert tracer.capabilities().supports_watch
+    tracer.shutdown()
+
+
+def test_watch_spans_sees_other_connections(tmp_path):
+    import threading
+
+    path = str(tmp_path / "traces.sqlite3")
+    reader = SQLiteTracer(path, concurrent=True)
+    reader.capabilities()
+    writer = SQLiteTracer(path, concurrent=True)
+    set_trace_processors([writer])
+
+    def record_later() -> None:
+        with trace("workflow"):
+            with custom_span(name="remote"):
+                pass
+        writer.force_flush()
+
+    timer = threading.Timer(0.1, record_later)
+    timer.start()
+    # Another tracer's commits arrive through data_version polling. / 別トレーサーのコミットはdata_versionで検知する。
+    assert [span.name for span in reader.watch_spans(workflow_name="workflow", timeout=2.0)] == ["remote"]
+    timer.join()
+    writer.shutdown()
+    reader.shutdown()
+
+
+def test_watch_spans_survives_deleting_newest_span(tmp_path):
+    import threading
+
+    tracer = _setup_tracer(tmp_path)
+    with trace("workflow"):
+        with custom_span(name="old"):
+            pass
+    tracer.force_flush()
+    newest = tracer._run_write(lambda conn: conn.execute("SELECT MAX(ingest_id) FROM spans").fetchone()[0])
+
+    def delete_then_record() -> None:
+        # Dropping the newest row must not hand its ingest_id out again. / 最新行を消してもingest_idは再利用しない。
+        tracer._run_write(lambda conn: conn.execute("DELETE FROM spans WHERE ingest_id = ?", (newest,)))
+        with trace("workflow"):
+            with custom_span(name="new"):
+                pass
+        tracer.force_flush()
+
+    timer = threading.Timer(0.1, delete_then_record)
+    timer.start()
+    assert [span.name for span in tracer.watch_spans(workflow_name="workflow", timeout=2.0)] == ["new"]
+    timer.join()
+    ids = tracer._run_write(lambda conn: [row[0] for row in conn.execute("SELECT ingest_id FROM spans")])
+    assert min(ids) > newest
+    tracer.shutdown()
+
+
+def test_trace_time_range_matches_any_span_in_range(tmp_path):
+    from kantan_llm.tracing import MemoryTracer
+
+    tracer = _setup_tracer(tmp_path)
+    memory = MemoryTracer()
+    set_trace_processors([tracer, memory])
+    with trace("long-running") as t:
+        with custom_span(name="first"):
+            pass
+        middle = datetime.now(timezone.utc)
+        with custom_span(name="second"):
+            pass
+
+    # The trace started before ``middle`` but has a span after it. / 開始はmiddle以前だが以降のSpanを持つ。
+    query = TraceQuery(started_from=middle)
+    assert [r.trace_id for r in tracer.search_traces(query=query)] == [t.trace_id]
+    assert [r.trace_id for r in memory.search_traces(query=query)] == [t.trace_id]
+    later = TraceQuery(started_from=datetime.now(timezone.utc) + timedelta(seconds=1))
+    assert tracer.search_traces(query=later) == memory.search_traces(query=later) == []
+    tracer.shutdown()
@@ -88,6 +88,7 @@ def test_auto_trace_creates_trace_and_span(monkeypatch):
     span_data = span_export["span_data"]
     assert "sk-***" in span_data["input"]
     assert "Bearer ***" in span_data["output"]
+    assert (span_data["model"], span_data["provider"], span_data["api_kind"]) == ("gpt-4.1-mini", "openai", "responses")
 
 
 def test_with_trace_creates_single_trace_multiple_spans(monkeypatch):